@@ -23,6 +23,7 @@ try:
     import cPickle as pickle
 except ImportError:
     import pickle
+import re
 import runpy
 import signal
 import socket
@@ -38,8 +39,9 @@ from six import exec_
 from six.moves import builtins
 from six.moves.configparser import ConfigParser, NoOptionError, NoSectionError
 
-from profiling import remote, sampling, tracing
+from profiling import governor, remote, sampling, tracing
 from profiling.__about__ import __version__
+from profiling.filters import CodeFilter
 from profiling.profiler import Profiler
 from profiling.remote.background import BackgroundProfiler
 from profiling.remote.client import FailoverProfilingClient, ProfilingClient
@@ -113,13 +115,20 @@ class read_config(object):
         return config
 
 
+def get_tuple_option(config, section, option):
+    """Gets a configuration option separated by commas or lines as a tuple."""
+    value = config.get(section, option)
+    return tuple(x.strip() for x in re.split(r'[,\n]', value) if x.strip())
+
+
 def option_getter(type):
     """Gets an unbound method to get a configuration option as the given type.
     """
     option_getters = {None: ConfigParser.get,
                       int: ConfigParser.getint,
                       float: ConfigParser.getfloat,
-                      bool: ConfigParser.getboolean}
+                      bool: ConfigParser.getboolean,
+                      tuple: get_tuple_option}
     return option_getters.get(type, option_getters[None])
 
 
@@ -437,8 +446,35 @@ def profiler_options(f):
     @click.option(
         '--timer', 'timer_class',
         type=Class([timers], timers.Timer, 'basic'),
-        default=config_default('timer', 'basic'),
-        help='Choose CPU timer for tracing profiler. (basic|thread|greenlet)')
+        default=config_default('timer'),
+        help=('Choose timer for tracing profiler. '
+              '(basic|thread|greenlet|asyncio|wall, default: thread)'))
+    @click.option(
+        '--backend', type=click.Choice(tracing.BACKENDS),
+        default=config_default('backend', tracing.BACKEND),
+        help=('Choose tracing backend for tracing profiler. '
+              '(setprofile|monitoring, default: setprofile)'))
+    @click.option(
+        '--hot-threshold', type=float, metavar='SEC',
+        default=config_default('hot-threshold', type=float),
+        help=('Stop timing functions called so often whose mean CPU time '
+              'per call is shorter than it.  Their times are estimated.'))
+    @click.option(
+        '--c-calls/--no-c-calls', 'trace_c_calls',
+        default=config_default('c-calls', False),
+        help='Record C function calls such as builtin functions also.')
+    @click.option(
+        '--histograms/--no-histograms', 'histograms',
+        default=config_default('histograms', False),
+        help='Record latency histograms to show percentiles.')
+    @click.option(
+        '--exemplar', 'exemplar_targets', multiple=True, metavar='NAME',
+        default=config_default('exemplar', ()),
+        help='Keep the call trees of the slowest calls of the function.')
+    @click.option(
+        '--collapse-recursion/--no-collapse-recursion', 'collapse_recursion',
+        default=config_default('collapse-recursion', False),
+        help='Record recursive calls into the outermost call.')
     # sampling profiler options
     @click.option(
         '-S', '--sampling', 'import_profiler_class',
@@ -449,32 +485,85 @@ def profiler_options(f):
         '--sampler', 'sampler_class',
         type=Class([samplers], samplers.Sampler),
         default=config_default('sampler', 'itimer'),
-        help='Choose frames sampler for sampling profiler. (itimer|tracing)')
+        help='Choose frames sampler for sampling profiler. '
+             '(itimer|tracing|threads)')
     @click.option(
         '--sampling-interval', type=float,
         default=config_default('sampling-interval', samplers.INTERVAL),
         help='How often sample. (default: %.3f cpu sec)' % samplers.INTERVAL)
+    @click.option(
+        '--sampling-overhead', type=float, metavar='RATIO',
+        default=config_default('sampling-overhead', type=float),
+        help=('Adjust the sampling interval so that sampling spends the '
+              'ratio of the time such as 0.01.'))
+    @click.option(
+        '--async-stacks/--no-async-stacks', 'async_stacks',
+        default=config_default('async-stacks', False),
+        help='Sample the logical call stacks of asyncio tasks.')
+    @click.option(
+        '--lines/--no-lines', 'sample_lines',
+        default=config_default('lines', False),
+        help='Count the samples by the executing lines also.')
+    @click.option(
+        '--call-lines/--no-call-lines', 'sample_call_lines',
+        default=config_default('call-lines', False),
+        help='Count the samples by the call-site lines of the callers also.')
+    # filter options
+    @click.option(
+        '--include', multiple=True, metavar='RULE',
+        default=config_default('include', ()),
+        help=('Profile only the matching code.  A rule is a module name glob, '
+              'a path prefix, "stdlib" or "site-packages".'))
+    @click.option(
+        '--exclude', multiple=True, metavar='RULE',
+        default=config_default('exclude', ()),
+        help='Ignore the matching code.  See --include for rules.')
     # etc
+    @click.option(
+        '--compact/--no-compact', 'compact',
+        default=config_default('compact', False),
+        help=('Record into flat arrays which the garbage collector doesn\'t '
+              'track.'))
     @click.option(
         '--pickle-protocol', type=int,
         default=config_default('pickle-protocol', remote.PICKLE_PROTOCOL),
         help='Pickle protocol to dump result.')
     @wraps(f)
-    def wrapped(import_profiler_class, timer_class, sampler_class,
-                sampling_interval, **kwargs):
+    def wrapped(import_profiler_class, timer_class, backend, hot_threshold,
+                trace_c_calls, histograms, exemplar_targets,
+                collapse_recursion, sampler_class, sampling_interval,
+                sampling_overhead, async_stacks, sample_lines,
+                sample_call_lines, include, exclude, compact, **kwargs):
         profiler_class = import_profiler_class()
         assert issubclass(profiler_class, Profiler)
         if issubclass(profiler_class, TracingProfiler):
             # profiler requires timer.
             timer_class = timer_class or tracing.TIMER_CLASS
             timer = timer_class()
-            profiler_kwargs = {'timer': timer}
+            profiler_kwargs = {'timer': timer, 'backend': backend,
+                               'hot_threshold': hot_threshold,
+                               'trace_c_calls': trace_c_calls,
+                               'histograms': histograms,
+                               'exemplar_targets': exemplar_targets,
+                               'collapse_recursion': collapse_recursion}
         elif issubclass(profiler_class, SamplingProfiler):
             sampler_class = sampler_class or sampling.SAMPLER_CLASS
-            sampler = sampler_class(sampling_interval)
-            profiler_kwargs = {'sampler': sampler}
+            sampler = sampler_class(sampling_interval,
+                                    target_overhead=sampling_overhead)
+            if async_stacks and not sampler.samples_in_thread:
+                raise click.UsageError('Option --async-stacks requires a '
+                                       'sampler which samples in the '
+                                       'sampled thread')
+            profiler_kwargs = {'sampler': sampler,
+                               'async_stacks': async_stacks,
+                               'lines': sample_lines,
+                               'call_lines': sample_call_lines}
         else:
             profiler_kwargs = {}
+        if include or exclude:
+            profiler_kwargs['ignored_codes'] = CodeFilter(include, exclude)
+        if compact:
+            profiler_kwargs['compact'] = True
         profiler_factory = partial(profiler_class, **profiler_kwargs)
         return f(profiler_factory=profiler_factory, **kwargs)
     return wrapped
@@ -510,6 +599,10 @@ onetime_profiler_options = Params([
     click.option(
         '-d', '--dump', 'dump_filename', type=click.Path(writable=True),
         help='Profiling result dump filename.'),
+    click.option(
+        '--columnar/--no-columnar', 'columnar',
+        default=config_default('columnar', False),
+        help='Dump the result as array-backed columns for a large profile.'),
 ])
 live_profiler_options = Params([
     click.option(
@@ -527,16 +620,36 @@ live_profiler_options = Params([
         help=(
             'For communication between server and application. (default: %s)' %
             SignalNumber.name_of(BackgroundProfiler.signum)
-        ))
+        )),
+    click.option(
+        '--overhead-budget', type=float, metavar='RATIO',
+        default=config_default('overhead-budget', type=float),
+        help=('Switch tracing profiler to sampling profiler while the '
+              'overhead exceeds it. (e.g. %.2f for %.0f%% of a CPU)' %
+              (governor.BUDGET, governor.BUDGET * 100))),
 ])
 
 
 # sub-commands
 
 
+def govern(profiler, overhead_budget=None):
+    """Wraps a tracing profiler with :class:`profiling.governor.
+    OverheadGovernor` if the overhead budget is given.
+    """
+    if overhead_budget is None or not isinstance(profiler, TracingProfiler):
+        return profiler
+    sampling_profiler = SamplingProfiler(
+        profiler.base_frame, profiler.base_code,
+        profiler.ignored_frames, profiler.ignored_codes,
+        compact=profiler.compact)
+    return governor.OverheadGovernor(profiler, sampling_profiler,
+                                     overhead_budget)
+
+
 def __profile__(filename, code, globals_, profiler_factory,
                 pickle_protocol=remote.PICKLE_PROTOCOL, dump_filename=None,
-                mono=False):
+                columnar=False, mono=False):
     frame = sys._getframe()
     profiler = profiler_factory(base_frame=frame, base_code=code)
     profiler.start()
@@ -556,7 +669,7 @@ def __profile__(filename, code, globals_, profiler_factory,
         except KeyboardInterrupt:
             pass
     else:
-        profiler.dump(dump_filename, pickle_protocol)
+        profiler.dump(dump_filename, pickle_protocol, columnar)
 
         click.echo('To view statistics:')
         click.echo('  $ profiling view ', nl=False)
@@ -580,13 +693,13 @@ class ProfilingCommand(click.Command):
 @onetime_profiler_options
 @viewer_options
 def profile(script, argv, profiler_factory,
-            pickle_protocol, dump_filename, mono):
+            pickle_protocol, dump_filename, columnar, mono):
     """Profile a Python script."""
     filename, code, globals_ = script
     sys.argv[:] = [filename] + list(argv)
     __profile__(filename, code, globals_, profiler_factory,
                 pickle_protocol=pickle_protocol, dump_filename=dump_filename,
-                mono=mono)
+                columnar=columnar, mono=mono)
 
 
 @cli.command('live-profile', aliases=['live'], cls=ProfilingCommand)
@@ -595,7 +708,7 @@ def profile(script, argv, profiler_factory,
 @live_profiler_options
 @viewer_options
 def live_profile(script, argv, profiler_factory, interval, spawn, signum,
-                 pickle_protocol, mono):
+                 overhead_budget, pickle_protocol, mono):
     """Profile a Python script continuously."""
     filename, code, globals_ = script
     sys.argv[:] = [filename] + list(argv)
@@ -644,6 +757,7 @@ def live_profile(script, argv, profiler_factory, interval, spawn, signum,
         os.dup2(stderr_w_fd, sys.stderr.fileno())
         frame = sys._getframe()
         profiler = profiler_factory(base_frame=frame, base_code=code)
+        profiler = govern(profiler, overhead_budget)
         profiler_trigger = BackgroundProfiler(profiler, signum)
         profiler_trigger.prepare()
         server_args = (interval, noop, pickle_protocol)
@@ -667,7 +781,7 @@ def live_profile(script, argv, profiler_factory, interval, spawn, signum,
 @click.option('-v', '--verbose', is_flag=True,
               help='Print profiling server logs.')
 def remote_profile(script, argv, profiler_factory, interval, spawn, signum,
-                   pickle_protocol, endpoint, verbose):
+                   overhead_budget, pickle_protocol, endpoint, verbose):
     """Launch a server to profile continuously.  The default endpoint is
     127.0.0.1:8912.
     """
@@ -688,6 +802,7 @@ def remote_profile(script, argv, profiler_factory, interval, spawn, signum,
     # start profiling server.
     frame = sys._getframe()
     profiler = profiler_factory(base_frame=frame, base_code=code)
+    profiler = govern(profiler, overhead_budget)
     profiler_trigger = BackgroundProfiler(profiler, signum)
     profiler_trigger.prepare()
     server_args = (interval, log, pickle_protocol)
@@ -712,9 +827,14 @@ def view(src, mono):
     if src_type == 'dump':
         time = datetime.fromtimestamp(os.path.getmtime(src_name))
         with open(src_name, 'rb') as f:
-            profiler_class, (stats, cpu_time, wall_time) = pickle.load(f)
+            dump = pickle.load(f)
+        # dumps before the meta was introduced have only 2 items.
+        profiler_class, result = dump[:2]
+        meta = dump[2] if len(dump) > 2 else None
+        stats, cpu_time, wall_time = result
         viewer.set_profiler_class(profiler_class)
-        viewer.set_result(stats, cpu_time, wall_time, title=title, at=time)
+        viewer.set_result(stats, cpu_time, wall_time, title=title, at=time,
+                          meta=meta)
         viewer.activate()
     elif src_type in ('tcp', 'sock'):
         family = {'tcp': socket.AF_INET, 'sock': socket.AF_UNIX}[src_type]
@@ -742,8 +862,8 @@ def view(src, mono):
 @onetime_profiler_options
 @viewer_options
 def timeit_profile(stmt, number, repeat, setup,
-                   profiler_factory, pickle_protocol, dump_filename, mono,
-                   **_ignored):
+                   profiler_factory, pickle_protocol, dump_filename, columnar,
+                   mono, **_ignored):
     """Profile a Python statement like timeit."""
     del _ignored
     globals_ = {}
@@ -765,7 +885,7 @@ def timeit_profile(stmt, number, repeat, setup,
                    'STATEMENT', 'exec')
     __profile__(stmt, code, globals_, profiler_factory,
                 pickle_protocol=pickle_protocol, dump_filename=dump_filename,
-                mono=mono)
+                columnar=columnar, mono=mono)
 
 
 # Deprecated.
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+   profiling.codes
+   ~~~~~~~~~~~~~~~
+
+   Interns the metadata of code objects.  The name, filename, line number and
+   module of a code are resolved just once in the process.  Especially the
+   module is resolved by :func:`inspect.getmodule` which scans
+   :data:`sys.modules` and normalizes file paths.
+
+   Each interned code has a compact integer id.  Its metadata is a tuple of
+   ``(name, filename, lineno, module)`` shared by all the statistics of the
+   code so that Pickle writes it once per dump.  The id also stands in for
+   the code in a compact container such as :mod:`profiling.compact`.
+
+   A code is identified by identity.  The table doesn't keep the codes alive.
+   When a code is collected, its id is released to be reused.  A container of
+   ids should keep its codes alive like :mod:`profiling.compact` does.  Only
+   the codes which cannot be weakly referenced such as pseudo codes are kept.
+   They are identified by names so that they are bounded.
+
+   :copyright: (c) 2014-2017, What! Studio
+   :license: BSD, see LICENSE for more details.
+
+"""
+from __future__ import absolute_import
+
+import inspect
+import threading
+import weakref
+
+
+__all__ = ['code_id', 'code_info', 'info_by_id', 'code_by_id']
+
+
+#: The weak references to codes and the ids by the addresses of the codes.
+#: A code is looked up by identity.  Comparing codes by equality is slow.
+_ids = {}
+
+#: The ids by codes which cannot be weakly referenced.
+_strong_ids = {}
+
+#: The metadata by ids.  ``None`` at a released id.
+_infos = []
+
+#: The weak references to codes or the codes by ids.
+_codes = []
+
+#: The released ids to reuse.
+_free_ids = []
+
+#: The weak references to the collected codes.  The garbage collector may
+#: call back anywhere even in :func:`code_id` so that the ids are released
+#: later under the lock.
+_collected = []
+
+_lock = threading.Lock()
+
+
+def resolve_info(code):
+    """Resolves the metadata of the given code.  A pseudo code such as of a
+    builtin function has ``co_module`` instead of a module to look up.
+    """
+    name = getattr(code, 'co_name', None)
+    if name == '<module>':
+        name = None
+    filename = getattr(code, 'co_filename', None)
+    lineno = getattr(code, 'co_firstlineno', None)
+    try:
+        module_name = code.co_module
+    except AttributeError:
+        try:
+            module = inspect.getmodule(code)
+        except Exception:
+            module = None
+        module_name = module and module.__name__
+    return (name, filename, lineno, module_name)
+
+
+def _lookup(code):
+    """Returns the id of the given code.  ``None`` if the code has not been
+    interned.
+    """
+    entry = _ids.get(id(code))
+    if entry is None:
+        return _strong_ids.get(code)
+    # the address may be of a collected code.
+    ref, id_ = entry
+    return id_ if ref() is code else None
+
+
+def _collect(ref):
+    _collected.append(ref)
+
+
+def _release_collected():
+    while _collected:
+        __, id_ = _ids.pop(_collected.pop().key)
+        _infos[id_] = _codes[id_] = None
+        _free_ids.append(id_)
+
+
+def _new_id(info, code):
+    if _free_ids:
+        id_ = _free_ids.pop()
+        _infos[id_], _codes[id_] = info, code
+    else:
+        id_ = len(_infos)
+        _infos.append(info)
+        _codes.append(code)
+    return id_
+
+
+def code_id(code):
+    """Gets the id of the given code.  The code is interned at first."""
+    id_ = _lookup(code)
+    if id_ is not None:
+        return id_
+    info = resolve_info(code)
+    with _lock:
+        _release_collected()
+        id_ = _lookup(code)
+        if id_ is not None:
+            return id_
+        try:
+            ref = weakref.KeyedRef(code, _collect, id(code))
+        except TypeError:
+            _strong_ids[code] = id_ = _new_id(info, code)
+        else:
+            id_ = _new_id(info, ref)
+            _ids[id(code)] = (ref, id_)
+        return id_
+
+
+def code_info(code):
+    """Gets the ``(name, filename, lineno, module)`` of the given code."""
+    id_ = _lookup(code)
+    if id_ is None:
+        id_ = code_id(code)
+    return _infos[id_]
+
+
+def info_by_id(id_):
+    """Gets the ``(name, filename, lineno, module)`` of the code of the given
+    id.
+    """
+    return _infos[id_]
+
+
+def code_by_id(id_):
+    """Gets the code of the given id."""
+    code = _codes[id_]
+    if isinstance(code, weakref.ref):
+        return code()
+    return code
@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+"""
+   profiling.columnar
+   ~~~~~~~~~~~~~~~~~~
+
+   Array-backed frozen statistics for large profiles.  A statistics tree is
+   stored as parallel columns in breadth-first order instead of an object per
+   node.  The names, filenames and modules are ids in a string table.
+
+   The columns are :class:`array.array` so that they are compact to pickle.
+   The aggregates, flattening and top-K are vectorized by NumPy if it is
+   available.  :class:`StatisticsView` is a thin view of a node which
+   satisfies the :class:`profiling.stats.Statistics` interface::
+
+      stats = columnar.freeze(profiler.stats)
+
+   :copyright: (c) 2014-2017, What! Studio
+   :license: BSD, see LICENSE for more details.
+
+"""
+from __future__ import absolute_import, division
+
+from array import array
+import heapq
+
+from six.moves import range, zip
+
+from profiling import histogram
+from profiling.stats import (
+    FlatFrozenStatistics, frozen_stats_from_tree, make_frozen_stats_tree,
+    merge_exemplars, merge_line_hits, Statistics)
+from profiling.utils import INT64
+
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+__all__ = ['ColumnarStatistics', 'StatisticsView', 'freeze']
+
+
+#: The id of ``None`` in the string table and the line numbers.
+NONE = -1
+
+#: The names of the int and float columns.  The times are float seconds.
+#: The hits may be summed up over a long run so that they are 64-bit.
+INT_COLUMNS = ('parents', 'names', 'filenames', 'linenos', 'modules')
+INT64_COLUMNS = ('own_hits',)
+FLOAT_COLUMNS = ('deep_times', 'deep_wall_times')
+COLUMNS = INT_COLUMNS + INT64_COLUMNS + FLOAT_COLUMNS
+
+
+def as_numpy(column):
+    """Views the given array as a NumPy array without copying."""
+    return numpy.frombuffer(column, dtype=column.typecode)
+
+
+class ColumnarStatistics(object):
+    """A statistics tree stored as parallel columns.  The root is at 0 and
+    each node follows its parent so that the children of a node are
+    contiguous.
+    """
+
+    def __init__(self, strings=(), estimated=(), histograms=None,
+                 exemplars=None, line_hits=None, **columns):
+        #: The string table of the names, filenames and modules.
+        self.strings = list(strings)
+        for attr in INT_COLUMNS:
+            setattr(self, attr, array('l', columns.get(attr, ())))
+        for attr in INT64_COLUMNS:
+            setattr(self, attr, array(INT64, columns.get(attr, ())))
+        for attr in FLOAT_COLUMNS:
+            setattr(self, attr, array('d', columns.get(attr, ())))
+        #: The indices of the estimated statistics.
+        self.estimated = set(estimated)
+        # the rare members by indices.
+        self.histograms = histograms or {}
+        self.exemplars = exemplars or {}
+        self.line_hits = line_hits or {}
+        self._index()
+
+    @classmethod
+    def from_stats(cls, stats):
+        """Makes the columns of the given statistics tree."""
+        string_ids = {None: NONE}
+        columns = dict((attr, []) for attr in COLUMNS)
+        estimated, histograms, exemplars, line_hits = set(), {}, {}, {}
+        stats_tree, parents = [stats], [NONE]
+        for x, _stats in enumerate(stats_tree):
+            stats_tree.extend(_stats)
+            parents.extend(x for __ in range(len(_stats)))
+            name, filename, lineno, module = _stats.code_info
+            for attr, string in [('names', name), ('filenames', filename),
+                                 ('modules', module)]:
+                try:
+                    string_id = string_ids[string]
+                except KeyError:
+                    string_id = string_ids[string] = len(string_ids) - 1
+                columns[attr].append(string_id)
+            columns['linenos'].append(NONE if lineno is None else lineno)
+            columns['own_hits'].append(_stats.own_hits)
+            columns['deep_times'].append(_stats.deep_time)
+            columns['deep_wall_times'].append(_stats.deep_wall_time)
+            if _stats.estimated:
+                estimated.add(x)
+            if _stats.histogram is not None:
+                histograms[x] = _stats.histogram
+            if _stats.exemplars is not None:
+                exemplars[x] = [
+                    frozen_stats_from_tree(make_frozen_stats_tree(s))
+                    for s in _stats.exemplars]
+            if _stats.line_hits is not None:
+                line_hits[x] = dict(_stats.line_hits)
+        columns['parents'] = parents
+        strings = sorted(string_ids, key=string_ids.get)[1:]
+        return cls(strings, estimated, histograms, exemplars, line_hits,
+                   **columns)
+
+    def __len__(self):
+        return len(self.parents)
+
+    def __getstate__(self):
+        state = dict((attr, getattr(self, attr))
+                     for attr in COLUMNS)
+        state.update(strings=self.strings, estimated=self.estimated,
+                     histograms=self.histograms, exemplars=self.exemplars,
+                     line_hits=self.line_hits)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._index()
+
+    def string(self, string_id):
+        return None if string_id == NONE else self.strings[string_id]
+
+    def _index(self):
+        """Computes the children ranges and the subtree aggregates."""
+        if numpy is None:
+            self._index_py()
+        else:
+            self._index_numpy()
+
+    def _index_py(self):
+        size = len(self)
+        child_counts = [0] * size
+        deep_hits = list(self.own_hits)
+        sub_times = [0.0] * size
+        parents, deep_times = self.parents, self.deep_times
+        # the children follow their parent.
+        for x in range(size - 1, 0, -1):
+            parent = parents[x]
+            child_counts[parent] += 1
+            deep_hits[parent] += deep_hits[x]
+            sub_times[parent] += deep_times[x]
+        first_children, first_child = [], 1
+        for count in child_counts:
+            first_children.append(first_child)
+            first_child += count
+        self.child_counts = child_counts
+        self.first_children = first_children
+        self.deep_hits = deep_hits
+        self.own_times = [max(0., t - s) for t, s in zip(deep_times,
+                                                         sub_times)]
+
+    def _index_numpy(self):
+        size = len(self)
+        parents = as_numpy(self.parents)
+        deep_times = as_numpy(self.deep_times)
+        child_counts = numpy.bincount(parents[1:], minlength=size)
+        first_children = numpy.cumsum(child_counts) - child_counts + 1
+        sub_times = numpy.bincount(parents[1:], weights=deep_times[1:],
+                                   minlength=size)
+        # sum up the hits level by level from the deepest.  a level is
+        # contiguous in breadth-first order.
+        levels, start, stop = [], 0, 1
+        while start < stop:
+            levels.append((start, stop))
+            start = stop
+            stop = start + int(child_counts[levels[-1][0]:stop].sum())
+        deep_hits = as_numpy(self.own_hits).astype(numpy.int64)
+        for start, stop in reversed(levels[1:]):
+            numpy.add.at(deep_hits, parents[start:stop],
+                         deep_hits[start:stop])
+        self.child_counts = child_counts
+        self.first_children = first_children
+        self.deep_hits = deep_hits
+        self.own_times = numpy.maximum(0., deep_times - sub_times)
+
+    def children(self, index):
+        """The indices of the children of the given node."""
+        first_child = int(self.first_children[index])
+        return range(first_child, first_child + int(self.child_counts[index]))
+
+    def code_info(self, index):
+        return (self.string(self.names[index]),
+                self.string(self.filenames[index]),
+                None if self.linenos[index] == NONE else self.linenos[index],
+                self.string(self.modules[index]))
+
+    def view(self, index=0):
+        return StatisticsView(self, index)
+
+    def top(self, k, column='own_hits'):
+        """Gets the views of the `k` nodes which have the largest values of
+        the given column such as ``'own_hits'``, ``'deep_hits'``,
+        ``'own_times'`` or ``'deep_times'``.  The largest comes first.
+        """
+        values = getattr(self, column)
+        if k <= 0:
+            return []
+        elif numpy is None:
+            indices = heapq.nlargest(k, range(len(values)),
+                                     key=values.__getitem__)
+        else:
+            if isinstance(values, array):
+                values = as_numpy(values)
+            k = min(k, len(values))
+            indices = numpy.argpartition(-values, k - 1)[:k]
+            indices = indices[numpy.argsort(-values[indices], kind='stable')]
+        return [self.view(int(x)) for x in indices]
+
+    def outermost(self, groups):
+        """Whether each node is the outermost one of its function on the path
+        from the root.  `groups` are the functions of the nodes except the
+        root.
+        """
+        if numpy is None:
+            return self._outermost_py(groups)
+        return self._outermost_numpy(groups)
+
+    def _outermost_py(self, groups):
+        outermost = [True] * len(self)
+        # the numbers of the nodes on the current path by groups.
+        active = {}
+        descendants = [(x, True) for x in reversed(self.children(0))]
+        while descendants:
+            x, entering = descendants.pop()
+            group = groups[x - 1]
+            if not entering:
+                active[group] -= 1
+                continue
+            outermost[x] = not active.get(group)
+            active[group] = active.get(group, 0) + 1
+            descendants.append((x, False))
+            descendants.extend((c, True) for c in reversed(self.children(x)))
+        return outermost
+
+    def _outermost_numpy(self, groups):
+        parents = as_numpy(self.parents)
+        groups = numpy.concatenate([[NONE], groups])
+        outermost = numpy.ones(len(self), dtype=bool)
+        # walk up the ancestors of all the nodes at once.
+        nodes = numpy.arange(1, len(self))
+        ancestors = parents[1:]
+        while len(nodes):
+            recursive = groups[ancestors] == groups[nodes]
+            outermost[nodes[recursive]] = False
+            walking = ~recursive & (ancestors > 0)
+            nodes = nodes[walking]
+            ancestors = parents[ancestors[walking]]
+        return outermost
+
+    def flat(self):
+        """Makes a :class:`profiling.stats.FlatFrozenStatistics` of the whole
+        tree.  The inclusive hits and time of a recursive function count only
+        the outermost node on each path like
+        :meth:`FlatFrozenStatistics.flatten`.
+        """
+        flat_children = []
+        if len(self) > 1:
+            flat_children = self._flat_children()
+        root = self.view()
+        return FlatFrozenStatistics(
+            root.name, root.filename, root.lineno, root.module,
+            root.own_hits, root.deep_hits, root.own_time, root.deep_time,
+            root.deep_wall_time, root.estimated, root.histogram,
+            root.exemplars, root.line_hits, flat_children)
+
+    def _flat_children(self):
+        if numpy is None:
+            groups, keys = self._group_py()
+        else:
+            groups, keys = self._group_numpy()
+        outermost = self.outermost(groups)
+        flat_children = [FlatFrozenStatistics(*self._key_info(key))
+                         for key in keys]
+        sums = self._group_sums(groups, len(keys), outermost)
+        for flat_stats, values in zip(flat_children, sums):
+            (flat_stats.own_hits, flat_stats.own_time, flat_stats.deep_hits,
+             flat_stats.deep_time, flat_stats.deep_wall_time) = values
+        # the rare members of the nodes except the root.
+        for x in self.estimated:
+            if x:
+                flat_children[groups[x - 1]].estimated = True
+        for x, _histogram in sorted(self.histograms.items()):
+            if not x:
+                continue
+            flat_stats = flat_children[groups[x - 1]]
+            if flat_stats.histogram is None:
+                flat_stats.histogram = histogram.make_histogram()
+            histogram.merge(flat_stats.histogram, _histogram)
+        for x, exemplars in sorted(self.exemplars.items()):
+            if not x:
+                continue
+            flat_stats = flat_children[groups[x - 1]]
+            flat_stats.exemplars = merge_exemplars(
+                flat_stats.exemplars or (), exemplars)
+        for x, line_hits in sorted(self.line_hits.items()):
+            if not x:
+                continue
+            flat_stats = flat_children[groups[x - 1]]
+            if flat_stats.line_hits is None:
+                flat_stats.line_hits = {}
+            merge_line_hits(flat_stats.line_hits, line_hits)
+        return flat_children
+
+    def _key_info(self, key):
+        name, filename, lineno, module = key
+        return (self.string(name), self.string(filename),
+                None if lineno == NONE else lineno, self.string(module))
+
+    def _group_py(self):
+        """Groups the nodes except the root by functions.  Returns the group
+        of each node and the keys of the groups.
+        """
+        group_ids, groups = {}, []
+        for key in zip(self.names[1:], self.filenames[1:], self.linenos[1:],
+                       self.modules[1:]):
+            try:
+                group = group_ids[key]
+            except KeyError:
+                group = group_ids[key] = len(group_ids)
+            groups.append(group)
+        return groups, sorted(group_ids, key=group_ids.get)
+
+    def _group_numpy(self):
+        keys = numpy.stack([as_numpy(getattr(self, attr))[1:] for attr in
+                            ['names', 'filenames', 'linenos', 'modules']],
+                           axis=1)
+        keys, groups = numpy.unique(keys, axis=0, return_inverse=True)
+        keys = [tuple(int(v) for v in key) for key in keys]
+        return groups.reshape(-1), keys
+
+    def _group_sums(self, groups, size, outermost):
+        """Sums the own hits, own time, and the deep hits and times of the
+        outermost nodes by groups.
+        """
+        columns = [self.own_hits, self.own_times, self.deep_hits,
+                   self.deep_times, self.deep_wall_times]
+        if numpy is None:
+            sums = [[0, 0.0, 0, 0.0, 0.0] for x in range(size)]
+            for x in range(1, len(self)):
+                values = sums[groups[x - 1]]
+                for y, column in enumerate(columns):
+                    if y < 2 or outermost[x]:
+                        values[y] += column[x]
+            return sums
+        weights = numpy.asarray(outermost[1:], dtype=float)
+        sums = []
+        for y, column in enumerate(columns):
+            if isinstance(column, array):
+                column = as_numpy(column)
+            column = column[1:]
+            if y >= 2:
+                column = column * weights
+            sums.append(numpy.bincount(groups, weights=column,
+                                       minlength=size))
+        return [(int(round(own_hits)), float(own_time),
+                 int(round(deep_hits)), float(deep_time),
+                 float(deep_wall_time))
+                for own_hits, own_time, deep_hits, deep_time, deep_wall_time
+                in zip(*sums)]
+
+
+class StatisticsView(Statistics):
+    """A view of a node of :class:`ColumnarStatistics`."""
+
+    __slots__ = ('columns', 'index')
+
+    def __init__(self, columns, index=0):
+        self.columns = columns
+        self.index = index
+
+    @property
+    def code_info(self):
+        return self.columns.code_info(self.index)
+
+    name = property(lambda x: x.columns.string(x.columns.names[x.index]))
+    filename = property(
+        lambda x: x.columns.string(x.columns.filenames[x.index]))
+    module = property(lambda x: x.columns.string(x.columns.modules[x.index]))
+
+    @property
+    def lineno(self):
+        lineno = self.columns.linenos[self.index]
+        return None if lineno == NONE else lineno
+
+    own_hits = property(lambda x: int(x.columns.own_hits[x.index]))
+    deep_hits = property(lambda x: int(x.columns.deep_hits[x.index]))
+    own_time = property(lambda x: float(x.columns.own_times[x.index]))
+    deep_time = property(lambda x: float(x.columns.deep_times[x.index]))
+    deep_wall_time = property(
+        lambda x: float(x.columns.deep_wall_times[x.index]))
+    estimated = property(lambda x: x.index in x.columns.estimated)
+    histogram = property(lambda x: x.columns.histograms.get(x.index))
+    exemplars = property(lambda x: x.columns.exemplars.get(x.index))
+    line_hits = property(lambda x: x.columns.line_hits.get(x.index))
+
+    def flat(self):
+        if self.index == 0:
+            return self.columns.flat()
+        return super(StatisticsView, self).flat()
+
+    def __iter__(self):
+        columns = self.columns
+        for x in columns.children(self.index):
+            yield StatisticsView(columns, x)
+
+    def __len__(self):
+        return int(self.columns.child_counts[self.index])
+
+    def __eq__(self, other):
+        return (isinstance(other, StatisticsView) and
+                self.columns is other.columns and self.index == other.index)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = Statistics.__hash__
+
+    def __reduce__(self):
+        return (StatisticsView, (self.columns, self.index))
+
+
+def freeze(stats):
+    """Freezes the given statistics tree into a :class:`StatisticsView` of
+    the root of its columns.
+    """
+    return ColumnarStatistics.from_stats(stats).view()
@@ -0,0 +1,462 @@
+# -*- coding: utf-8 -*-
+"""
+   profiling.compact
+   ~~~~~~~~~~~~~~~~~
+
+   Compact recording statistics for long-running profiling.  An ordinary
+   recording statistics tree has an object and a dict per node.  They are all
+   tracked by the cyclic garbage collector so that a large tree lengthens the
+   collections of the profiled program.
+
+   :class:`RecordingTree` keeps the nodes in flat arrays instead.  The nodes
+   are looked up in a single table keyed by the parent index and the code id
+   from :mod:`profiling.codes`.  The table has only integers so that the
+   cyclic GC doesn't track it.  The GC tracks only a few objects of a tree
+   however many nodes it has::
+
+      stats = CompactRecordingStatistics()
+      stats.ensure_child(code).own_hits += 1
+
+   :class:`CompactRecordingStatistics` is a transient handle of a node which
+   satisfies the :class:`profiling.stats.RecordingStatistics` interface.  A
+   node removed from the tree is not reclaimed until the tree is cleared.
+   The tree keeps its codes alive so that their ids are not reused.
+
+   Each access to a node such as by ``ensure_child()`` or iteration makes a
+   new handle.  The handles are not cached because a cache would be an object
+   per node for the GC to track again.  A handle costs an allocation so hold
+   it to access a node repeatedly as the stack cache of
+   :class:`profiling.sampling.SamplingProfiler` does.
+
+   :copyright: (c) 2014-2017, What! Studio
+   :license: BSD, see LICENSE for more details.
+
+"""
+from __future__ import absolute_import, division
+
+from array import array
+
+from six.moves import range
+
+from profiling import codes, histogram
+from profiling.stats import (
+    Exemplars, merge_line_hits, NO_CODE_INFO, RecordingStatistics,
+    Statistics, VoidRecordingStatistics)
+from profiling.utils import INT64, noop
+
+
+__all__ = ['RecordingTree', 'CompactRecordingStatistics',
+           'CompactVoidRecordingStatistics']
+
+
+#: The index or the code id of nothing.
+NONE = -1
+
+#: The flags of a node.
+VOID, ESTIMATED, DIRTY = 1, 2, 4
+
+#: The number of the low bits of a key for the code id.
+CODE_ID_BITS = 32
+
+#: The names of the int and float columns.  The last ones of each are the
+#: aggregates of the subtrees.  The nanoseconds overflow 32 bits in a few
+#: seconds and the hits may in a long run so that they are 64-bit.
+INT_COLUMNS = ('code_ids', 'first_children', 'next_siblings', 'child_counts')
+INT64_COLUMNS = ('own_hits', 'deep_times_ns', 'deep_wall_times_ns',
+                 'deep_hits')
+FLOAT_COLUMNS = ('own_times', 'deep_times', 'deep_wall_times')
+
+
+def make_key(parent, code_id):
+    return parent << CODE_ID_BITS | code_id
+
+
+class RecordingTree(object):
+    """A recording statistics tree stored as parallel columns.  The root is
+    at 0.  The children of a node are linked from :attr:`first_children`
+    through :attr:`next_siblings`.
+    """
+
+    def __init__(self, code=None, void=False):
+        self.reset(code, void)
+
+    def reset(self, code=None, void=False):
+        """Forgets all the nodes but a new root."""
+        #: The node indices by the keys of the parent indices and the code
+        #: ids.  See :func:`make_key`.
+        self.nodes = {}
+        #: The codes by ids.  It keeps the codes alive.
+        self.codes = {}
+        for attr in INT_COLUMNS:
+            setattr(self, attr, array('l'))
+        for attr in INT64_COLUMNS:
+            setattr(self, attr, array(INT64))
+        for attr in FLOAT_COLUMNS:
+            setattr(self, attr, array('d'))
+        self.flags = bytearray()
+        # the rare members by indices.
+        self.histograms = {}
+        self.exemplars = {}
+        self.line_hits = {}
+        self.add(NONE, code, void)
+
+    def __len__(self):
+        return len(self.flags)
+
+    def add(self, parent, code, void=False):
+        """Adds a node of the given code under the parent.  Returns the index
+        of the node.
+        """
+        index = len(self.flags)
+        if code is None:
+            code_id = NONE
+        else:
+            code_id = codes.code_id(code)
+            self.codes[code_id] = code
+        self.code_ids.append(code_id)
+        for column in [self.first_children, self.next_siblings]:
+            column.append(NONE)
+        for column in [self.child_counts, self.own_hits, self.deep_times_ns,
+                       self.deep_wall_times_ns, self.deep_hits]:
+            column.append(0)
+        for column in [self.own_times, self.deep_times,
+                       self.deep_wall_times]:
+            column.append(0.0)
+        # a new node has nothing to aggregate yet.
+        self.flags.append(DIRTY | VOID if void else DIRTY)
+        if parent != NONE:
+            self.next_siblings[index] = self.first_children[parent]
+            self.first_children[parent] = index
+            self.child_counts[parent] += 1
+            self.nodes[make_key(parent, code_id)] = index
+        return index
+
+    def child(self, parent, code):
+        """Finds the index of the child of the given code.  ``None`` if there
+        is no such child.
+        """
+        return self.nodes.get(make_key(parent, codes.code_id(code)))
+
+    def children(self, index):
+        x = self.first_children[index]
+        while x != NONE:
+            yield x
+            x = self.next_siblings[x]
+
+    def unlink(self, parent, code):
+        """Detaches the child of the given code from the parent.  Returns the
+        index of the child or ``None`` if there is no such child.
+        """
+        index = self.nodes.pop(make_key(parent, codes.code_id(code)), None)
+        if index is None:
+            return None
+        x = self.first_children[parent]
+        if x == index:
+            self.first_children[parent] = self.next_siblings[index]
+        else:
+            while self.next_siblings[x] != index:
+                x = self.next_siblings[x]
+            self.next_siblings[x] = self.next_siblings[index]
+        self.next_siblings[index] = NONE
+        self.child_counts[parent] -= 1
+        return index
+
+    def unlink_all(self, parent):
+        """Detaches all the children from the parent."""
+        for x in list(self.children(parent)):
+            del self.nodes[make_key(parent, self.code_ids[x])]
+            self.next_siblings[x] = NONE
+        self.first_children[parent] = NONE
+        self.child_counts[parent] = 0
+
+    def code(self, index):
+        code_id = self.code_ids[index]
+        return None if code_id == NONE else self.codes[code_id]
+
+    def code_info(self, index):
+        code_id = self.code_ids[index]
+        return NO_CODE_INFO if code_id == NONE else codes.info_by_id(code_id)
+
+    def stats(self, index):
+        """Makes a handle of the node.  A new handle is made for each call."""
+        if self.flags[index] & VOID:
+            stat_class = CompactVoidRecordingStatistics
+        else:
+            stat_class = CompactRecordingStatistics
+        # bypass the metaclass which fills the defaults.
+        stats = stat_class.__new__(stat_class)
+        stats.tree = self
+        stats.index = index
+        return stats
+
+    def aggregate(self, index):
+        """Computes the aggregates of the dirty nodes in the subtree in one
+        post-order pass.  The clean subtrees are not walked.
+        """
+        flags = self.flags
+        dirty, descendants = [], [index]
+        while descendants:
+            x = descendants.pop()
+            dirty.append(x)
+            descendants.extend(c for c in self.children(x)
+                               if flags[c] & DIRTY)
+        deep_hits, deep_times = self.deep_hits, self.deep_times
+        deep_wall_times = self.deep_wall_times
+        for x in reversed(dirty):
+            hits, sub_time, sub_wall_time = self.own_hits[x], 0.0, 0.0
+            for c in self.children(x):
+                hits += deep_hits[c]
+                sub_time += deep_times[c]
+                sub_wall_time += deep_wall_times[c]
+            if flags[x] & VOID:
+                # an absent frame takes the times of its children.
+                deep_time, deep_wall_time = sub_time, sub_wall_time
+            else:
+                deep_time = self.deep_times_ns[x] / 1e9
+                deep_wall_time = self.deep_wall_times_ns[x] / 1e9
+            deep_hits[x] = hits
+            self.own_times[x] = max(0., deep_time - sub_time)
+            deep_times[x] = deep_time
+            deep_wall_times[x] = deep_wall_time
+            flags[x] &= ~DIRTY
+
+    def invalidate(self, index):
+        """Marks the node and all the descendants dirty."""
+        flags = self.flags
+        if index == 0:
+            for x in range(len(flags)):
+                flags[x] |= DIRTY
+            return
+        descendants = [index]
+        while descendants:
+            x = descendants.pop()
+            flags[x] |= DIRTY
+            descendants.extend(self.children(x))
+
+
+def column_property(attr):
+    """Makes a property of the given column of the tree at the index."""
+    def fget(stats):
+        return getattr(stats.tree, attr)[stats.index]
+    def fset(stats, value):
+        getattr(stats.tree, attr)[stats.index] = value
+    return property(fget, fset)
+
+
+def rare_property(attr):
+    """Makes a property of the given rare member of the tree at the index.
+    ``None`` is not stored.
+    """
+    def fget(stats):
+        return getattr(stats.tree, attr).get(stats.index)
+    def fset(stats, value):
+        if value is None:
+            getattr(stats.tree, attr).pop(stats.index, None)
+        else:
+            getattr(stats.tree, attr)[stats.index] = value
+    return property(fget, fset)
+
+
+class CompactStatistics(object):
+    """The implementation of a handle of a node of :class:`RecordingTree`.
+    It declares no slots so that it can precede both of
+    :class:`RecordingStatistics` and :class:`VoidRecordingStatistics`.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, code=None):
+        # a new handle is the root of a new tree.
+        void = isinstance(self, VoidRecordingStatistics)
+        self.tree = RecordingTree(code, void)
+        self.index = 0
+
+    code = property(lambda x: x.tree.code(x.index))
+
+    @property
+    def code_info(self):
+        return self.tree.code_info(self.index)
+
+    own_hits = column_property('own_hits')
+    deep_time_ns = column_property('deep_times_ns')
+    deep_wall_time_ns = column_property('deep_wall_times_ns')
+    histogram = rare_property('histograms')
+    exemplars = rare_property('exemplars')
+    line_hits = rare_property('line_hits')
+
+    @property
+    def estimated(self):
+        return bool(self.tree.flags[self.index] & ESTIMATED)
+
+    @estimated.setter
+    def estimated(self, estimated):
+        if estimated:
+            self.tree.flags[self.index] |= ESTIMATED
+        else:
+            self.tree.flags[self.index] &= ~ESTIMATED
+
+    @property
+    def _aggregates(self):
+        tree, x = self.tree, self.index
+        if tree.flags[x] & DIRTY:
+            return None
+        return (tree.deep_hits[x], tree.own_times[x], tree.deep_times[x],
+                tree.deep_wall_times[x])
+
+    @_aggregates.setter
+    def _aggregates(self, aggregates):
+        # only to mark dirty.
+        assert aggregates is None
+        self.tree.flags[self.index] |= DIRTY
+
+    def _aggregate(self):
+        self.tree.aggregate(self.index)
+
+    def invalidate(self):
+        self.tree.invalidate(self.index)
+
+    @property
+    def children(self):
+        return list(self)
+
+    def get_child(self, code):
+        index = self.tree.child(self.index, code)
+        if index is None:
+            raise KeyError(code)
+        return self.tree.stats(index)
+
+    def add_child(self, code, stats):
+        """Records the given statistics as the child of the given code.  The
+        statistics is copied into the tree.
+        """
+        self.discard_child(code)
+        void = isinstance(stats, VoidRecordingStatistics)
+        index = self.tree.add(self.index, code, void)
+        self.tree.stats(index).merge(stats)
+
+    def remove_child(self, code):
+        if self.tree.unlink(self.index, code) is None:
+            raise KeyError(code)
+        self._aggregates = None
+
+    def discard_child(self, code):
+        self.tree.unlink(self.index, code)
+        self._aggregates = None
+
+    def ensure_child(self, code, adding_stat_class=None):
+        tree = self.tree
+        index = tree.child(self.index, code)
+        if index is None:
+            if adding_stat_class is None:
+                void = bool(tree.flags[self.index] & VOID)
+            else:
+                void = issubclass(adding_stat_class, VoidRecordingStatistics)
+            index = tree.add(self.index, code, void)
+        return tree.stats(index)
+
+    def fill_child(self, code):
+        tree = self.tree
+        index = tree.child(self.index, code)
+        if index is None:
+            raise KeyError(code)
+        if tree.flags[index] & VOID:
+            void_stats = tree.stats(index)
+            deep_time = void_stats.deep_time
+            deep_wall_time = void_stats.deep_wall_time
+            tree.flags[index] &= ~VOID
+            tree.flags[index] |= DIRTY
+            self._aggregates = None
+            stats = tree.stats(index)
+            stats.deep_time = deep_time
+            stats.deep_wall_time = deep_wall_time
+        return tree.stats(index)
+
+    def merge(self, stats):
+        """Merges the given recording statistics tree into this tree.  The
+        given tree may be an ordinary one and is not modified.
+        """
+        tree = self.tree
+        flags = tree.flags
+        pairs = [(self.index, stats)]
+        while pairs:
+            x, _stats = pairs.pop()
+            flags[x] |= DIRTY
+            if not (flags[x] & VOID or
+                    isinstance(_stats, VoidRecordingStatistics)):
+                _self = tree.stats(x)
+                _self.own_hits += _stats.own_hits
+                _self.deep_time_ns += _stats.deep_time_ns
+                _self.deep_wall_time_ns += _stats.deep_wall_time_ns
+                _self.estimated = _self.estimated or _stats.estimated
+                if _stats.histogram is not None:
+                    if _self.histogram is None:
+                        _self.histogram = histogram.make_histogram()
+                    histogram.merge(_self.histogram, _stats.histogram)
+                if _stats.exemplars is not None:
+                    if _self.exemplars is None:
+                        _self.exemplars = Exemplars(_stats.exemplars.capacity)
+                    _self.exemplars.merge(_stats.exemplars)
+                if _stats.line_hits is not None:
+                    if _self.line_hits is None:
+                        _self.line_hits = {}
+                    merge_line_hits(_self.line_hits, _stats.line_hits)
+            for child_stats in list(_stats):
+                code = child_stats.code
+                void = isinstance(child_stats, VoidRecordingStatistics)
+                y = tree.child(x, code)
+                if y is None:
+                    y = tree.add(x, code, void)
+                elif not void:
+                    # the absent frame has been recorded in the other tree.
+                    flags[y] &= ~VOID
+                pairs.append((y, child_stats))
+
+    def clear(self):
+        tree, x = self.tree, self.index
+        if x == 0:
+            tree.reset(self.code, bool(tree.flags[0] & VOID))
+            return
+        tree.unlink_all(x)
+        self.own_hits = self.deep_time_ns = self.deep_wall_time_ns = 0
+        self.estimated = False
+        self.histogram = self.exemplars = self.line_hits = None
+        self._aggregates = None
+
+    def __iter__(self):
+        tree = self.tree
+        for x in tree.children(self.index):
+            yield tree.stats(x)
+
+    def __len__(self):
+        return self.tree.child_counts[self.index]
+
+    def __contains__(self, code):
+        return self.tree.child(self.index, code) is not None
+
+    def __eq__(self, other):
+        return (isinstance(other, CompactStatistics) and
+                self.tree is other.tree and self.index == other.index)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = Statistics.__hash__
+
+
+class CompactRecordingStatistics(CompactStatistics, RecordingStatistics):
+    """A handle of a node of :class:`RecordingTree`."""
+
+    __slots__ = ('tree', 'index')
+
+
+class CompactVoidRecordingStatistics(CompactStatistics,
+                                     VoidRecordingStatistics):
+    """A handle of an absent frame of :class:`RecordingTree`."""
+
+    __slots__ = ('tree', 'index')
+
+    own_hits = property(lambda x: 0, noop)
+    estimated = property(lambda x: False, noop)
+    histogram = property(lambda x: None, noop)
+    exemplars = property(lambda x: None, noop)
+    line_hits = property(lambda x: None, noop)
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+   profiling.filters
+   ~~~~~~~~~~~~~~~~~
+
+   Include/exclude rules for code objects.
+
+   :copyright: (c) 2014-2017, What! Studio
+   :license: BSD, see LICENSE for more details.
+
+"""
+from __future__ import absolute_import
+
+from fnmatch import fnmatchcase
+import inspect
+import os
+import sysconfig
+import weakref
+
+from profiling import codes
+
+
+__all__ = ['CodeFilter', 'STDLIB', 'SITE_PACKAGES']
+
+
+#: The rule which matches the standard library.
+STDLIB = 'stdlib'
+
+#: The rule which matches third-party packages.
+SITE_PACKAGES = 'site-packages'
+
+
+def normalize_path(path):
+    return os.path.normcase(os.path.realpath(os.path.expanduser(path)))
+
+
+def is_path_rule(rule):
+    return (os.sep in rule or '/' in rule or
+            rule.startswith('.') or rule.startswith('~'))
+
+
+def stdlib_paths():
+    paths = sysconfig.get_paths()
+    return tuple(set(os.path.join(normalize_path(paths[key]), '')
+                     for key in ['stdlib', 'platstdlib']))
+
+
+def code_module_name(code):
+    """Guesses the name of the module where the given code is defined."""
+    module_name = codes.code_info(code)[3]
+    if module_name is not None:
+        return module_name
+    return inspect.getmodulename(code.co_filename) or ''
+
+
+class CodeFilter(object):
+    """Classifies code objects by include/exclude rules.  A rule is one of:
+
+    - ``'stdlib'``: the standard library.
+    - ``'site-packages'``: third-party packages.
+    - A file path prefix such as ``'./myapp'``.
+    - A module name glob such as ``'myapp.*'``.  It also matches the
+      submodules.
+
+    If there are include rules, only the matching codes are profiled.  Then
+    the codes matching exclude rules are ignored.
+
+    :meth:`is_ignored` evaluates the rules when a code is looked up at first
+    and caches the verdict.  The cache doesn't keep the codes alive.  A code
+    filter works as the container of the ignored codes so that it can be used
+    as `ignored_codes` of :class:`profiling.profiler.Profiler`::
+
+       code_filter = CodeFilter(exclude=['stdlib', 'site-packages'])
+       profiler = TracingProfiler(ignored_codes=code_filter)
+
+    """
+
+    def __init__(self, include=(), exclude=(), ignored_codes=()):
+        self.include = list(include)
+        self.exclude = list(exclude)
+        self._stdlib_paths = stdlib_paths()
+        # the verdicts by codes.  a pseudo code which cannot be weakly
+        # referenced is cached in `_strong_verdicts`.
+        self._verdicts = weakref.WeakKeyDictionary()
+        self._strong_verdicts = {}
+        for code in ignored_codes:
+            self._cache(code, True)
+
+    def is_ignored(self, code):
+        """Whether the given code should be ignored."""
+        try:
+            return self._verdicts[code]
+        except KeyError:
+            pass
+        except TypeError:
+            try:
+                return self._strong_verdicts[code]
+            except KeyError:
+                pass
+        verdict = self.classify(code)
+        self._cache(code, verdict)
+        return verdict
+
+    __contains__ = is_ignored
+
+    def _cache(self, code, verdict):
+        try:
+            self._verdicts[code] = verdict
+        except TypeError:
+            self._strong_verdicts[code] = verdict
+
+    def classify(self, code):
+        """Evaluates the rules for the given code.  Returns ``True`` if the
+        code should be ignored.
+        """
+        if not self.include and not self.exclude:
+            return False
+        context = {}
+        if self.include and not self.match(self.include, code, context):
+            return True
+        return self.match(self.exclude, code, context)
+
+    def match(self, rules, code, context):
+        """Whether the given code matches any of the rules.  `context` caches
+        the properties of the code among rules.
+        """
+        for rule in rules:
+            if rule == STDLIB or rule == SITE_PACKAGES:
+                kind = self._library_kind(code, context)
+                if kind == rule:
+                    return True
+            elif is_path_rule(rule):
+                filename = self._filename(code, context)
+                if filename.startswith(normalize_path(rule)):
+                    return True
+            else:
+                module_name = self._module_name(code, context)
+                while module_name:
+                    if fnmatchcase(module_name, rule):
+                        return True
+                    module_name = module_name.rpartition('.')[0]
+        return False
+
+    def _filename(self, code, context):
+        try:
+            return context['filename']
+        except KeyError:
+            pass
+        filename = code.co_filename
+        if not filename.startswith('<'):
+            filename = normalize_path(filename)
+        context['filename'] = filename
+        return filename
+
+    def _module_name(self, code, context):
+        try:
+            return context['module_name']
+        except KeyError:
+            pass
+        module_name = context['module_name'] = code_module_name(code)
+        return module_name
+
+    def _library_kind(self, code, context):
+        filename = self._filename(code, context)
+        if filename.startswith('<frozen'):
+            # frozen modules such as importlib._bootstrap.
+            return STDLIB
+        parts = filename.split(os.sep)
+        if 'site-packages' in parts or 'dist-packages' in parts:
+            return SITE_PACKAGES
+        if filename.startswith(self._stdlib_paths):
+            return STDLIB
+        return None
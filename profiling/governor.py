@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+   profiling.governor
+   ~~~~~~~~~~~~~~~~~~
+
+   Keeps the profiling overhead within a CPU budget by switching between a
+   tracing profiler and a sampling profiler.
+
+   :copyright: (c) 2014-2017, What! Studio
+   :license: BSD, see LICENSE for more details.
+
+"""
+from __future__ import absolute_import, division
+
+from profiling.profiler import ProfilerWrapper
+
+
+__all__ = ['OverheadGovernor', 'BUDGET']
+
+
+#: The default overhead budget.  3% of a CPU.
+BUDGET = 0.03
+
+
+class OverheadGovernor(ProfilerWrapper):
+    """Wraps a tracing profiler and a sampling profiler.  It is supposed to be
+    started and stopped repeatedly like by :class:`profiling.remote.
+    ProfilingServer`.  :attr:`profiler` is the active one.
+
+    After a tracing interval, the overhead of the tracing profiler is compared
+    with the budget.  If it exceeds the budget, the sampling profiler runs for
+    the next interval.  After a sampling interval, the overhead which the
+    tracing profiler would cost is estimated by the CPU load of the interval
+    assuming the overhead per CPU time is as same as the last tracing
+    interval.  If the estimation is enough under the budget, it switches back
+    to the tracing profiler.
+    """
+
+    #: The ratio of the budget under which the estimated overhead should be to
+    #: switch back to tracing.  It prevents flapping.
+    hysteresis = 0.8
+
+    def __init__(self, tracing_profiler, sampling_profiler, budget=BUDGET):
+        super(OverheadGovernor, self).__init__(tracing_profiler)
+        self.tracing_profiler = tracing_profiler
+        self.sampling_profiler = sampling_profiler
+        self.budget = budget
+        #: The profiler to run at the next interval.
+        self.next_profiler = tracing_profiler
+        #: The overhead per CPU time measured at the last tracing interval.
+        self.overhead_per_cpu_time = 0.0
+        #: The overhead ratio to a CPU of the last tracing interval or the
+        #: estimated one of the last sampling interval.
+        self.overhead_ratio = 0.0
+
+    @property
+    def mode(self):
+        """``'tracing'`` or ``'sampling'``."""
+        if self.profiler is self.tracing_profiler:
+            return 'tracing'
+        return 'sampling'
+
+    def govern(self):
+        """Chooses the profiler for the next interval by the result of the
+        last interval.
+        """
+        __, cpu_time, wall_time = self.profiler.result()
+        if not wall_time:
+            return
+        if self.profiler is self.tracing_profiler:
+            overhead = self.tracing_profiler.overhead
+            # cpu_time of the tracing profiler excludes the overhead.
+            if cpu_time + overhead:
+                self.overhead_per_cpu_time = overhead / (cpu_time + overhead)
+            # otherwise nothing ran.  keep the last one.
+            self.overhead_ratio = overhead / wall_time
+            if self.overhead_ratio > self.budget:
+                self.next_profiler = self.sampling_profiler
+        else:
+            load = cpu_time / wall_time
+            self.overhead_ratio = self.overhead_per_cpu_time * load
+            if self.overhead_ratio < self.budget * self.hysteresis:
+                self.next_profiler = self.tracing_profiler
+
+    def meta(self):
+        meta = self.profiler.meta()
+        meta.update(mode=self.mode, overhead_budget=self.budget,
+                    overhead_ratio=self.overhead_ratio)
+        return meta
+
+    def run(self):
+        # switch just before starting not to mismatch the result.
+        self.profiler = self.next_profiler
+        with self.profiler:
+            yield
+        self.govern()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+   profiling.histogram
+   ~~~~~~~~~~~~~~~~~~~
+
+   Compact log-bucketed latency histograms.  Like HDR histograms, each power
+   of 2 is divided into :data:`SUB_BUCKETS` linear sub-buckets so the relative
+   error of a value is bounded.  A histogram is just a fixed-size array of
+   64-bit counts so that it is cheap to update and to pickle.
+
+   :copyright: (c) 2014-2017, What! Studio
+   :license: BSD, see LICENSE for more details.
+
+"""
+from __future__ import absolute_import, division
+
+from array import array
+import math
+
+from profiling.utils import INT64
+
+
+__all__ = ['make_histogram', 'record', 'merge', 'percentile', 'total']
+
+
+#: The number of linear sub-buckets in a power of 2.
+SUB_BUCKETS = 4
+
+#: The binary exponent of the smallest bucket.  2**-20 sec is about 1 usec.
+MIN_EXP = -19
+
+#: The number of powers of 2 covered.  Up to about 68 minutes.
+OCTAVES = 32
+
+#: The number of buckets.  The first one is for underflow.
+BUCKETS = 1 + OCTAVES * SUB_BUCKETS
+
+
+def make_histogram():
+    return array(INT64, [0]) * BUCKETS
+
+
+def bucket_index(sec):
+    """The bucket index of the given seconds in O(1)."""
+    if sec <= 0:
+        return 0
+    mantissa, exp = math.frexp(sec)
+    octave = exp - MIN_EXP
+    if octave < 0:
+        return 0
+    # 0.5 <= mantissa < 1
+    sub = int((mantissa - 0.5) * 2 * SUB_BUCKETS)
+    return min(1 + octave * SUB_BUCKETS + sub, BUCKETS - 1)
+
+
+def bucket_value(index):
+    """The highest seconds which belong to the bucket."""
+    if index == 0:
+        return math.ldexp(0.5, MIN_EXP)
+    octave, sub = divmod(index - 1, SUB_BUCKETS)
+    return math.ldexp(0.5 + (sub + 1) / (2 * SUB_BUCKETS), octave + MIN_EXP)
+
+
+def record(histogram, sec, count=1):
+    """Counts the given seconds in the histogram."""
+    histogram[bucket_index(sec)] += count
+
+
+def merge(histogram, other):
+    """Adds the counts of the other histogram into the histogram."""
+    for index, count in enumerate(other):
+        if count:
+            histogram[index] += count
+
+
+def total(histogram):
+    return sum(histogram)
+
+
+def percentile(histogram, ratio):
+    """Estimates the seconds at the given ratio such as 0.99 for p99.  The
+    result is the highest value of the bucket.
+    """
+    rank = ratio * total(histogram)
+    if not rank:
+        return 0.0
+    counted = 0
+    for index, count in enumerate(histogram):
+        counted += count
+        if counted >= rank:
+            return bucket_value(index)
+    return bucket_value(BUCKETS - 1)
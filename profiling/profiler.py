@@ -15,8 +15,9 @@ except ImportError:
     import pickle
 import time
 
+from profiling.filters import CodeFilter
 from profiling.stats import RecordingStatistics
-from profiling.utils import frame_stack, Runnable
+from profiling.utils import cpu_clock, frame_stack, Runnable
 from profiling.viewer import StatisticsTable, StatisticsViewer
 
 
@@ -37,16 +38,28 @@ class Profiler(Runnable):
     ignored_frames = ()
     ignored_codes = ()
 
+    #: Whether to record into :class:`profiling.compact.
+    #: CompactRecordingStatistics` which the cyclic GC doesn't track.
+    compact = False
+
     def __init__(self, base_frame=None, base_code=None,
-                 ignored_frames=(), ignored_codes=()):
+                 ignored_frames=(), ignored_codes=(), compact=False):
         self.base_frame = base_frame
         self.base_code = base_code
         self.ignored_frames = ignored_frames
+        if not isinstance(ignored_codes, CodeFilter):
+            # look up ignored codes in constant time.
+            ignored_codes = CodeFilter(ignored_codes=ignored_codes)
         self.ignored_codes = ignored_codes
-        self.stats = RecordingStatistics()
+        self.compact = compact
+        if compact:
+            from profiling.compact import CompactRecordingStatistics
+            self.stats = CompactRecordingStatistics()
+        else:
+            self.stats = RecordingStatistics()
 
     def start(self):
-        self._cpu_time_started = time.clock()
+        self._cpu_time_started = cpu_clock()
         self._wall_time_started = time.time()
         self.stats.clear()
         return super(Profiler, self).start()
@@ -65,13 +78,20 @@ class Profiler(Runnable):
     def result(self):
         """Gets the frozen statistics to serialize by Pickle."""
         try:
-            cpu_time = max(0, time.clock() - self._cpu_time_started)
+            cpu_time = max(0, cpu_clock() - self._cpu_time_started)
             wall_time = max(0, time.time() - self._wall_time_started)
         except AttributeError:
             cpu_time = wall_time = 0.0
         return self.stats, cpu_time, wall_time
 
-    def dump(self, dump_filename, pickle_protocol=pickle.HIGHEST_PROTOCOL):
+    def meta(self):
+        """Gets the information how the profiling result has been measured.
+        It is saved in the dump with the result.
+        """
+        return {}
+
+    def dump(self, dump_filename, pickle_protocol=pickle.HIGHEST_PROTOCOL,
+             columnar=False):
         """Saves the profiling result to a file
 
         :param dump_filename: path to a file
@@ -79,11 +99,20 @@ class Profiler(Runnable):
 
         :param pickle_protocol: version of pickle protocol
         :type pickle_protocol: int
+
+        :param columnar: whether to freeze the statistics into
+                         :mod:`profiling.columnar` columns
+        :type columnar: bool
         """
         result = self.result()
+        meta = self.meta()
+        if columnar:
+            from profiling.columnar import freeze
+            stats, cpu_time, wall_time = result
+            result = (freeze(stats), cpu_time, wall_time)
 
         with open(dump_filename, 'wb') as f:
-            pickle.dump((self.__class__, result), f, pickle_protocol)
+            pickle.dump((self.__class__, result, meta), f, pickle_protocol)
 
     def make_viewer(self, title=None, at=None):
         """Makes a statistics viewer from the profiling result.
@@ -91,7 +120,8 @@ class Profiler(Runnable):
         viewer = StatisticsViewer()
         viewer.set_profiler_class(self.__class__)
         stats, cpu_time, wall_time = self.result()
-        viewer.set_result(stats, cpu_time, wall_time, title=title, at=at)
+        viewer.set_result(stats, cpu_time, wall_time, title=title, at=at,
+                          meta=self.meta())
         viewer.activate()
         return viewer
 
@@ -116,7 +146,7 @@ class Profiler(Runnable):
 class ProfilerWrapper(Profiler):
 
     for attr in ['table_class', 'stats', 'top_frame', 'top_code', 'result',
-                 'is_running']:
+                 'meta', 'is_running']:
         f = lambda self, attr=attr: getattr(self.profiler, attr)
         locals()[attr] = property(f)
         del f
@@ -178,9 +178,14 @@ class ProfilingServer(object):
             # should sleep.
             yield
             self.profiler.stop()
-            result = self.profiler.result()
-            data = pack_msg(RESULT, result,
+            # the meta follows the result.
+            result = self.profiler.result() + (self.profiler.meta(),)
+            # the profiler class may be switched by a wrapper such as
+            # profiling.governor.OverheadGovernor.
+            data = pack_msg(PROFILER, self.profiler_class(),
                             pickle_protocol=self.pickle_protocol)
+            data += pack_msg(RESULT, result,
+                             pickle_protocol=self.pickle_protocol)
             self._latest_result_data = data
             # broadcast.
             closed_clients = []
@@ -196,6 +201,18 @@ class ProfilingServer(object):
                 self.disconnected(client)
         self._log_profiler_stopped()
 
+    def profiler_class(self):
+        """The class of the innermost profiler which is wrapped by
+        :class:`profiling.profiler.ProfilerWrapper`.
+        """
+        profiler = self.profiler
+        while True:
+            try:
+                profiler = profiler.profiler
+            except AttributeError:
+                break
+        return type(profiler)
+
     def send_msg(self, client, method, msg, pickle_protocol=None):
         if pickle_protocol is None:
             pickle_protocol = self.pickle_protocol
@@ -209,14 +226,10 @@ class ProfilingServer(object):
         self._start_watching(client)
         self.send_msg(client, WELCOME, (self.pickle_protocol, __version__),
                       pickle_protocol=0)
-        profiler = self.profiler
-        while True:
-            try:
-                profiler = profiler.profiler
-            except AttributeError:
-                break
-        self.send_msg(client, PROFILER, type(profiler))
-        if self._latest_result_data is not None:
+        if self._latest_result_data is None:
+            # otherwise the latest result data starts with the profiler.
+            self.send_msg(client, PROFILER, self.profiler_class())
+        else:
             try:
                 self._send(client, self._latest_result_data)
             except socket.error as exc:
@@ -38,9 +38,11 @@ def handle_profiler(_, profiler_class, client):
 
 @protocol.register(RESULT)
 def handle_result(_, result, client):
-    stats, cpu_time, wall_time = result
+    stats, cpu_time, wall_time = result[:3]
+    # servers before the meta was introduced send only 3 items.
+    meta = result[3] if len(result) > 3 else None
     client.viewer.set_result(stats, cpu_time, wall_time,
-                             client.title, datetime.now())
+                             client.title, datetime.now(), meta)
 
 
 class ProfilingClient(object):
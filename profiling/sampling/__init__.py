@@ -11,6 +11,11 @@
 """
 from __future__ import absolute_import
 
+from collections import OrderedDict
+import threading
+
+from six.moves import zip
+
 from profiling import sortkeys
 from profiling.profiler import Profiler
 from profiling.sampling.samplers import ItimerSampler, Sampler
@@ -33,9 +38,23 @@ class SamplingStatisticsTable(StatisticsTable):
         ('%', 'left', (4,), None),
         ('DEEP', 'right', (6,), sortkeys.by_deep_hits),
         ('%', 'left', (4,), None),
+        ('CPU', 'right', (6,), sortkeys.by_own_time),
+        ('%', 'left', (4,), None),
+        ('CUM', 'right', (6,), sortkeys.by_deep_time),
+        ('%', 'left', (4,), None),
     ]
     order = sortkeys.by_deep_hits
 
+    def make_meta_markup(self, meta):
+        try:
+            interval = meta['interval']
+        except KeyError:
+            return None
+        markup = ['INTERVAL ', fmt.markup_time(interval)]
+        if meta.get('target_overhead') is not None:
+            markup.append(('weak', ' (adaptive)'))
+        return markup
+
     def make_cells(self, node, stats):
         root_stats = node.get_root().get_value()
         yield fmt.make_stat_text(stats)
@@ -43,6 +62,16 @@ class SamplingStatisticsTable(StatisticsTable):
         yield fmt.make_percent_text(stats.own_hits, root_stats.deep_hits)
         yield fmt.make_int_or_na_text(stats.deep_hits)
         yield fmt.make_percent_text(stats.deep_hits, root_stats.deep_hits)
+        # the CPU times estimated by the samples.  Dumps of the older
+        # version don't have them.
+        cpu_time = root_stats.deep_time
+        for time in [stats.own_time, stats.deep_time]:
+            if cpu_time:
+                yield fmt.make_time_text(time)
+                yield fmt.make_percent_text(time, cpu_time)
+            else:
+                yield fmt.make_time_or_na_text(None)
+                yield fmt.make_percent_text(0)
 
 
 class SamplingProfiler(Profiler):
@@ -53,27 +82,258 @@ class SamplingProfiler(Profiler):
     #: sampling.samplers.Sampler`.
     sampler = None
 
+    #: :class:`profiling.sampling.asyncio.TaskStacks` if the logical call
+    #: stacks of asyncio tasks are sampled.
+    task_stacks = None
+
+    #: The number of samples which the ring buffer holds.  The samples are
+    #: aggregated into the statistics in bulk by a background thread every
+    #: :attr:`aggregation_interval` or when the result is requested.  The
+    #: samples are dropped while the buffer is full.
+    buffer_size = 1024
+
+    #: The seconds between the aggregations in the background.
+    aggregation_interval = 0.1
+
+    #: The identifiers of the threads which the profiler runs.  They are not
+    #: sampled.
+    thread_ids = frozenset()
+
+    #: The maximum number of distinct stacks whose statistics nodes are
+    #: cached.  The least recently recorded stack is evicted first.
+    stack_cache_size = 1024
+
+    #: Whether the samples are counted by the executing lines of the sampled
+    #: functions.  The leaf function counts the line which was executing.
+    lines = False
+
+    #: Whether the callers count their call-site lines also.  It implies
+    #: :attr:`lines`.
+    call_lines = False
+
+    #: The numbers of the stacks recorded with and without the cache.
+    stack_cache_hits = 0
+    stack_cache_misses = 0
+
+    #: The number of the samples dropped because the buffer was full or
+    #: another sample was being written.
+    dropped_samples = 0
+
     def __init__(self, base_frame=None, base_code=None,
-                 ignored_frames=(), ignored_codes=(), sampler=None):
+                 ignored_frames=(), ignored_codes=(), sampler=None,
+                 async_stacks=False, buffer_size=None, stack_cache_size=None,
+                 lines=False, call_lines=False, compact=False):
         sampler = sampler or SAMPLER_CLASS()
         if not isinstance(sampler, Sampler):
             raise TypeError('Not a sampler instance')
         base = super(SamplingProfiler, self)
-        base.__init__(base_frame, base_code, ignored_frames, ignored_codes)
+        base.__init__(base_frame, base_code, ignored_frames, ignored_codes,
+                      compact)
         self.sampler = sampler
+        if async_stacks:
+            if not sampler.samples_in_thread:
+                # the running task of another thread is unknown.
+                raise ValueError('Async stacks require a sampler which '
+                                 'samples in the sampled thread')
+            from profiling.sampling.asyncio import TaskStacks
+            self.task_stacks = TaskStacks(self.ignored_codes)
+        self.lines = lines or call_lines
+        self.call_lines = call_lines
+        if buffer_size is not None:
+            self.buffer_size = buffer_size
+        # The ring buffer of samples.  A sampler only writes a record into
+        # it so that sampling doesn't allocate statistics nodes.  The
+        # samples from `_aggregated` to `_written` are not aggregated yet.
+        # Samples may be written by several threads or by nested signal
+        # handlers so that a record is written under `_writing`.
+        self._buffer = [None] * self.buffer_size
+        self._written = 0
+        self._aggregated = 0
+        self._writing = threading.Lock()
+        self._aggregating = threading.Lock()
+        if stack_cache_size is not None:
+            self.stack_cache_size = stack_cache_size
+        # The stacks of codes interned to the paths of statistics nodes from
+        # the root so that a repeated stack doesn't walk the tree.
+        self._stack_cache = OrderedDict()
+
+    def sample(self, frame, cpu_time=None, weight=1):
+        """Samples the given frame.  The sample counts `weight` hits.  It is
+        also weighted by the CPU time in nanoseconds which the thread spent
+        since the last sample if `cpu_time` is given.
 
-    def sample(self, frame):
-        """Samples the given frame."""
+        It may be called in a signal handler.  It just writes the stack of
+        codes into the ring buffer.  The line numbers of the frames are
+        written along with them if :attr:`lines` is set.  They are aligned to
+        the innermost end of the stack.  The sample is dropped if the buffer
+        is full.  It never waits for a lock.
+        """
         frames = self.frame_stack(frame)
         if frames:
+            # the innermost frame which is not ignored takes the sample.
+            frame = frames.pop()
+        elif (frame in self.ignored_frames or
+              frame.f_code in self.ignored_codes):
+            return
+        codes = lines = None
+        if self.task_stacks is not None:
+            frames.append(frame)
+            codes = self.task_stacks.codes(frames)
             frames.pop()
-        parent_stats = self.stats
-        for f in frames:
-            parent_stats = parent_stats.ensure_child(f.f_code, void)
-        stats = parent_stats.ensure_child(frame.f_code, RecordingStatistics)
-        stats.own_hits += 1
+        if codes is None:
+            codes = [f.f_code for f in frames]
+            codes.append(frame.f_code)
+            if self.call_lines:
+                lines = [f.f_lineno for f in frames]
+                lines.append(frame.f_lineno)
+                lines = tuple(lines)
+        if lines is None and self.lines:
+            # the logical stack of a task doesn't have the call-site lines
+            # of the awaiting tasks.
+            lines = (frame.f_lineno,)
+        record = (tuple(codes), lines, cpu_time, weight)
+        if not self._writing.acquire(False):
+            # another sample is being written by the interrupted code.
+            self.dropped_samples += 1
+            return
+        try:
+            index = self._written
+            if index - self._aggregated >= self.buffer_size:
+                # the buffer is full.  The unread samples must not be
+                # overwritten.
+                self.dropped_samples += 1
+                return
+            self._buffer[index % self.buffer_size] = record
+            self._written = index + 1
+        finally:
+            self._writing.release()
+
+    def aggregate(self, blocking=True):
+        """Aggregates the buffered samples into the statistics.  The same
+        stacks are merged before walking the statistics tree.
+
+        :returns: ``False`` if another aggregation is in progress and
+                  `blocking` is false.
+        """
+        if not self._aggregating.acquire(blocking):
+            return False
+        try:
+            written = self._written
+            hits, cpu_times = {}, {}
+            for index in range(self._aggregated, written):
+                record = self._buffer[index % self.buffer_size]
+                codes, lines, cpu_time, weight = record
+                key = (codes, lines)
+                hits[key] = hits.get(key, 0) + weight
+                if cpu_time is not None:
+                    cpu_times[key] = cpu_times.get(key, 0) + cpu_time
+            self._aggregated = written
+            for key, count in hits.items():
+                codes, lines = key
+                self.record(codes, count, cpu_times.get(key), lines)
+        finally:
+            self._aggregating.release()
+        return True
+
+    def record(self, codes, hits, cpu_time=None, lines=None):
+        """Records the samples of the given stack of codes into the
+        statistics.  The hits are counted by the given line numbers of the
+        innermost codes also.
+        """
+        weighted = cpu_time is not None or self.call_lines
+        cached = self._stack_cache.pop(codes, None)
+        if cached is None or weighted and not cached[1]:
+            # a path made for unweighted samples may have void callers.
+            self.stack_cache_misses += 1
+            path = self.ensure_path(codes, weighted)
+            full = len(self._stack_cache) >= self.stack_cache_size
+            if cached is None and full:
+                self._stack_cache.popitem(last=False)
+        else:
+            self.stack_cache_hits += 1
+            path, weighted = cached
+        # the most recently recorded stack goes to the end.
+        self._stack_cache[codes] = (path, weighted)
+        path[-1].own_hits += hits
+        # the aggregates of the ancestors have been changed.
+        self.stats.mark_dirty()
+        for stats in path:
+            stats.mark_dirty()
+        if lines is not None:
+            for stats, lineno in zip(path[-len(lines):], lines):
+                if stats.line_hits is None:
+                    stats.line_hits = {}
+                stats.line_hits[lineno] = stats.line_hits.get(lineno, 0) + hits
+        if cpu_time is not None:
+            # the CPU time is inclusive so the ancestors record it too.
+            self.stats.deep_time_ns += cpu_time
+            for stats in path:
+                stats.deep_time_ns += cpu_time
+
+    def ensure_path(self, codes, weighted=False):
+        """Finds or makes the statistics nodes of the given stack of codes.
+        The nodes of the callers are void unless the samples are `weighted`
+        by CPU time or the call-site lines are counted.  A void node which
+        has to record is filled.  Then the cached paths are dropped because
+        they may go through the replaced node.
+        """
+        path = []
+        stats = self.stats
+        last = len(codes) - 1
+        for x, code in enumerate(codes):
+            recording = weighted or x == last
+            parent, stats = stats, stats.ensure_child(
+                code, RecordingStatistics if recording else void)
+            if recording and isinstance(stats, void):
+                stats = parent.fill_child(code)
+                self._stack_cache.clear()
+            path.append(stats)
+        return path
+
+    def exclude_code(self, code):
+        super(SamplingProfiler, self).exclude_code(code)
+        self._stack_cache.clear()
+
+    def start(self):
+        # the cached nodes are detached from the tree cleared by start().
+        self._stack_cache.clear()
+        self.stack_cache_hits = self.stack_cache_misses = 0
+        self.dropped_samples = 0
+        return super(SamplingProfiler, self).start()
+
+    def result(self):
+        self.aggregate()
+        return super(SamplingProfiler, self).result()
+
+    def meta(self):
+        meta = super(SamplingProfiler, self).meta()
+        meta.update(sampler=type(self.sampler).__name__,
+                    interval=self.sampler.interval,
+                    target_overhead=self.sampler.target_overhead,
+                    stack_cache_hits=self.stack_cache_hits,
+                    stack_cache_misses=self.stack_cache_misses,
+                    dropped_samples=self.dropped_samples,
+                    lines=self.lines, call_lines=self.call_lines)
+        return meta
+
+    def _aggregate_periodically(self, stopped):
+        while not stopped.wait(self.aggregation_interval):
+            self.aggregate()
 
     def run(self):
+        # forget the samples of the last run.
+        self._aggregated = self._written
+        # the samplers don't aggregate.  It may be in a signal handler.
+        stopped = threading.Event()
+        thread = threading.Thread(target=self._aggregate_periodically,
+                                  args=(stopped,))
+        thread.daemon = True
+        thread.start()
+        self.thread_ids = frozenset([thread.ident])
         self.sampler.start(self)
         yield
         self.sampler.stop()
+        stopped.set()
+        thread.join()
+        self.thread_ids = frozenset()
+        self.aggregate()
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+   profiling.sampling.asyncio
+   ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+   Reconstructs the logical call stacks of `asyncio`_ tasks.  A sampled frame
+   stack of an asyncio program has only the event loop and the running task.
+   The tasks which are awaiting the running task are suspended so they are
+   not on the frame stack.
+
+   .. _asyncio: https://docs.python.org/3/library/asyncio.html
+
+   :copyright: (c) 2014-2017, What! Studio
+   :license: BSD, see LICENSE for more details.
+
+"""
+from __future__ import absolute_import
+
+import asyncio
+import weakref
+
+from profiling.stats import PseudoCode
+
+
+__all__ = ['TaskStacks', 'current_task', 'task_code', 'waiter_task']
+
+
+#: The module name of the pseudo codes of tasks.
+TASK_MODULE = 'asyncio.Task'
+
+#: The maximum number of futures or tasks to follow.
+MAX_DEPTH = 64
+
+
+def current_task():
+    """The running task in the current thread or ``None``."""
+    try:
+        get_current_task = asyncio.current_task
+    except AttributeError:
+        # Python 3.6 or earlier.
+        return asyncio.Task.current_task()
+    try:
+        return get_current_task()
+    except RuntimeError:
+        # no running event loop.
+        return None
+
+
+def task_coro(task):
+    try:
+        return task.get_coro()
+    except AttributeError:
+        # Python 3.7 or earlier.
+        return task._coro
+
+
+def task_code(task):
+    """Makes a :class:`profiling.stats.PseudoCode` for the given task.  It is
+    named after the coroutine so that the tasks of a coroutine function share
+    a pseudo code.
+    """
+    coro = task_coro(task)
+    name = getattr(coro, '__qualname__', None) or coro.__name__
+    return PseudoCode(TASK_MODULE, name)
+
+
+def coro_frames(coro):
+    """Iterates the frames of the chain of coroutines awaiting each other.
+    The outermost frame comes first.
+    """
+    for x in range(MAX_DEPTH):
+        frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame',
+                                                           None)
+        if frame is None:
+            break
+        yield frame
+        coro = (getattr(coro, 'cr_await', None) or
+                getattr(coro, 'gi_yieldfrom', None))
+
+
+def waiter_task(future):
+    """Finds the task which is awaiting the given future.  Futures combining
+    other futures such as by :func:`asyncio.gather` are followed.
+    """
+    futures = [future]
+    for x in range(MAX_DEPTH):
+        if not futures:
+            break
+        future = futures.pop()
+        for callback in getattr(future, '_callbacks', None) or ():
+            if isinstance(callback, tuple):
+                # (callback, context) since Python 3.7.
+                callback = callback[0]
+            task = getattr(callback, '__self__', None)
+            if isinstance(task, asyncio.Task):
+                return task
+            for cell in getattr(callback, '__closure__', None) or ():
+                try:
+                    value = cell.cell_contents
+                except ValueError:
+                    continue
+                if isinstance(value, asyncio.Future) and value is not future:
+                    futures.append(value)
+
+
+class TaskStacks(object):
+    """Reconstructs the logical call stacks of the running tasks.  Each task
+    is represented by a pseudo code made by :func:`task_code` and the frames
+    of its coroutines follow it.
+
+    The stack of the awaiting tasks is cached by the running task along with
+    the chain of the awaiting tasks.  The awaiting tasks don't move while they
+    are waiting, so the stack is rebuilt only when the chain changes such as
+    when a task is awaited after it has started.  The cache is dropped with
+    the task so that its size is bounded by the number of alive tasks.
+
+    The running task is looked up in the current thread.  So the stacks must
+    be sampled in the sampled thread such as by a signal handler.
+    """
+
+    def __init__(self, ignored_codes=()):
+        self.ignored_codes = ignored_codes
+        self._prefixes = weakref.WeakKeyDictionary()
+
+    def codes(self, frames):
+        """Makes the logical stack of codes from the given frames ordered
+        from the outermost.  The frames out of the running task such as of
+        the event loop are replaced with the awaiting tasks.  ``None`` if no
+        task is running.
+        """
+        task = current_task()
+        if task is None:
+            return None
+        frames = list(frames)
+        coro_frame = getattr(task_coro(task), 'cr_frame', None)
+        for x, frame in enumerate(frames):
+            if frame is coro_frame:
+                break
+        else:
+            return None
+        waiters = self.waiters(task)
+        try:
+            cached_waiters, prefix = self._prefixes[task]
+        except KeyError:
+            cached_waiters = None
+        if cached_waiters != waiters:
+            prefix = self.prefix(task, waiters)
+            self._prefixes[task] = (waiters, prefix)
+        codes = list(prefix)
+        codes.extend(f.f_code for f in frames[x:])
+        return codes
+
+    def waiters(self, task):
+        """The chain of the tasks awaiting the given task ordered from the
+        innermost.
+        """
+        tasks = [task]
+        for x in range(MAX_DEPTH):
+            waiter = waiter_task(tasks[-1])
+            if waiter is None or waiter in tasks:
+                break
+            tasks.append(waiter)
+        return tuple(tasks[1:])
+
+    def prefix(self, task, waiters=None):
+        """Makes the stack of the tasks awaiting the given task and the pseudo
+        code of the task.
+        """
+        if waiters is None:
+            waiters = self.waiters(task)
+        codes = []
+        for waiter in reversed(waiters):
+            codes.append(task_code(waiter))
+            codes.extend(f.f_code for f in coro_frames(task_coro(waiter))
+                         if f.f_code not in self.ignored_codes)
+        codes.append(task_code(task))
+        return tuple(codes)
@@ -13,6 +13,7 @@ import functools
 import signal
 import sys
 import threading
+import time
 import weakref
 
 import six.moves._thread as _thread
@@ -20,20 +21,119 @@ import six.moves._thread as _thread
 from profiling.utils import deferral, Runnable, thread_clock
 
 
-__all__ = ['Sampler', 'ItimerSampler', 'TracingSampler']
+__all__ = ['Sampler', 'ItimerSampler', 'TracingSampler', 'ThreadsSampler']
 
 
 INTERVAL = 1e-3  # 1ms
 
+#: The default bounds of an adaptive interval.
+MIN_INTERVAL = 1e-4  # 100us
+MAX_INTERVAL = 1e-1  # 100ms
+
+#: The weight of the last cost in the moving average of the sampling cost.
+COST_SMOOTHING = 0.1
+
+#: The clock to measure the time spent to take a sample.
+clock = getattr(time, 'perf_counter', time.time)
+
+#: The table of the alive threads in :mod:`threading`, the table of the
+#: starting threads which are not registered yet, and their lock.
+_threads = getattr(threading, '_active', None)
+_starting_threads = getattr(threading, '_limbo', None)
+_threads_lock = getattr(threading, '_active_limbo_lock', None)
+if _threads is None or _starting_threads is None:
+    _threads_lock = None
+
+
+def resolve_thread_clock():
+    """Returns :func:`profiling.utils.thread_clock` if it is available.
+    Otherwise ``None``.  It imports `Yappi`_ earlier than Python 3.3 so it
+    should not be called in a signal handler.
+
+    .. _Yappi: https://code.google.com/p/yappi/
+
+    """
+    try:
+        thread_clock()
+    except ImportError:
+        return None
+    return thread_clock
+
+
+def cpu_time_ns(cpu_time, prev_cpu_time):
+    """The CPU time in nanoseconds between the given seconds.  The first
+    sample of a thread is not weighted.
+    """
+    if prev_cpu_time is None:
+        return 0
+    return int(round((cpu_time - prev_cpu_time) * 1e9))
+
 
 class Sampler(Runnable):
-    """The base class for samplers."""
+    """The base class for samplers.
+
+    If `target_overhead` is given, the interval is adjusted within
+    `min_interval` and `max_interval` so that the time spent to take a sample
+    is the ratio of the interval.  Then each sample is weighted by the number
+    of `min_interval` in the effective interval so that the hits are
+    comparable while the interval changes.
+    """
 
     #: Sampling interval.
     interval = INTERVAL
 
-    def __init__(self, interval=INTERVAL):
+    #: The target ratio of the sampling cost to the interval.  ``None`` if the
+    #: interval is fixed.
+    target_overhead = None
+
+    min_interval = MIN_INTERVAL
+    max_interval = MAX_INTERVAL
+
+    #: The moving average of the seconds spent to take a sample.
+    cost = None
+
+    #: Whether a frame is sampled in its thread.  The state of the sampled
+    #: thread such as the running asyncio task is available then.
+    samples_in_thread = True
+
+    #: The CPU-time clock of the current thread resolved when the sampler
+    #: starts.  ``None`` if it is not available then the samples are not
+    #: weighted by CPU time.
+    thread_clock = None
+
+    def __init__(self, interval=INTERVAL, target_overhead=None,
+                 min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL):
+        if target_overhead is not None and target_overhead <= 0:
+            raise ValueError('Target overhead must be positive')
+        self.interval = interval
+        self.target_overhead = target_overhead
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+    @property
+    def weight(self):
+        """The weight of a sample taken in the current interval."""
+        if self.target_overhead is None:
+            return 1
+        return max(1, int(round(self.interval / self.min_interval)))
+
+    def adapt(self, cost):
+        """Adjusts the interval for :attr:`target_overhead` by the seconds
+        spent to take a sample.
+
+        :returns: whether the interval has been changed.
+        """
+        if self.cost is None:
+            self.cost = cost
+        else:
+            self.cost += (cost - self.cost) * COST_SMOOTHING
+        interval = self.cost / self.target_overhead
+        interval = min(max(interval, self.min_interval), self.max_interval)
+        # ignore a small change not to reset a timer so often.
+        if abs(interval - self.interval) < self.interval * 0.1:
+            return False
         self.interval = interval
+        return True
 
 
 class ItimerSampler(Sampler):
@@ -42,17 +142,39 @@ class ItimerSampler(Sampler):
     .. note::
 
        ``signal.SIGPROF`` is triggeres by only the main thread.  If you need
-       sample multiple threads, use :class:`TracingSampler` instead.
+       sample multiple threads, use :class:`ThreadsSampler` or
+       :class:`TracingSampler` instead.
 
     """
 
+    #: The CPU time of the main thread at the last sample.
+    cpu_time = None
+
     def handle_signal(self, profiler, signum, frame):
-        profiler.sample(frame)
+        # a signal may be delayed or coalesced.  The sample is weighted by
+        # the actual CPU time since the last sample.
+        if self.thread_clock is None:
+            cpu_time_delta = None
+        else:
+            cpu_time = self.thread_clock()
+            cpu_time_delta = cpu_time_ns(cpu_time, self.cpu_time)
+            self.cpu_time = cpu_time
+        if self.target_overhead is None:
+            profiler.sample(frame, cpu_time_delta)
+            return
+        t = clock()
+        profiler.sample(frame, cpu_time_delta, self.weight)
+        if self.adapt(clock() - t):
+            t = self.interval
+            signal.setitimer(signal.ITIMER_PROF, t, t)
 
     def run(self, profiler):
         weak_profiler = weakref.proxy(profiler)
         handle = functools.partial(self.handle_signal, weak_profiler)
         t = self.interval
+        self.cpu_time = None
+        # not to import in the signal handler.
+        self.thread_clock = resolve_thread_clock()
         with deferral() as defer:
             prev_handle = signal.signal(signal.SIGPROF, handle)
             if prev_handle == signal.SIG_DFL:
@@ -74,7 +196,8 @@ class TracingSampler(Sampler):
     profiling signals.
 
     Just like :class:`profiling.tracing.timers.ThreadTimer`, `Yappi`_ is
-    required for earlier than Python 3.3.
+    required for earlier than Python 3.3.  Without it, the frames are sampled
+    by wall-clock time and the samples are not weighted by CPU time.
 
     .. _Yappi: https://code.google.com/p/yappi/
 
@@ -86,13 +209,22 @@ class TracingSampler(Sampler):
         self.counter = 0
 
     def _profile(self, profiler, frame, event, arg):
-        t = thread_clock()
+        timer = self.thread_clock or clock
+        t = timer()
         thread_id = _thread.get_ident()
-        sampled_at = self.sampled_times.get(thread_id, 0)
-        if t - sampled_at < self.interval:
+        sampled_at = self.sampled_times.get(thread_id)
+        if sampled_at is not None and t - sampled_at < self.interval:
             return
         self.sampled_times[thread_id] = t
-        profiler.sample(frame)
+        if self.thread_clock is None:
+            cpu_time_delta = None
+        else:
+            cpu_time_delta = cpu_time_ns(t, sampled_at)
+        if self.target_overhead is None:
+            profiler.sample(frame, cpu_time_delta)
+        else:
+            profiler.sample(frame, cpu_time_delta, self.weight)
+            self.adapt(timer() - t)
         self.counter += 1
         if self.counter % 10000 == 0:
             self._clear_for_dead_threads()
@@ -102,6 +234,7 @@ class TracingSampler(Sampler):
             self.sampled_times.pop(thread_id, None)
 
     def run(self, profiler):
+        self.thread_clock = resolve_thread_clock()
         profile = functools.partial(self._profile, profiler)
         with deferral() as defer:
             sys.setprofile(profile)
@@ -109,3 +242,122 @@ class TracingSampler(Sampler):
             threading.setprofile(profile)
             defer(threading.setprofile, None)
             yield
+
+
+class ThreadsSampler(Sampler):
+    """Samples the running frames of all threads by
+    :func:`sys._current_frames` in a background thread every :attr:`interval`
+    of wall-clock time.  It costs nothing in the profiled threads.
+
+    Each sample is weighted by the CPU time which the thread spent since the
+    last sample if :func:`time.pthread_getcpuclockid` is available (Python
+    3.3 or later on Unix).  So the number of samples shows wall-clock time
+    while the weights show CPU time.  A thread which is not started by
+    :mod:`threading` is sampled without weights.
+    """
+
+    samples_in_thread = False
+
+    def __init__(self, *args, **kwargs):
+        super(ThreadsSampler, self).__init__(*args, **kwargs)
+        #: The CPU times in nanoseconds of the threads at the last sample.
+        self.cpu_times = {}
+        #: The CPU-time clock ids of the threads.
+        self.clock_ids = {}
+
+    def thread_clock_id(self, thread_id):
+        """The CPU-time clock id of the thread.  ``None`` if it is not
+        available.
+
+        :func:`time.pthread_getcpuclockid` is undefined for an exited thread.
+        So the clock id is resolved only while :mod:`threading` knows that the
+        thread is alive and then it is cached.  Reading the clock of an exited
+        thread just fails.
+
+        A thread may run before :mod:`threading` registers it.  So the clock
+        id is looked up again while any thread is starting.  ``None`` is
+        cached only for a thread which is not started by :mod:`threading`.
+        """
+        try:
+            return self.clock_ids[thread_id]
+        except KeyError:
+            pass
+        if _threads_lock is None:
+            self.clock_ids[thread_id] = None
+            return None
+        # a thread leaves the table under the lock before it exits.
+        with _threads_lock:
+            if thread_id not in _threads:
+                if not _starting_threads:
+                    self.clock_ids[thread_id] = None
+                return None
+            try:
+                clock_id = time.pthread_getcpuclockid(thread_id)
+            except (AttributeError, OSError):
+                clock_id = None
+        self.clock_ids[thread_id] = clock_id
+        return clock_id
+
+    def thread_cpu_time(self, thread_id):
+        """The CPU time of the thread in nanoseconds.  ``None`` if it is not
+        available.
+        """
+        clock_id = self.thread_clock_id(thread_id)
+        if clock_id is None:
+            return None
+        try:
+            return time.clock_gettime_ns(clock_id)
+        except AttributeError:
+            # Python 3.6 or earlier.
+            return int(time.clock_gettime(clock_id) * 1e9)
+        except OSError:
+            # the thread has exited.  its identifier may be reused.
+            del self.clock_ids[thread_id]
+            return None
+
+    def sample(self, profiler):
+        """Samples the frames of all threads except the sampler thread and
+        the threads of the profiler.
+        """
+        frames = sys._current_frames()
+        ignored_thread_ids = set(getattr(profiler, 'thread_ids', ()))
+        ignored_thread_ids.add(_thread.get_ident())
+        cpu_times, clock_ids = {}, {}
+        for thread_id, frame in frames.items():
+            if thread_id in ignored_thread_ids:
+                continue
+            cpu_time = self.thread_cpu_time(thread_id)
+            if thread_id in self.clock_ids:
+                clock_ids[thread_id] = self.clock_ids[thread_id]
+            if cpu_time is None:
+                cpu_time_delta = None
+            else:
+                cpu_times[thread_id] = cpu_time
+                # the first sample of a thread is not weighted.
+                cpu_time_delta = cpu_time - self.cpu_times.get(thread_id,
+                                                               cpu_time)
+            profiler.sample(frame, cpu_time_delta, self.weight)
+        # forget dead threads.
+        self.cpu_times, self.clock_ids = cpu_times, clock_ids
+
+    def _sample_periodically(self, profiler, stopped):
+        while not stopped.wait(self.interval):
+            if self.target_overhead is None:
+                self.sample(profiler)
+                continue
+            t = clock()
+            self.sample(profiler)
+            self.adapt(clock() - t)
+
+    def run(self, profiler):
+        weak_profiler = weakref.proxy(profiler)
+        stopped = threading.Event()
+        thread = threading.Thread(target=self._sample_periodically,
+                                  args=(weak_profiler, stopped))
+        thread.daemon = True
+        thread.start()
+        yield
+        stopped.set()
+        thread.join()
+        self.cpu_times.clear()
+        self.clock_ids.clear()
@@ -12,7 +12,8 @@ from __future__ import absolute_import
 
 __all__ = ['by_name', 'by_module', 'by_deep_hits', 'by_own_hits',
            'by_deep_time', 'by_own_time', 'by_deep_time_per_call',
-           'by_own_time_per_call']
+           'by_own_time_per_call', 'by_deep_time_p99', 'by_deep_wall_time',
+           'by_deep_wall_time_per_call']
 
 
 class SortKey(object):
@@ -50,6 +51,9 @@ by_deep_time = SortKey(lambda stat: -stat.deep_time)
 #: Sorting by exclusive elapsed time in descending order.
 by_own_time = SortKey(lambda stat: (-stat.own_time, -stat.deep_time))
 
+#: Sorting by inclusive wall-clock time in descending order.
+by_deep_wall_time = SortKey(lambda stat: -stat.deep_wall_time)
+
 
 @SortKey
 def by_deep_time_per_call(stat):
@@ -62,3 +66,20 @@ def by_own_time_per_call(stat):
     """Sorting by exclusive elapsed time per call in descending order."""
     return (-stat.own_time_per_call if stat.own_hits else -stat.own_time,
             by_deep_time_per_call(stat))
+
+
+@SortKey
+def by_deep_wall_time_per_call(stat):
+    """Sorting by inclusive wall-clock time per call in descending order."""
+    if stat.own_hits:
+        return -stat.deep_wall_time_per_call
+    return -stat.deep_wall_time
+
+
+@SortKey
+def by_deep_time_p99(stat):
+    """Sorting by 99th percentile of inclusive elapsed time per call in
+    descending order.
+    """
+    p99 = stat.deep_time_percentile(0.99)
+    return (-p99 if p99 is not None else 0, by_deep_time(stat))
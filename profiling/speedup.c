@@ -12,12 +12,14 @@ frame_stack(PyObject *self, PyObject *args)
     const PyFrameObject* base_frame;
     const PyCodeObject* base_code;
     const PySetObject* ignored_frames;
-    const PySetObject* ignored_codes;
+    // a container such as profiling.filters.CodeFilter.
+    PyObject* ignored_codes;
     if (!PyArg_ParseTuple(args, "OOOOO", &frame, &base_frame, &base_code,
                                          &ignored_frames, &ignored_codes))
     {
         return NULL;
     }
+    int ignored;
     PyObject* frame_stack = PyList_New(0);
     if (frame_stack == NULL)
     {
@@ -29,12 +31,24 @@ frame_stack(PyObject *self, PyObject *args)
         {
             break;
         }
-        if (PySet_Contains((PYOBJ)ignored_frames, (PYOBJ)frame) == 0 &&
-            PySet_Contains((PYOBJ)ignored_codes, (PYOBJ)frame->f_code) == 0)
+        ignored = PySet_Contains((PYOBJ)ignored_frames, (PYOBJ)frame);
+        if (ignored == 0)
+        {
+            ignored = PySequence_Contains(ignored_codes,
+                                          (PYOBJ)frame->f_code);
+        }
+        if (ignored < 0)
+        {
+            // The containers raised an error.
+            Py_DECREF(frame_stack);
+            return NULL;
+        }
+        if (ignored == 0)
         {
             // Not ignored.
             if (PyList_Append(frame_stack, (PyObject*)frame) == -1)
             {
+                Py_DECREF(frame_stack);
                 return NULL;
             }
         }
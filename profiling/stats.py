@@ -11,19 +11,28 @@
 """
 from __future__ import absolute_import, division
 
-from collections import deque
-import inspect
+from collections import deque, namedtuple
+import heapq
 import itertools
 
 from six import itervalues, with_metaclass
 from six.moves import zip
 
+from profiling import codes, histogram
 from profiling.sortkeys import by_deep_time
 from profiling.utils import noop
 
 
 __all__ = ['Statistics', 'RecordingStatistics', 'VoidRecordingStatistics',
-           'FrozenStatistics', 'FlatFrozenStatistics']
+           'FrozenStatistics', 'FlatFrozenStatistics', 'PseudoCode',
+           'LineStatistics', 'Exemplars']
+
+
+#: The code info of the statistics without code such as the root.
+NO_CODE_INFO = (None, None, None, None)
+
+#: The default number of the slowest calls kept as exemplars per statistics.
+EXEMPLAR_CAPACITY = 5
 
 
 class spread_t(object):
@@ -56,6 +65,26 @@ def spread_stats(stats, spreader=False):
             descendants.extend(_stats)
 
 
+def merge_line_hits(line_hits, other_line_hits):
+    """Adds the hits by line numbers of `other_line_hits` into
+    `line_hits`.
+    """
+    for lineno, hits in other_line_hits.items():
+        line_hits[lineno] = line_hits.get(lineno, 0) + hits
+
+
+def merge_exemplars(exemplars, other_exemplars):
+    """Merges two frozen lists of exemplars into a new list slowest first.
+    A frozen list doesn't know the capacity it was kept in.  So the merged
+    list is cut to :data:`EXEMPLAR_CAPACITY` or to the longest of the two if
+    it is longer.
+    """
+    capacity = max(EXEMPLAR_CAPACITY, len(exemplars), len(other_exemplars))
+    merged = list(exemplars) + list(other_exemplars)
+    merged.sort(key=by_deep_time)
+    return merged[:capacity]
+
+
 class default(object):
 
     __slots__ = ('value',)
@@ -80,8 +109,9 @@ class StatisticsMeta(type):
         except AttributeError:
             pass
         else:
-            # inherit defaults from the base classes.
-            for attr in slots:
+            # inherit defaults from the base classes.  A class which doesn't
+            # declare slots keeps all of them.
+            for attr in slots or base_defaults:
                 if attr not in defaults and attr in base_defaults:
                     defaults[attr] = base_defaults[attr]
         cls.__defaults__ = defaults
@@ -99,7 +129,8 @@ class Statistics(with_metaclass(StatisticsMeta)):
     """Statistics of a function."""
 
     __slots__ = ('name', 'filename', 'lineno', 'module',
-                 'own_hits', 'deep_time')
+                 'own_hits', 'deep_time', 'deep_wall_time', 'estimated',
+                 'histogram', 'exemplars', 'line_hits')
 
     name = default(None)
     filename = default(None)
@@ -109,6 +140,20 @@ class Statistics(with_metaclass(StatisticsMeta)):
     own_hits = default(0)
     #: The exclusive execution time.
     deep_time = default(0.0)
+    #: The inclusive wall-clock time.  It includes the time waiting for I/O
+    #: or locks unlike :attr:`deep_time`.
+    deep_wall_time = default(0.0)
+    #: Whether the execution time is estimated from a part of the calls.
+    estimated = default(False)
+    #: The latency histogram of the inclusive execution time per call.  See
+    #: :mod:`profiling.histogram`.
+    histogram = default(None)
+    #: The statistics trees of the slowest calls, slowest first.  Each tree is
+    #: rooted by a statistics of this function for the call.
+    exemplars = default(None)
+    #: The sampling hits by the line numbers which were executing in this
+    #: function.  ``None`` unless lines are sampled.
+    line_hits = default(None)
 
     def __init__(self, *args, **kwargs):
         for attr, value in zip(self.__slots__, args):
@@ -116,6 +161,11 @@ class Statistics(with_metaclass(StatisticsMeta)):
         for attr, value in kwargs.items():
             setattr(self, attr, value)
 
+    @property
+    def code_info(self):
+        """The ``(name, filename, lineno, module)`` of the function."""
+        return (self.name, self.filename, self.lineno, self.module)
+
     @property
     def regular_name(self):
         name, module = self.name, self.module
@@ -146,6 +196,13 @@ class Statistics(with_metaclass(StatisticsMeta)):
         except ZeroDivisionError:
             return 0.0
 
+    @property
+    def deep_wall_time_per_call(self):
+        try:
+            return self.deep_wall_time / self.own_hits
+        except ZeroDivisionError:
+            return 0.0
+
     @property
     def own_time_per_call(self):
         try:
@@ -153,9 +210,32 @@ class Statistics(with_metaclass(StatisticsMeta)):
         except ZeroDivisionError:
             return 0.0
 
+    def deep_time_percentile(self, ratio):
+        """Estimates the inclusive execution time per call at the given
+        ratio such as 0.99 for p99.  ``None`` if there's no histogram.
+        """
+        if self.histogram is None:
+            return None
+        return histogram.percentile(self.histogram, ratio)
+
     def sorted(self, order=by_deep_time):
         return sorted(self, key=order)
 
+    def flat(self):
+        """Makes a :class:`FlatFrozenStatistics` of this statistics."""
+        return FlatFrozenStatistics.flatten(self)
+
+    def line_stats(self):
+        """Makes a :class:`LineStatistics` for each sampled line of this
+        function.
+        """
+        if not self.line_hits:
+            return []
+        return [LineStatistics(name=self.name, filename=self.filename,
+                               lineno=lineno, module=self.module,
+                               own_hits=hits)
+                for lineno, hits in self.line_hits.items()]
+
     def __iter__(self):
         """Override it to walk statistics children."""
         return iter(())
@@ -195,43 +275,161 @@ class Statistics(with_metaclass(StatisticsMeta)):
                 ''.format(class_name, name_string, hits_string, time_string))
 
 
+class PseudoCode(namedtuple('PseudoCode', ['co_module', 'co_name'])):
+    """Stands in for the code of a function which doesn't have a code such as
+    a builtin function.  It is identified by the module name and the qualified
+    name so it is stable across function objects.
+    """
+
+    __slots__ = ()
+
+    co_filename = None
+    co_firstlineno = None
+
+
+class Exemplars(object):
+    """A bounded min-heap of the statistics trees of the slowest calls.  The
+    fastest one is dropped when it overflows so that pushing costs
+    O(log :attr:`capacity`).
+    """
+
+    __slots__ = ('capacity', '_heap')
+
+    _seq = itertools.count()
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._heap = []
+
+    def push(self, stats):
+        # the sequence number avoids comparing statistics on a tie.
+        item = (stats.deep_time, next(self._seq), stats)
+        if len(self._heap) < self.capacity:
+            heapq.heappush(self._heap, item)
+        elif self._heap and item > self._heap[0]:
+            heapq.heapreplace(self._heap, item)
+
+    def merge(self, other):
+        for __, __, stats in other._heap:
+            self.push(stats)
+
+    def __iter__(self):
+        """Iterates the statistics trees slowest first."""
+        for __, __, stats in sorted(self._heap, reverse=True):
+            yield stats
+
+    def __len__(self):
+        return len(self._heap)
+
+
 class RecordingStatistics(Statistics):
-    """Recordig statistics measures execution time of a code."""
+    """Recordig statistics measures execution time of a code.  The times are
+    accumulated in integer nanoseconds.  They are converted into seconds when
+    the statistics is frozen or read.
+    """
 
-    __slots__ = ('own_hits', 'deep_time', 'code', '_children')
+    __slots__ = ('own_hits', 'deep_time_ns', 'deep_wall_time_ns', 'estimated',
+                 'histogram', 'exemplars', 'line_hits', 'code', '_children',
+                 '_aggregates')
 
     own_hits = default(0)
-    deep_time = default(0.0)
+    deep_time_ns = default(0)
+    deep_wall_time_ns = default(0)
+    estimated = default(False)
+    histogram = default(None)
+    #: :class:`Exemplars` or ``None``.
+    exemplars = default(None)
+    line_hits = default(None)
 
     def __init__(self, code=None):
         self.code = code
         self._children = {}
+        # (deep_hits, own_time, deep_time, deep_wall_time) of the subtree or
+        # ``None`` if it is dirty.
+        self._aggregates = None
 
     @property
-    def name(self):
+    def code_info(self):
         if self.code is None:
-            return
-        name = self.code.co_name
-        if name == '<module>':
-            return
-        return name
+            return NO_CODE_INFO
+        return codes.code_info(self.code)
+
+    name = property(lambda x: x.code_info[0])
+    filename = property(lambda x: x.code_info[1])
+    lineno = property(lambda x: x.code_info[2])
+    module = property(lambda x: x.code_info[3])
 
     @property
-    def filename(self):
-        return self.code and self.code.co_filename
+    def deep_time(self):
+        return self.deep_time_ns / 1e9
+
+    @deep_time.setter
+    def deep_time(self, deep_time):
+        self.deep_time_ns = int(round(deep_time * 1e9))
 
     @property
-    def lineno(self):
-        return self.code and self.code.co_firstlineno
+    def deep_wall_time(self):
+        return self.deep_wall_time_ns / 1e9
+
+    @deep_wall_time.setter
+    def deep_wall_time(self, deep_wall_time):
+        self.deep_wall_time_ns = int(round(deep_wall_time * 1e9))
 
     @property
-    def module(self):
-        if self.code is None:
-            return
-        module = inspect.getmodule(self.code)
-        if not module:
-            return
-        return module.__name__
+    def deep_hits(self):
+        if self._aggregates is None:
+            self._aggregate()
+        return self._aggregates[0]
+
+    @property
+    def own_time(self):
+        if self._aggregates is None:
+            self._aggregate()
+        return self._aggregates[1]
+
+    def _aggregate(self):
+        """Computes the aggregates of the dirty statistics in the subtree in
+        one post-order pass.  The clean subtrees are not walked.
+        """
+        dirty, descendants = [], [self]
+        while descendants:
+            stats = descendants.pop()
+            dirty.append(stats)
+            descendants.extend(s for s in itervalues(stats._children)
+                               if s._aggregates is None)
+        for stats in reversed(dirty):
+            deep_hits, sub_time, sub_wall_time = stats.own_hits, 0, 0
+            for child_stats in itervalues(stats._children):
+                child_aggregates = child_stats._aggregates
+                deep_hits += child_aggregates[0]
+                sub_time += child_aggregates[2]
+                sub_wall_time += child_aggregates[3]
+            if isinstance(stats, VoidRecordingStatistics):
+                # an absent frame takes the times of its children.
+                deep_time, deep_wall_time = sub_time, sub_wall_time
+            else:
+                deep_time = stats.deep_time
+                deep_wall_time = stats.deep_wall_time
+            own_time = max(0., deep_time - sub_time)
+            stats._aggregates = (deep_hits, own_time, deep_time,
+                                 deep_wall_time)
+
+    def mark_dirty(self):
+        """Marks the aggregates of this statistics dirty.  The caller should
+        mark the ancestors also.
+        """
+        self._aggregates = None
+
+    def invalidate(self):
+        """Marks the aggregates of this statistics and all the descendants
+        dirty.  A profiler which doesn't mark the paths it records calls it
+        before the aggregates are read.
+        """
+        descendants = [self]
+        while descendants:
+            stats = descendants.pop()
+            stats._aggregates = None
+            descendants.extend(itervalues(stats._children))
 
     @property
     def children(self):
@@ -242,23 +440,87 @@ class RecordingStatistics(Statistics):
 
     def add_child(self, code, stats):
         self._children[code] = stats
+        self._aggregates = None
 
     def remove_child(self, code):
         del self._children[code]
+        self._aggregates = None
 
     def discard_child(self, code):
         self._children.pop(code, None)
+        self._aggregates = None
 
     def ensure_child(self, code, adding_stat_class=None):
         stats = self._children.get(code)
         if stats is None:
             stat_class = adding_stat_class or type(self)
             stats = stat_class(code)
+            # a new child has nothing to aggregate yet.
+            self._children[code] = stats
+        return stats
+
+    def fill_child(self, code):
+        """Replaces the void child of the given code with a recording
+        statistics which takes over the children.  Its times start from the
+        sums of the children.  Returns the child.
+        """
+        stats = self._children[code]
+        if isinstance(stats, VoidRecordingStatistics):
+            void_stats, stats = stats, RecordingStatistics(code)
+            stats._children = void_stats._children
+            stats.deep_time = void_stats.deep_time
+            stats.deep_wall_time = void_stats.deep_wall_time
             self.add_child(code, stats)
         return stats
 
+    def merge(self, stats):
+        """Merges the given recording statistics tree into this tree.  The
+        given tree is not modified.
+        """
+        pairs = [(self, stats)]
+        while pairs:
+            _self, _stats = pairs.pop()
+            _self._aggregates = None
+            if not isinstance(_stats, VoidRecordingStatistics):
+                _self.own_hits += _stats.own_hits
+                _self.deep_time_ns += _stats.deep_time_ns
+                _self.deep_wall_time_ns += _stats.deep_wall_time_ns
+                _self.estimated = _self.estimated or _stats.estimated
+                if _stats.histogram is not None:
+                    if _self.histogram is None:
+                        _self.histogram = histogram.make_histogram()
+                    histogram.merge(_self.histogram, _stats.histogram)
+                if _stats.exemplars is not None:
+                    if _self.exemplars is None:
+                        _self.exemplars = Exemplars(_stats.exemplars.capacity)
+                    _self.exemplars.merge(_stats.exemplars)
+                if _stats.line_hits is not None:
+                    if _self.line_hits is None:
+                        _self.line_hits = {}
+                    merge_line_hits(_self.line_hits, _stats.line_hits)
+            # the given tree may be of another kind of recording statistics.
+            for child_stats in list(_stats):
+                code = child_stats.code
+                if isinstance(child_stats, VoidRecordingStatistics):
+                    stat_class = VoidRecordingStatistics
+                else:
+                    stat_class = RecordingStatistics
+                _child_stats = _self._children.get(code)
+                if _child_stats is None:
+                    _child_stats = stat_class(code)
+                    _self.add_child(code, _child_stats)
+                elif (isinstance(_child_stats, VoidRecordingStatistics) and
+                      stat_class is not VoidRecordingStatistics):
+                    # the absent frame has been recorded in the other tree.
+                    _void_stats, _child_stats = \
+                        _child_stats, stat_class(code)
+                    _child_stats._children = _void_stats._children
+                    _self.add_child(code, _child_stats)
+                pairs.append((_child_stats, child_stats))
+
     def clear(self):
         self._children.clear()
+        self._aggregates = None
         for attr, value in self.__defaults__.items():
             setattr(self, attr, value)
 
@@ -278,29 +540,70 @@ class VoidRecordingStatistics(RecordingStatistics):
     __slots__ = ('code', '_children')
 
     own_hits = property(lambda x: 0, noop)
+    estimated = property(lambda x: False, noop)
+    histogram = property(lambda x: None, noop)
+    exemplars = property(lambda x: None, noop)
+    line_hits = property(lambda x: None, noop)
 
-    def deep_time(self):
-        times = []
-        for stats, spread in spread_stats(self, spreader=True):
-            if isinstance(stats, VoidRecordingStatistics):
-                spread()
-            else:
-                times.append(stats.deep_time)
-        return sum(times)
+    def _sum_times(self, index):
+        if self._aggregates is None:
+            self._aggregate()
+        return self._aggregates[index]
 
-    deep_time = property(deep_time, noop)
+    deep_time = property(lambda x: x._sum_times(2), noop)
+    deep_wall_time = property(lambda x: x._sum_times(3), noop)
 
 
 class FrozenStatistics(Statistics):
-    """Frozen :class:`Statistics` to serialize by Pickle."""
+    """Frozen :class:`Statistics` to serialize by Pickle.  The subtree
+    aggregates are computed once because a frozen tree doesn't change.
+    """
 
     __slots__ = ('name', 'filename', 'lineno', 'module',
-                 'own_hits', 'deep_time', 'children')
+                 'own_hits', 'deep_time', 'deep_wall_time', 'estimated',
+                 'histogram', 'exemplars', 'line_hits', 'children',
+                 '_deep_hits', '_own_time')
 
     def __init__(self, *args, **kwargs):
         super(FrozenStatistics, self).__init__(*args, **kwargs)
         if not hasattr(self, 'children'):
             self.children = []
+        self._deep_hits = self._own_time = None
+
+    @property
+    def deep_hits(self):
+        if self._deep_hits is None:
+            self._aggregate()
+        return self._deep_hits
+
+    @property
+    def own_time(self):
+        if self._own_time is None:
+            self._aggregate()
+        return self._own_time
+
+    def _aggregate(self):
+        """Computes the aggregates of the statistics in the subtree which
+        have not been aggregated in one post-order pass.
+        """
+        pending, descendants = [], [self]
+        while descendants:
+            stats = descendants.pop()
+            pending.append(stats)
+            descendants.extend(s for s in stats.children
+                               if isinstance(s, FrozenStatistics) and
+                               s._deep_hits is None)
+        for stats in reversed(pending):
+            stats._aggregate_children()
+
+    def _aggregate_children(self):
+        """Computes the aggregates from the aggregated children."""
+        deep_hits, sub_time = self.own_hits, 0.0
+        for stats in self.children:
+            deep_hits += stats.deep_hits
+            sub_time += stats.deep_time
+        self._deep_hits = deep_hits
+        self._own_time = max(0., self.deep_time - sub_time)
 
     def __iter__(self):
         return iter(self.children)
@@ -309,19 +612,44 @@ class FrozenStatistics(Statistics):
         return len(self.children)
 
 
+class LineStatistics(FrozenStatistics):
+    """The sampling hits of a line in a function.  :attr:`lineno` is the
+    line number of the line rather than of the function.
+    """
+
+    __slots__ = ()
+
+    def __hash__(self):
+        return hash((LineStatistics, self.filename, self.lineno))
+
+
 def make_frozen_stats_tree(stats):
     """Makes a flat members tree of the given statistics.  The statistics can
     be restored by :func:`frozen_stats_from_tree`.
+
+    The members start with the code info.  The same code info is shared by
+    the statistics of a function so that Pickle writes it once.
     """
     tree, stats_tree = [], [(None, stats)]
+    code_infos = {}
     for x in itertools.count():
         try:
             parent_offset, _stats = stats_tree[x]
         except IndexError:
             break
         stats_tree.extend((x, s) for s in _stats)
-        members = (_stats.name, _stats.filename, _stats.lineno,
-                   _stats.module, _stats.own_hits, _stats.deep_time)
+        exemplars = _stats.exemplars
+        if exemplars is not None:
+            exemplars = [frozen_stats_from_tree(make_frozen_stats_tree(s))
+                         for s in exemplars]
+        line_hits = _stats.line_hits
+        if line_hits is not None:
+            line_hits = dict(line_hits)
+        code_info = _stats.code_info
+        code_info = code_infos.setdefault(code_info, code_info)
+        members = (code_info, _stats.own_hits, _stats.deep_time,
+                   _stats.deep_wall_time, _stats.estimated, _stats.histogram,
+                   exemplars, line_hits)
         tree.append((parent_offset, members))
     return tree
 
@@ -334,10 +662,17 @@ def frozen_stats_from_tree(tree):
         raise ValueError('Empty tree')
     stats_index = []
     for parent_offset, members in tree:
+        if isinstance(members[0], tuple):
+            # the interned code info is flattened.  the older trees have it
+            # flat already.
+            members = members[0] + members[1:]
         stats = FrozenStatistics(*members)
         stats_index.append(stats)
         if parent_offset is not None:
             stats_index[parent_offset].children.append(stats)
+    # the children always follow the parent in the tree.
+    for stats in reversed(stats_index):
+        stats._aggregate_children()
     return stats_index[0]
 
 
@@ -345,29 +680,64 @@ class FlatFrozenStatistics(FrozenStatistics):
 
     __slots__ = ('name', 'filename', 'lineno', 'module',
                  'own_hits', 'deep_hits', 'own_time', 'deep_time',
-                 'children')
+                 'deep_wall_time', 'estimated', 'histogram', 'exemplars',
+                 'line_hits', 'children')
 
     own_hits = default(0)
     deep_hits = default(0)
     own_time = default(0.0)
     deep_time = default(0.0)
+    deep_wall_time = default(0.0)
+    estimated = default(False)
+    histogram = default(None)
+    exemplars = default(None)
+    line_hits = default(None)
     children = default(())
 
     @classmethod
     def flatten(cls, stats):
-        """Makes a flat statistics from the given statistics."""
+        """Makes a flat statistics from the given statistics.  The inclusive
+        hits and time of a recursive function count only the outermost
+        statistics on each path not to count the same time several times.
+        """
         flat_children = {}
-        for _stats in spread_stats(stats):
-            key = (_stats.name, _stats.filename, _stats.lineno, _stats.module)
+        # the number of the statistics on the current path by keys.
+        active = {}
+        descendants = [(_stats, True) for _stats in stats]
+        while descendants:
+            _stats, entering = descendants.pop()
+            key = _stats.code_info
+            if not entering:
+                active[key] -= 1
+                continue
             try:
                 flat_stats = flat_children[key]
             except KeyError:
                 flat_stats = flat_children[key] = cls(*key)
             flat_stats.own_hits += _stats.own_hits
-            flat_stats.deep_hits += _stats.deep_hits
             flat_stats.own_time += _stats.own_time
-            flat_stats.deep_time += _stats.deep_time
+            if not active.get(key):
+                flat_stats.deep_hits += _stats.deep_hits
+                flat_stats.deep_time += _stats.deep_time
+                flat_stats.deep_wall_time += _stats.deep_wall_time
+            active[key] = active.get(key, 0) + 1
+            descendants.append((_stats, False))
+            descendants.extend((s, True) for s in _stats)
+            flat_stats.estimated = flat_stats.estimated or _stats.estimated
+            if _stats.histogram is not None:
+                if flat_stats.histogram is None:
+                    flat_stats.histogram = histogram.make_histogram()
+                histogram.merge(flat_stats.histogram, _stats.histogram)
+            if _stats.exemplars is not None:
+                flat_stats.exemplars = merge_exemplars(
+                    flat_stats.exemplars or (), _stats.exemplars)
+            if _stats.line_hits is not None:
+                if flat_stats.line_hits is None:
+                    flat_stats.line_hits = {}
+                merge_line_hits(flat_stats.line_hits, _stats.line_hits)
         children = list(itervalues(flat_children))
         return cls(stats.name, stats.filename, stats.lineno, stats.module,
                    stats.own_hits, stats.deep_hits, stats.own_time,
-                   stats.deep_time, children)
+                   stats.deep_time, stats.deep_wall_time, stats.estimated,
+                   stats.histogram, stats.exemplars, stats.line_hits,
+                   children)
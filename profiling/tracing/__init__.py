@@ -3,30 +3,75 @@
    profiling.tracing
    ~~~~~~~~~~~~~~~~~
 
-   Profiles deterministically by :func:`sys.setprofile`.
+   Profiles deterministically by :func:`sys.setprofile` or
+   :mod:`sys.monitoring` (PEP 669).
 
    :copyright: (c) 2014-2017, What! Studio
    :license: BSD, see LICENSE for more details.
 
 """
-from __future__ import absolute_import
+from __future__ import absolute_import, division
 
 import sys
 import threading
+import types
 
-from profiling import sortkeys
+import six.moves._thread as _thread
+
+from profiling import histogram, sortkeys
 from profiling.profiler import Profiler
 from profiling.stats import (
-    RecordingStatistics, VoidRecordingStatistics as void)
-from profiling.tracing.timers import Timer
+    EXEMPLAR_CAPACITY, Exemplars, PseudoCode, RecordingStatistics,
+    VoidRecordingStatistics as void)
+from profiling.tracing.timers import perf_counter_ns, ThreadTimer, Timer
 from profiling.utils import deferral
 from profiling.viewer import fmt, StatisticsTable
 
 
-__all__ = ['TracingProfiler', 'TracingStatisticsTable']
+__all__ = ['TracingProfiler', 'TracingStatisticsTable', 'calibrate']
+
+
+if sys.version_info < (3, 3):
+    # ThreadTimer requires Yappi on earlier Python versions.
+    TIMER_CLASS = Timer
+else:
+    TIMER_CLASS = ThreadTimer
+
+
+#: The available names of tracing backends.  ``'monitoring'`` requires Python
+#: 3.12 or later.
+BACKENDS = ['setprofile', 'monitoring']
+BACKEND = 'setprofile'
+
 
+#: The types of C functions which emit ``c_call`` events.
+C_FUNCTION_TYPES = (types.BuiltinFunctionType, type(list.append))
 
-TIMER_CLASS = Timer
+
+def c_function_code(func):
+    """Makes a :class:`profiling.stats.PseudoCode` for the given C function.
+    """
+    name = getattr(func, '__qualname__', None) or func.__name__
+    module = getattr(func, '__module__', None)
+    if module is None:
+        owner = getattr(func, '__self__', None)
+        if owner is None or isinstance(owner, types.ModuleType):
+            owner = getattr(func, '__objclass__', None)
+        elif not isinstance(owner, type):
+            owner = type(owner)
+        if isinstance(owner, types.ModuleType):
+            module = owner.__name__
+        elif owner is not None:
+            module = owner.__module__
+            if '.' not in name:
+                # Python 2 doesn't have __qualname__.
+                name = '.'.join([owner.__name__, name])
+    return PseudoCode(module, name)
+
+
+def is_c_entry(entry):
+    """Whether the shadow stack entry is of a C function call."""
+    return entry[2] is not None and type(entry[2].code) is PseudoCode
 
 
 class TracingStatisticsTable(StatisticsTable):
@@ -40,107 +85,724 @@ class TracingStatisticsTable(StatisticsTable):
         ('DEEP', 'right', (6,), sortkeys.by_deep_time),
         ('/CALL', 'right', (6,), sortkeys.by_deep_time_per_call),
         ('%', 'left', (4,), None),
+        ('WALL', 'right', (6,), sortkeys.by_deep_wall_time),
+        ('/CALL', 'right', (6,), sortkeys.by_deep_wall_time_per_call),
+        ('P50', 'right', (6,), None),
+        ('P95', 'right', (6,), None),
+        ('P99', 'right', (6,), sortkeys.by_deep_time_p99),
     ]
     order = sortkeys.by_deep_time
 
     def make_cells(self, node, stats):
+        if stats.estimated:
+            make_time_text = fmt.make_estimated_time_text
+        else:
+            make_time_text = fmt.make_time_text
         yield fmt.make_stat_text(stats)
         yield fmt.make_int_or_na_text(stats.own_hits)
-        yield fmt.make_time_text(stats.own_time)
-        yield fmt.make_time_text(stats.own_time_per_call)
+        yield make_time_text(stats.own_time)
+        yield make_time_text(stats.own_time_per_call)
         yield fmt.make_percent_text(stats.own_time, self.cpu_time)
-        yield fmt.make_time_text(stats.deep_time)
-        yield fmt.make_time_text(stats.deep_time_per_call)
+        yield make_time_text(stats.deep_time)
+        yield make_time_text(stats.deep_time_per_call)
         yield fmt.make_percent_text(stats.deep_time, self.cpu_time)
+        yield make_time_text(stats.deep_wall_time)
+        yield make_time_text(stats.deep_wall_time_per_call)
+        for ratio in [0.5, 0.95, 0.99]:
+            percentile = stats.deep_time_percentile(ratio)
+            yield fmt.make_time_or_na_text(percentile)
+
+
+class ShadowStack(object):
+    """The per-thread recording state.  It keeps the stack of the frames which
+    are being traced.  Each entry is a tuple of ``(frame, scope, stats,
+    time_entered, scale, wall_time_entered)``:
+
+    - `scope` is the statistics under which the children are recorded.  It
+      is a fresh statistics tree if the call is captured as an exemplar.
+    - `stats` is the statistics which takes the elapsed time.  It is ``None``
+      if the frame was entered before the profiler noticed.
+    - `time_entered` is ``None`` if the call is not timed.
+    - `scale` multiplies the elapsed time.  See :class:`HotCodeWatch`.
+    - `wall_time_entered` is by :attr:`TracingProfiler.wall_clock`.  It is
+      ``None`` if the call is not timed.
+
+    The times are in integer nanoseconds.
+
+    """
+
+    __slots__ = ('entries', 'detached', 'stats', 'overhead', 'watches',
+                 'active')
+
+    def __init__(self, stats):
+        self.entries = []
+        #: Timed entries which have been dropped from :attr:`entries` by
+        #: resynchronization.  They are still waiting for their return events.
+        self.detached = {}
+        #: The root statistics only for the thread.
+        self.stats = stats
+        #: The profiling overhead in the thread in nanoseconds.
+        self.overhead = 0
+        #: :class:`HotCodeWatch` objects by codes.
+        self.watches = {}
+        #: The outermost recorded entries by codes on the stack.  It is
+        #: maintained only if the recursion is collapsed.
+        self.active = {}
+
+
+class HotCodeWatch(object):
+    """Watches the calls of a code in a thread to decide whether to stop
+    timing it.  Timing a tiny function called so often costs far more than
+    running it.  Once the code is found to be hot and cheap, only 1 of
+    :attr:`interval` calls is timed and the elapsed time is scaled up by
+    :attr:`interval`.  If :attr:`interval` is 0, the calls are just counted.
+    """
+
+    __slots__ = ('calls', 'time', 'started', 'interval')
+
+    def __init__(self):
+        #: The number of calls in the current window.
+        self.calls = 0
+        #: The elapsed time of the timed calls in the current window in
+        #: nanoseconds.
+        self.time = 0
+        #: The CPU time when the current window started in nanoseconds.
+        #: ``None`` until a call of the window is timed.
+        self.started = None
+        #: ``None`` until the code is de-instrumented.
+        self.interval = None
 
 
 class TracingProfiler(Profiler):
-    """The tracing profiler."""
+    """The tracing profiler.  Each thread records into its own statistics tree
+    with its own overhead so that threads don't share any mutable state while
+    tracing.  The trees are merged into :attr:`stats` when the profiler stops.
+    While profiling, :attr:`stats` has only the calls in the thread which
+    started the profiler and :meth:`result` merges all of them.
+    """
 
     table_class = TracingStatisticsTable
 
-    #: The CPU timer.  Usually it is an instance of :class:`profiling.tracing.
-    #: timers.Timer`.
+    #: The CPU timer in nanoseconds.  Usually it is an instance of
+    #: :class:`profiling.tracing.timers.Timer`.
     timer = None
 
-    #: The CPU time of profiling overhead.  It's the time spent in
-    #: :meth:`_profile`.
-    overhead = 0.0
+    #: The name of the tracing backend.  One of :data:`BACKENDS`.
+    backend = BACKEND
+
+    #: The clock to measure the wall time of each call along with
+    #: :attr:`timer` in nanoseconds.
+    wall_clock = staticmethod(perf_counter_ns)
+
+    #: The CPU time which a profiling event costs.  See :func:`calibrate`.
+    #: ``None`` until it is calibrated when the profiler starts.
+    bias = None
+
+    #: :attr:`bias` in integer nanoseconds.
+    _bias_ns = 0
+
+    #: If it is set, a code whose mean CPU time per call is shorter than it
+    #: stops being timed.  See :class:`HotCodeWatch`.
+    hot_threshold = None
+
+    #: The number of calls to watch before deciding whether a code is hot.
+    hot_calls = 1000
+
+    #: The call rate per CPU second of the thread above which a code is hot.
+    #: The rate is measured over the window of :attr:`hot_calls`.
+    hot_rate = 1000
+
+    #: 1 of how many calls of a hot code to time.  0 means to only count.
+    hot_interval = 100
+
+    #: Whether to record C function calls such as builtin functions.
+    trace_c_calls = False
+
+    #: Whether to record a latency histogram per statistics.
+    histograms = False
+
+    #: The functions to capture the slowest calls of.  Each target is a code
+    #: or a (qualified) name of functions.
+    exemplar_targets = ()
+
+    #: The number of the slowest calls to keep per statistics.
+    exemplars = EXEMPLAR_CAPACITY
+
+    #: Whether to record a recursive call into the outermost call of the
+    #: function on the stack instead of a new child statistics.  Only the
+    #: outermost call is timed like primitive calls of :mod:`cProfile`.
+    collapse_recursion = False
 
     def __init__(self, base_frame=None, base_code=None,
-                 ignored_frames=(), ignored_codes=(), timer=None):
+                 ignored_frames=(), ignored_codes=(), timer=None, bias=None,
+                 backend=None, hot_threshold=None, hot_calls=None,
+                 hot_rate=None, hot_interval=None, trace_c_calls=False,
+                 histograms=False,
+                 exemplar_targets=(), exemplars=None,
+                 collapse_recursion=False, compact=False):
         timer = timer or TIMER_CLASS()
         if not isinstance(timer, Timer):
             raise TypeError('Not a timer instance')
+        backend = backend or BACKEND
+        if backend not in BACKENDS:
+            raise ValueError('Unknown tracing backend: %r' % backend)
+        if backend == 'monitoring' and not hasattr(sys, 'monitoring'):
+            raise RuntimeError('sys.monitoring requires Python 3.12 or later')
         base = super(TracingProfiler, self)
-        base.__init__(base_frame, base_code, ignored_frames, ignored_codes)
+        base.__init__(base_frame, base_code, ignored_frames, ignored_codes,
+                      compact)
         self.timer = timer
-        self._times_entered = {}
+        self.backend = backend
+        self.bias = bias
+        if bias is not None:
+            self._bias_ns = int(round(bias * 1e9))
+        self.hot_threshold = hot_threshold
+        if hot_calls is not None:
+            self.hot_calls = hot_calls
+        if hot_rate is not None:
+            self.hot_rate = hot_rate
+        if hot_interval is not None:
+            self.hot_interval = hot_interval
+        self.trace_c_calls = trace_c_calls
+        self.histograms = histograms
+        self.exemplar_targets = tuple(exemplar_targets)
+        if exemplars is not None:
+            self.exemplars = exemplars
+        self.collapse_recursion = collapse_recursion
+        #: Whether each code is an exemplar target.
+        self._exemplar_codes = {}
+        #: The pseudo codes by C function objects or ``(type, name)`` of
+        #: bound methods.
+        self._c_codes = {}
+        self._reset_shadows()
+
+    @property
+    def overhead(self):
+        """The CPU time of profiling overhead.  It's estimated by the number
+        of the profiling events and :attr:`bias`.
+        """
+        return sum(shadow.overhead for shadow in self._shadows) / 1e9
+
+    def _reset_shadows(self):
+        self._local = threading.local()
+        self._shadows = []
+        # the thread which starts the profiler records into `self.stats`
+        # directly.
+        self._home_thread_id = _thread.get_ident()
+
+    def _new_shadow(self):
+        """Makes the shadow stack for the current thread."""
+        if _thread.get_ident() == self._home_thread_id:
+            stats = self.stats
+        else:
+            stats = type(self.stats)()
+        shadow = self._local.shadow = ShadowStack(stats)
+        self._shadows.append(shadow)
+        return shadow
 
     def _profile(self, frame, event, arg):
         """The callback function to register by :func:`sys.setprofile`."""
-        # c = event.startswith('c_')
-        if event.startswith('c_'):
+        c = event.startswith('c_')
+        if c and not self.trace_c_calls:
+            return
+        try:
+            shadow = self._local.shadow
+        except AttributeError:
+            shadow = self._new_shadow()
+        # each event costs the calibrated bias.  every recorded time excludes
+        # the overhead accumulated so far.
+        shadow.overhead += self._bias_ns
+        if frame in self.ignored_frames or frame.f_code in self.ignored_codes:
+            # ignored frames are transparent.  their children are recorded
+            # under the closest traced ancestor.
+            return
+        if c:
+            self._profile_c(shadow, frame, event, arg)
             return
-        time1 = self.timer()
-        frames = self.frame_stack(frame)
-        if frames:
-            frames.pop()
-        parent_stats = self.stats
-        for f in frames:
-            parent_stats = parent_stats.ensure_child(f.f_code, void)
-        code = frame.f_code
-        frame_key = id(frame)
-        # if c:
-        #     event = event[2:]
-        #     code = mock_code(arg.__name__)
-        #     frame_key = id(arg)
         # record
-        time2 = self.timer()
-        self.overhead += time2 - time1
         if event == 'call':
-            time = time2 - self.overhead
-            self.record_entering(time, code, frame_key, parent_stats)
+            if self.collapse_recursion:
+                outer_entry = shadow.active.get(frame.f_code)
+                if outer_entry is not None and not self._is_base(frame):
+                    entry = self.record_recursion(frame, outer_entry)
+                    self._mark_dirty(shadow, entry[2], outer_entry)
+                    shadow.entries.append(entry)
+                    return
+            if self.hot_threshold is None:
+                scale = 1
+            else:
+                scale = self._watch(shadow, frame.f_code)
+            if scale:
+                time = self.timer() - shadow.overhead
+                wall_time = self.wall_clock() - shadow.overhead
+            else:
+                time = wall_time = None
+            if self._is_base(frame):
+                parent_stats = shadow.stats
+            else:
+                parent_stats = self._scope(shadow, frame.f_back)
+            entry = self.record_entering(time, frame, parent_stats, scale,
+                                         wall_time)
+            self._mark_dirty(shadow, entry[2])
+            shadow.entries.append(entry)
+            if self.collapse_recursion and not self._is_base(frame):
+                shadow.active[frame.f_code] = entry
         elif event == 'return':
-            time = time1 - self.overhead
-            self.record_leaving(time, code, frame_key, parent_stats)
-        time3 = self.timer()
-        self.overhead += time3 - time2
+            entry = self._pop(shadow, frame)
+            if self.trace_c_calls:
+                # c_return of the frame might be missed.
+                while entry is not None and is_c_entry(entry):
+                    entry = self._pop(shadow, frame)
+            if self.collapse_recursion and entry is not None:
+                if shadow.active.get(frame.f_code) is entry:
+                    del shadow.active[frame.f_code]
+            if entry is not None and entry[3] is not None:
+                time = self.timer() - shadow.overhead
+                wall_time = self.wall_clock() - shadow.overhead
+                self.record_leaving(time, entry, wall_time)
+                self._mark_dirty(shadow, entry[2])
+                if entry[4] == 1 and self.hot_threshold is not None:
+                    self._observe(shadow, entry[2], time, time - entry[3])
+
+    def _profile_c(self, shadow, frame, event, func):
+        """Records a C function call.  `frame` is of the caller.  The entry
+        of a C function call has the frame of the caller too so that Python
+        functions called back by the C function are nested in it.
+        """
+        if event == 'c_call':
+            # the pseudo codes are cached by the function objects.  But a
+            # bound method is a new object on each call.  So it is cached by
+            # the type of the instance and the name, which also doesn't keep
+            # the instance alive.
+            owner = getattr(func, '__self__', None)
+            if owner is None or isinstance(owner, (types.ModuleType, type)):
+                key = func
+            else:
+                key = (type(owner), func.__name__)
+            try:
+                code = self._c_codes[key]
+            except KeyError:
+                code = self._c_codes[key] = c_function_code(func)
+            time = self.timer() - shadow.overhead
+            wall_time = self.wall_clock() - shadow.overhead
+            parent_stats = self._scope(shadow, frame)
+            stats = parent_stats.ensure_child(code, RecordingStatistics)
+            stats.own_hits += 1
+            self._mark_dirty(shadow, stats)
+            shadow.entries.append((frame, stats, stats, time, 1, wall_time))
+            return
+        # c_return or c_exception.
+        entries = shadow.entries
+        if entries and entries[-1][0] is frame and is_c_entry(entries[-1]):
+            entry = entries.pop()
+            time = self.timer() - shadow.overhead
+            wall_time = self.wall_clock() - shadow.overhead
+            self.record_leaving(time, entry, wall_time)
+            self._mark_dirty(shadow, entry[2])
 
-    def record_entering(self, time, code, frame_key, parent_stats):
-        """Entered to a function call."""
+    def _is_exemplar_target(self, code):
+        """Whether the calls of the code should be captured as exemplars.
+        It is cached by the code.
+        """
+        try:
+            return self._exemplar_codes[code]
+        except KeyError:
+            pass
+        names = set([code.co_name, getattr(code, 'co_qualname', None)])
+        for target in self.exemplar_targets:
+            if target is code or target in names:
+                is_target = True
+                break
+        else:
+            is_target = False
+        self._exemplar_codes[code] = is_target
+        return is_target
+
+    def _watch(self, shadow, code):
+        """Counts a call of the given code.  Returns the scale of the call:
+        1 if it is timed as usual, 0 if it is not timed.
+        """
+        try:
+            watch = shadow.watches[code]
+        except KeyError:
+            watch = shadow.watches[code] = HotCodeWatch()
+        watch.calls += 1
+        interval = watch.interval
+        if interval is None:
+            return 1
+        elif interval and watch.calls % interval == 0:
+            return interval
+        return 0
+
+    def _observe(self, shadow, stats, time, time_elapsed):
+        """Observes a timed call of a watched code which returned at `time`.
+        A window ends after :attr:`hot_calls` calls.  The code is
+        de-instrumented if it was called faster than :attr:`hot_rate` in the
+        window and the mean time per call is shorter than
+        :attr:`hot_threshold`.
+        """
+        watch = shadow.watches.get(stats.code)
+        if watch is None or watch.interval is not None:
+            return
+        watch.time += max(0, time_elapsed)
+        if watch.started is None:
+            watch.started = time - time_elapsed
+        if watch.calls < self.hot_calls:
+            return
+        window = time - watch.started
+        if (watch.time < self.hot_threshold * 1e9 * watch.calls and
+                watch.calls * 1e9 >= self.hot_rate * window):
+            watch.interval = self.hot_interval
+            stats.estimated = True
+        else:
+            # start the next window.
+            watch.calls, watch.time, watch.started = 0, 0, None
+
+    # sys.monitoring callbacks.  The monitored frame is the caller of the
+    # callback.  Returning DISABLE for an ignored code turns off the event at
+    # the location so that the code costs nothing after the first call.
+
+    def _monitor_call(self, code, offset, *args):
+        """The callback for ``PY_START`` and ``PY_RESUME``."""
+        if code in self.ignored_codes:
+            return sys.monitoring.DISABLE
+        self._profile(sys._getframe(1), 'call', None)
+
+    def _monitor_return(self, code, offset, *args):
+        """The callback for ``PY_RETURN`` and ``PY_YIELD``."""
+        if code in self.ignored_codes:
+            return sys.monitoring.DISABLE
+        self._profile(sys._getframe(1), 'return', None)
+
+    def _monitor_throw(self, code, offset, exc):
+        """The callback for ``PY_THROW``.  It cannot be disabled."""
+        self._profile(sys._getframe(1), 'call', None)
+
+    def _monitor_unwind(self, code, offset, exc):
+        """The callback for ``PY_UNWIND``.  It cannot be disabled."""
+        self._profile(sys._getframe(1), 'return', None)
+
+    def _monitor_c_call(self, code, offset, func, arg0):
+        """The callback for ``CALL``.  Only C functions are recorded."""
+        if isinstance(func, C_FUNCTION_TYPES):
+            self._profile(sys._getframe(1), 'c_call', func)
+
+    def _monitor_c_return(self, code, offset, func, arg0):
+        """The callback for ``C_RETURN`` and ``C_RAISE``."""
+        if isinstance(func, C_FUNCTION_TYPES):
+            self._profile(sys._getframe(1), 'c_return', func)
+
+    def _mark_dirty(self, shadow, stats, outer_entry=None):
+        """Marks the aggregates of the recorded statistics and its ancestors
+        dirty so that they are not stale while profiling.  The ancestors are
+        the scopes on the shadow stack.  The ancestors of a dirty statistics
+        are kept dirty so that it stops at the first dirty scope.  It costs
+        O(1) unless the aggregates have been read.
+
+        `outer_entry` is the entry of `stats` on the shadow stack if it is
+        recorded as a recursive call.
+        """
+        entries = shadow.entries
+        if outer_entry is not None and outer_entry[1] is not stats:
+            # the scope of an exemplar target is not in the tree.  the
+            # ancestors are under the entry.
+            for x in range(len(entries) - 1, -1, -1):
+                if entries[x] is outer_entry:
+                    entries = entries[:x]
+                    break
+        for entry in reversed(entries):
+            scope = entry[1]
+            if scope._aggregates is None:
+                break
+            scope._aggregates = None
+        else:
+            shadow.stats._aggregates = None
+        stats._aggregates = None
+
+    def _is_base(self, frame):
+        return frame is self.base_frame or frame.f_code is self.base_code
+
+    def _scope(self, shadow, frame):
+        """Finds the statistics under which a callee of the given frame should
+        be recorded.  It costs O(1) unless the shadow stack is out of sync.
+        """
+        entries = shadow.entries
+        if entries and entries[-1][0] is frame:
+            return entries[-1][1]
+        while frame is not None:
+            if self._is_base(frame):
+                break
+            if (frame not in self.ignored_frames and
+                    frame.f_code not in self.ignored_codes):
+                break
+            frame = frame.f_back
+        if frame is None or self._is_base(frame):
+            if not entries:
+                return shadow.stats
+        elif entries and entries[-1][0] is frame:
+            return entries[-1][1]
+        return self._resync(shadow, frame)
+
+    def _resync(self, shadow, frame):
+        """Rebuilds the shadow stack by walking the frame stack.  Entries of
+        the frames which are still on the frame stack are reused.
+        """
+        reusable = shadow.detached
+        for entry in shadow.entries:
+            if is_c_entry(entry):
+                # C function calls share the frame with the caller.
+                continue
+            reusable[id(entry[0])] = entry
+        entries = []
+        scope = shadow.stats
+        for f in self.frame_stack(frame):
+            entry = reusable.pop(id(f), None)
+            if entry is None or entry[0] is not f:
+                scope = scope.ensure_child(f.f_code, void)
+                entry = (f, scope, None, None, 1, None)
+            else:
+                scope = entry[1]
+            entries.append(entry)
+        # keep only timed entries as detached.
+        for key, entry in list(reusable.items()):
+            if entry[2] is None:
+                del reusable[key]
+        shadow.entries = entries
+        # the new scopes may be under clean ancestors.
+        shadow.stats.mark_dirty()
+        for entry in entries:
+            entry[1].mark_dirty()
+        if self.collapse_recursion:
+            self._reactivate(shadow)
+        return scope
+
+    def _reactivate(self, shadow):
+        """Rebuilds :attr:`ShadowStack.active` from the shadow stack."""
+        shadow.active.clear()
+        for entry in shadow.entries:
+            frame, __, stats = entry[:3]
+            if stats is None or is_c_entry(entry) or self._is_base(frame):
+                continue
+            shadow.active.setdefault(frame.f_code, entry)
+
+    def _pop(self, shadow, frame):
+        """Pops the entry of the given frame from the shadow stack."""
+        entries = shadow.entries
+        if entries and entries[-1][0] is frame:
+            return entries.pop()
+        # out of sync.
+        for x in range(len(entries) - 1, -1, -1):
+            if entries[x][0] is frame:
+                entry = entries[x]
+                del entries[x:]
+                if self.collapse_recursion:
+                    self._reactivate(shadow)
+                return entry
+        entry = shadow.detached.pop(id(frame), None)
+        if entry is not None and entry[0] is frame:
+            # the ancestors of a detached entry are unknown.  it is rare.
+            shadow.stats.invalidate()
+            return entry
+
+    def record_entering(self, time, frame, parent_stats, scale=1,
+                        wall_time=None):
+        """Entered to a function call.  Returns an entry for the shadow stack.
+        """
+        code = frame.f_code
         stats = parent_stats.ensure_child(code, RecordingStatistics)
-        self._times_entered[(code, frame_key)] = time
         stats.own_hits += 1
+        if scale != 1:
+            # the code has been de-instrumented.
+            stats.estimated = True
+        # the base frame is recorded but its children are not nested in it.
+        if self._is_base(frame):
+            scope = parent_stats
+        elif (self.exemplar_targets and scale == 1 and
+              self._is_exemplar_target(code)):
+            # record the children into a fresh tree for the call.  it will be
+            # merged into `stats` when the call returns.
+            scope = RecordingStatistics(code)
+        else:
+            scope = stats
+        return (frame, scope, stats, time, scale, wall_time)
+
+    def record_recursion(self, frame, outer_entry):
+        """Entered to a recursive function call.  It is counted in the
+        statistics of the outermost call but not timed.  Returns an entry for
+        the shadow stack.
+        """
+        __, scope, stats = outer_entry[:3]
+        stats.own_hits += 1
+        return (frame, scope, stats, None, 1, None)
 
-    def record_leaving(self, time, code, frame_key, parent_stats):
+    def record_leaving(self, time, entry, wall_time=None):
         """Left from a function call."""
-        try:
-            stats = parent_stats.get_child(code)
-            time_entered = self._times_entered.pop((code, frame_key))
-        except KeyError:
+        __, __, stats, time_entered, scale, wall_time_entered = entry
+        if stats is None or time_entered is None:
+            # entered before profiling or not timed.
             return
-        time_elapsed = time - time_entered
-        stats.deep_time += max(0, time_elapsed)
+        time_elapsed = max(0, time - time_entered)
+        stats.deep_time_ns += time_elapsed * scale
+        if wall_time is None or wall_time_entered is None:
+            wall_time_elapsed = 0
+        else:
+            wall_time_elapsed = max(0, wall_time - wall_time_entered)
+        stats.deep_wall_time_ns += wall_time_elapsed * scale
+        if self.histograms:
+            if stats.histogram is None:
+                stats.histogram = histogram.make_histogram()
+            histogram.record(stats.histogram, time_elapsed / 1e9, scale)
+        frame, scope = entry[:2]
+        if (scope is not stats and scope.code is stats.code and
+                not self._is_base(frame)):
+            self.record_exemplar(time_elapsed, stats, scope,
+                                 wall_time_elapsed)
+
+    def record_exemplar(self, time_elapsed, stats, exemplar_stats,
+                        wall_time_elapsed=0):
+        """Merges the statistics tree of a call into the statistics and keeps
+        the tree if the call is one of the slowest.
+        """
+        stats.merge(exemplar_stats)
+        exemplar_stats.own_hits = 1
+        exemplar_stats.deep_time_ns = time_elapsed
+        exemplar_stats.deep_wall_time_ns = wall_time_elapsed
+        if stats.exemplars is None:
+            stats.exemplars = Exemplars(self.exemplars)
+        stats.exemplars.push(exemplar_stats)
+
+    def merge_thread_stats(self, stats=None):
+        """Merges the statistics trees of the other threads into the given
+        statistics.  If it is omitted, they are merged into :attr:`stats`.
+        """
+        if stats is None:
+            stats = self.stats
+        for shadow in self._shadows:
+            if shadow.stats is not self.stats:
+                stats.merge(shadow.stats)
+        return stats
 
     def result(self):
         base = super(TracingProfiler, self)
         frozen_stats, cpu_time, wall_time = base.result()
+        if self.is_running():
+            # merge into a temporary tree not to disturb the threads.
+            frozen_stats = type(self.stats)()
+            frozen_stats.merge(self.stats)
+            self.merge_thread_stats(frozen_stats)
         return (frozen_stats, cpu_time - self.overhead, wall_time)
 
-    def run(self):
+    def meta(self):
+        meta = super(TracingProfiler, self).meta()
+        meta.update(timer=type(self.timer).__name__, bias=self.bias,
+                    backend=self.backend, hot_threshold=self.hot_threshold)
+        return meta
+
+    def _install(self, defer, all_threads=True):
+        """Registers the callbacks of :attr:`backend`.  They are unregistered
+        by the given deferral.
+        """
+        if self.backend == 'monitoring':
+            self._install_monitoring(defer)
+            return
         if sys.getprofile() is not None:
             # NOTE: There's no threading.getprofile().
             # The profiling function will be stored at threading._profile_hook
             # but it's not documented.
             raise RuntimeError('Another profiler already registered')
-        with deferral() as defer:
-            self._times_entered.clear()
-            self.overhead = 0.0
-            sys.setprofile(self._profile)
-            defer(sys.setprofile, None)
+        sys.setprofile(self._profile)
+        defer(sys.setprofile, None)
+        if all_threads:
             threading.setprofile(self._profile)
             defer(threading.setprofile, None)
+
+    def _install_monitoring(self, defer):
+        # the events are global for all threads.
+        monitoring = sys.monitoring
+        tool_id = monitoring.PROFILER_ID
+        try:
+            monitoring.use_tool_id(tool_id, 'profiling')
+        except ValueError:
+            raise RuntimeError('Another profiler already registered')
+        defer(monitoring.free_tool_id, tool_id)
+        E = monitoring.events
+        callbacks = [(E.PY_START, self._monitor_call),
+                     (E.PY_RESUME, self._monitor_call),
+                     (E.PY_THROW, self._monitor_throw),
+                     (E.PY_RETURN, self._monitor_return),
+                     (E.PY_YIELD, self._monitor_return),
+                     (E.PY_UNWIND, self._monitor_unwind)]
+        if self.trace_c_calls:
+            callbacks.extend([(E.CALL, self._monitor_c_call),
+                              (E.C_RETURN, self._monitor_c_return),
+                              (E.C_RAISE, self._monitor_c_return)])
+        events = 0
+        for event, callback in callbacks:
+            monitoring.register_callback(tool_id, event, callback)
+            defer(monitoring.register_callback, tool_id, event, None)
+            events |= event
+        # locations disabled by a previous session might not be ignored now.
+        monitoring.restart_events()
+        monitoring.set_events(tool_id, events)
+        defer(monitoring.set_events, tool_id, 0)
+
+    def run(self):
+        if self.bias is None:
+            # calibrated lazily because calibration replaces the profile
+            # function for a while.  constructing a profiler shouldn't
+            # disturb an active profiler or debugger.
+            self.bias = calibrate(self.timer, self.backend)
+            self._bias_ns = int(round(self.bias * 1e9))
+        with deferral() as defer:
+            self._reset_shadows()
+            defer(self.merge_thread_stats)
+            self._install(defer)
             self.timer.start(self)
             defer(self.timer.stop)
             yield
+
+
+#: The calibrated biases by timer classes and backends.
+_biases = {}
+
+
+def calibrate(timer, backend=None, number=5000, repeat=3):
+    """Measures the CPU time which a profiling event of
+    :class:`TracingProfiler` costs with the given timer and backend on the
+    current machine.  It includes the cost of the interpreter to dispatch the
+    profiling function.  Like the calibration of :mod:`profile`, the result is
+    the minimum of the repeated measurements.  It is measured just once for a
+    timer class and a backend.
+    """
+    backend = backend or BACKEND
+    key = (type(timer), backend)
+    try:
+        return _biases[key]
+    except KeyError:
+        pass
+    def callee():
+        pass
+    def caller(number):
+        for x in range(number):
+            callee()
+    profiler = TracingProfiler(timer=timer, bias=0, backend=backend)
+    prev_profile = sys.getprofile()
+    biases = []
+    try:
+        sys.setprofile(None)
+        for x in range(repeat):
+            t = timer()
+            caller(number)
+            t_unprofiled = timer() - t
+            with deferral() as defer:
+                profiler._install(defer, all_threads=False)
+                t = timer()
+                caller(number)
+                t_profiled = timer() - t
+            # a callee() call emits 2 events.
+            biases.append((t_profiled - t_unprofiled) // (2 * number))
+    finally:
+        sys.setprofile(prev_profile)
+    # in whole nanoseconds.
+    bias = _biases[key] = max(0, min(biases)) / 1e9
+    return bias
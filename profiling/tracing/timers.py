@@ -3,6 +3,9 @@
    profiling.tracing.timers
    ~~~~~~~~~~~~~~~~~~~~~~~~
 
+   Timers measure time in integer nanoseconds not to lose precision while
+   accumulating.
+
    :copyright: (c) 2014-2017, What! Studio
    :license: BSD, see LICENSE for more details.
 
@@ -11,17 +14,41 @@ from __future__ import absolute_import
 
 import time
 
-from profiling.utils import lazy_import, Runnable, thread_clock
+import six.moves._thread as _thread
+
+from profiling.utils import cpu_clock, lazy_import, Runnable, thread_clock
+
+
+__all__ = ['Timer', 'ContextualTimer', 'ThreadTimer', 'GreenletTimer',
+           'AsyncioTaskTimer', 'WallTimer']
+
+
+def clock_ns(clock):
+    """Makes a clock in integer nanoseconds from the given clock in seconds.
+    It is for Python versions which don't have the nanosecond clocks.
+    """
+    def clock_ns():
+        return int(clock() * 1e9)
+    return clock_ns
+
 
+#: The CPU time of the process in nanoseconds.
+process_time_ns = getattr(time, 'process_time_ns', None) or clock_ns(cpu_clock)
 
-__all__ = ['Timer', 'ContextualTimer', 'ThreadTimer', 'GreenletTimer']
+#: The CPU time of the current thread in nanoseconds.
+thread_time_ns = (getattr(time, 'thread_time_ns', None) or
+                  clock_ns(thread_clock))
+
+#: The monotonic wall-clock time in nanoseconds.
+perf_counter_ns = (getattr(time, 'perf_counter_ns', None) or
+                   clock_ns(getattr(time, 'perf_counter', time.time)))
 
 
 class Timer(Runnable):
-    """The basic timer."""
+    """The basic timer.  It measures the CPU time of the process."""
 
-    #: The raw function to get the CPU time.
-    clock = time.clock
+    #: The raw function to get the time in integer nanoseconds.
+    clock = staticmethod(process_time_ns)
 
     def __call__(self):
         return self.clock()
@@ -69,8 +96,15 @@ class ThreadTimer(Timer):
 
     """
 
-    def __call__(self):
-        return thread_clock()
+    clock = staticmethod(thread_time_ns)
+
+
+class WallTimer(Timer):
+    """A timer to get wall-clock time.  The time includes waiting for I/O or
+    locks.
+    """
+
+    clock = staticmethod(perf_counter_ns)
 
 
 class GreenletTimer(ContextualTimer):
@@ -91,3 +125,79 @@ class GreenletTimer(ContextualTimer):
         self.greenlet.settrace(self._trace)
         yield
         self.greenlet.settrace(None)
+
+
+class AsyncioTaskTimer(ContextualTimer):
+    """A timer to get CPU time per :class:`asyncio.Task`.  There's no hook
+    for task switches.  Instead, a switch is noticed when the timer is called
+    in another task, so a task is paused at the first profiling event after
+    its step.  The time out of tasks such as in the event loop belongs to the
+    ``None`` task.
+
+    The CPU clock is per thread.  A context is ``(thread_id, id(task))`` so
+    that the work in the other threads such as of
+    :meth:`asyncio.AbstractEventLoop.run_in_executor` is timed by their own
+    clocks.
+    """
+
+    asyncio = lazy_import('asyncio')
+
+    # an event loop runs in a thread.
+    clock = staticmethod(thread_time_ns)
+
+    def __new__(cls, *args, **kwargs):
+        timer = super(AsyncioTaskTimer, cls).__new__(cls, *args, **kwargs)
+        #: The task which has been running since the last call and its
+        #: context by thread ids.
+        timer._running_tasks = {}
+        return timer
+
+    def current_task(self):
+        asyncio = self.asyncio
+        try:
+            current_task = asyncio.current_task
+        except AttributeError:
+            # Python 3.6 or earlier.
+            return asyncio.Task.current_task()
+        try:
+            return current_task()
+        except RuntimeError:
+            # no running event loop.
+            return None
+
+    def detect_context(self):
+        task = self.current_task()
+        return (_thread.get_ident(), None if task is None else id(task))
+
+    def __call__(self, context=None):
+        if context is None:
+            task = self.current_task()
+            thread_id = _thread.get_ident()
+            context = (thread_id, None if task is None else id(task))
+            __, running_context = self._running_tasks.get(thread_id,
+                                                          (None, None))
+            if context != running_context:
+                self._switch(thread_id, task, context)
+        return super(AsyncioTaskTimer, self).__call__(context)
+
+    def _switch(self, thread_id, task, context):
+        times = self._contextual_times
+        now = self.clock()
+        prev_task, prev_context = self._running_tasks.get(thread_id,
+                                                          (None, None))
+        if prev_context is None:
+            # the first call in the thread.
+            pass
+        elif prev_task is not None and prev_task.done():
+            # the task will never be resumed.
+            times.pop(prev_context, None)
+        else:
+            paused_at, resumed_at = times.get(prev_context, (0, 0))
+            times[prev_context] = (paused_at + now - resumed_at, None)
+        paused_at, __ = times.get(context, (0, 0))
+        times[context] = (paused_at, now)
+        self._running_tasks[thread_id] = (task, context)
+
+
+#: The alias for ``--timer=asyncio``.
+AsyncioTimer = AsyncioTaskTimer
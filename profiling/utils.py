@@ -9,9 +9,11 @@
 """
 from __future__ import absolute_import
 
+from array import array
 from collections import deque
 from contextlib import contextmanager
 import sys
+import time
 
 try:
     from profiling import speedup
@@ -20,7 +22,7 @@ except ImportError:
 
 
 __all__ = ['Runnable', 'frame_stack', 'repr_frame', 'lazy_import', 'deferral',
-           'thread_clock', 'noop']
+           'thread_clock', 'cpu_clock', 'INT64', 'noop']
 
 
 class Runnable(object):
@@ -94,8 +96,9 @@ class Runnable(object):
 if speedup:
     def frame_stack(frame, base_frame=None, base_code=None,
                     ignored_frames=(), ignored_codes=()):
+        # ignored_codes may be a CodeFilter.  Don't convert it to a set.
         return speedup.frame_stack(frame, base_frame, base_code,
-                                   set(ignored_frames), set(ignored_codes))
+                                   set(ignored_frames), ignored_codes)
 else:
     def frame_stack(frame, base_frame=None, base_code=None,
                     ignored_frames=(), ignored_codes=()):
@@ -160,10 +163,23 @@ if sys.version_info < (3, 3):
     def thread_clock():
         return _yappi_holder.yappi.get_clock_time()
 else:
-    import time
     def thread_clock():
         return time.clock_gettime(time.CLOCK_THREAD_CPUTIME_ID)
 
 
+#: The CPU time of the process in seconds.  :func:`time.clock` has been
+#: removed since Python 3.8.
+cpu_clock = getattr(time, 'process_time', None) or time.clock
+
+
+#: The typecode of :class:`array.array` for 64-bit integers.  ``'l'`` is
+#: 32-bit on some platforms such as Windows.  ``'q'`` has been added since
+#: Python 3.3.
+try:
+    INT64 = array('q').typecode
+except ValueError:
+    INT64 = 'l'
+
+
 #: Does nothing.  It allows any arguments.
 noop = lambda x, *a, **k: None
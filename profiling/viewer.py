@@ -28,7 +28,7 @@ import urwid
 from urwid import connect_signal as on
 
 from profiling import sortkeys
-from profiling.stats import FlatFrozenStatistics
+from profiling.stats import FrozenStatistics, LineStatistics
 
 
 __all__ = ['StatisticsTable', 'StatisticsViewer', 'fmt',
@@ -221,11 +221,45 @@ class Formatter(object):
     markup_time = _markup(format_time, attr_time)
     make_time_text = _make_text(markup_time, **_numeric)
 
+    # time or n/a
+
+    @staticmethod
+    def format_time_or_na(sec):
+        if sec is None:
+            return 'n/a'
+        return Formatter.format_time(sec)
+
+    @staticmethod
+    def attr_time_or_na(sec):
+        if sec is None:
+            return 'zero'
+        return Formatter.attr_time(sec)
+
+    markup_time_or_na = _markup(format_time_or_na, attr_time_or_na)
+    make_time_or_na_text = _make_text(markup_time_or_na, **_numeric)
+
+    # estimated time
+
+    @staticmethod
+    def format_estimated_time(sec):
+        # examples:
+        # 0.000123: ~123us
+        return '~' + Formatter.format_time(sec)
+
+    markup_estimated_time = _markup(format_estimated_time, attr_time)
+    make_estimated_time_text = _make_text(markup_estimated_time, **_numeric)
+
     # stats
 
     @staticmethod
     def markup_stats(stats):
-        if stats.name:
+        if isinstance(stats, LineStatistics):
+            return [('weak', 'line '), ('loc', str(stats.lineno))]
+        elif stats.name and stats.lineno is None:
+            # such as a builtin function.
+            loc = '({0})'.format(stats.module or stats.filename)
+            return [('name', stats.name), ' ', ('loc', loc)]
+        elif stats.name:
             loc = ('({0}:{1})'
                    ''.format(stats.module or stats.filename, stats.lineno))
             return [('name', stats.name), ' ', ('loc', loc)]
@@ -437,11 +471,19 @@ class StatisticsNode(StatisticsNodeBase, urwid.ParentNode):
         stats = self.get_value()
         if stats is None:
             return ()
-        return stats.sorted(self.table.order)
+        line_stats = stats.line_stats()
+        if not line_stats:
+            return stats.sorted(self.table.order)
+        # the sampled lines are expanded along with the callees.
+        line_stats.extend(stats)
+        return sorted(line_stats, key=self.table.order)
 
     def load_child_node(self, stats):
         depth = self.get_depth() + 1
-        node_class = StatisticsNode if len(stats) else LeafStatisticsNode
+        if len(stats) or stats.line_hits:
+            node_class = StatisticsNode
+        else:
+            node_class = LeafStatisticsNode
         return node_class(stats, self, stats, depth, self.table)
 
 
@@ -479,6 +521,8 @@ class StatisticsTable(urwid.WidgetWrap):
     title = None
     stats = None
     time = None
+    #: The meta of the profiler which has measured the result.
+    meta = None
 
     def __init__(self, viewer):
         self._expanded_stat_hashes = set()
@@ -577,12 +621,13 @@ class StatisticsTable(urwid.WidgetWrap):
         return self.stats
 
     def set_result(self, stats, cpu_time=0.0, wall_time=0.0,
-                   title=None, at=None):
+                   title=None, at=None, meta=None):
         self.stats = stats
         self.cpu_time = cpu_time
         self.wall_time = wall_time
         self.title = title
         self.at = at
+        self.meta = meta
         self.refresh()
 
     def set_layout(self, layout):
@@ -609,7 +654,7 @@ class StatisticsTable(urwid.WidgetWrap):
         if stats is None:
             return
         if self.layout == FLAT:
-            stats = FlatFrozenStatistics.flatten(stats)
+            stats = stats.flat()
         node = StatisticsNode(stats, table=self)
         path = self.get_path()
         node = self.find_node(node, path)
@@ -657,14 +702,24 @@ class StatisticsTable(urwid.WidgetWrap):
             cpu_usage = self.cpu_time / self.wall_time
         except ZeroDivisionError:
             cpu_usage = 0.0
-        cpu_info = urwid.Text([
-            'CPU ', fmt.markup_percent(cpu_usage, unit=True),
-            ' ', ('weak', fraction_string)])
+        cpu_markup = ['CPU ', fmt.markup_percent(cpu_usage, unit=True),
+                      ' ', ('weak', fraction_string)]
+        if self.meta:
+            meta_markup = self.make_meta_markup(self.meta)
+            if meta_markup:
+                cpu_markup.extend(['  '] + meta_markup)
+        cpu_info = urwid.Text(cpu_markup)
         # Set header columns.
         col_opts = ('weight', 1, False)
         self.header.contents = \
             [(w, col_opts) for w in [cpu_info, meta_info] if w]
 
+    def make_meta_markup(self, meta):
+        """Makes the markup list of the header from the meta of the profiler.
+        Override it to show how the result has been measured.
+        """
+        return None
+
     def focus_hotspot(self, size):
         widget, __ = self.tbody.get_focus()
         while widget:
@@ -692,6 +747,12 @@ class StatisticsTable(urwid.WidgetWrap):
             layout = {FLAT: NESTED, NESTED: FLAT}[self.layout]
             self.set_layout(layout)
             return True
+        elif key == 'x':
+            __, node = self.get_focus()
+            stats = None if node is None else node.get_value()
+            if stats is not None:
+                self.viewer.open_exemplar(stats)
+            return True
         command = self._command_map[key]
         if command == 'menu':
             # key: ESC.
@@ -804,8 +865,8 @@ class StatisticsViewer(object):
         self.widget.original_widget = self.table
 
     def set_result(self, stats, cpu_time=0.0, wall_time=0.0,
-                   title=None, at=None):
-        self._final_result = (stats, cpu_time, wall_time, title, at)
+                   title=None, at=None, meta=None):
+        self._final_result = (stats, cpu_time, wall_time, title, at, meta)
         if not self.paused:
             self.update_result()
 
@@ -819,8 +880,7 @@ class StatisticsViewer(object):
         except AttributeError:
             self.table.update_frame()
             return
-        stats, cpu_time, wall_time, title, at = result
-        self.table.set_result(stats, cpu_time, wall_time, title, at)
+        self.table.set_result(*result)
 
     def activate(self):
         self.active = True
@@ -840,10 +900,38 @@ class StatisticsViewer(object):
 
     def resume(self):
         self.paused = False
-        try:
-            del self._paused_result
-        except AttributeError:
-            pass
+        for attr in ['_paused_result', '_exemplar']:
+            try:
+                delattr(self, attr)
+            except AttributeError:
+                pass
+        self.update_result()
+
+    def open_exemplar(self, stats):
+        """Pauses and shows the statistics tree of the slowest call of the
+        given statistics.  If the statistics doesn't have exemplars, the next
+        slowest call of the shown exemplar is shown.  It returns to the
+        result by :meth:`resume`.
+        """
+        if getattr(stats, 'exemplars', None):
+            index = 0
+        else:
+            try:
+                stats, index = self._exemplar
+            except AttributeError:
+                return
+            index += 1
+        exemplars = list(stats.exemplars)
+        index %= len(exemplars)
+        exemplar = exemplars[index]
+        if not self.paused:
+            self.pause()
+        self._exemplar = (stats, index)
+        title = 'exemplar {0}/{1} of {2}'.format(
+            index + 1, len(exemplars), stats.regular_name)
+        root = FrozenStatistics(children=[exemplar])
+        self._paused_result = (root, exemplar.deep_time,
+                               exemplar.deep_wall_time, title, None, None)
         self.update_result()
 
 
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import gc
+import pickle
+
+from profiling import codes
+from profiling.compact import CompactRecordingStatistics
+from profiling.stats import PseudoCode, RecordingStatistics
+
+
+def foo():
+    pass
+
+
+def test_code_info():
+    code = foo.__code__
+    id_ = codes.code_id(code)
+    assert codes.code_id(code) == id_
+    info = codes.code_info(code)
+    assert info == ('foo', code.co_filename, code.co_firstlineno,
+                    'test_codes')
+    assert codes.info_by_id(id_) is info
+    # a pseudo code has the module name.
+    info = codes.code_info(PseudoCode('builtins', 'len'))
+    assert info == ('len', None, None, 'builtins')
+
+
+def test_recording_stats_share_code_info():
+    stats = RecordingStatistics()
+    foo_stats1 = stats.ensure_child(foo.__code__)
+    foo_stats2 = foo_stats1.ensure_child(foo.__code__)
+    assert foo_stats1.code_info is foo_stats2.code_info
+    assert foo_stats1.module == 'test_codes'
+    assert stats.code_info == (None, None, None, None)
+    # the code info is written once per dump.
+    frozen_stats = pickle.loads(pickle.dumps(stats))
+    frozen_foo_stats = frozen_stats.children[0]
+    assert frozen_foo_stats.name == 'foo'
+    assert frozen_foo_stats.filename is \
+        frozen_foo_stats.children[0].filename
+
+
+def test_weak_codes():
+    code = compile('pass', '<test_weak_codes>', 'exec')
+    id_ = codes.code_id(code)
+    assert codes.code_by_id(id_) is code
+    # a collected code releases the id.
+    del code
+    gc.collect()
+    code = compile('pass', '<test_weak_codes_2>', 'exec')
+    assert codes.code_id(code) == id_
+    assert codes.code_info(code)[1] == '<test_weak_codes_2>'
+    assert codes.code_by_id(id_) is code
+    # a compact tree keeps its codes alive.
+    stats = CompactRecordingStatistics()
+    stats.ensure_child(code).own_hits += 1
+    del code
+    gc.collect()
+    assert codes.code_id(compile('other', '<other>', 'exec')) != id_
+    assert stats.children[0].filename == '<test_weak_codes_2>'
+    # pseudo codes are kept.
+    id_ = codes.code_id(PseudoCode('builtins', 'test_weak_codes'))
+    gc.collect()
+    assert codes.code_by_id(id_) == PseudoCode('builtins', 'test_weak_codes')
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+import pickle
+
+import pytest
+
+from profiling import columnar, sortkeys
+from profiling.stats import FlatFrozenStatistics, FrozenStatistics
+from profiling.viewer import FLAT, StatisticsViewer
+
+
+@pytest.fixture(params=['numpy', 'array'])
+def backend(request, monkeypatch):
+    if request.param == 'numpy':
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(columnar, 'numpy', None)
+    return request.param
+
+
+def make_stats():
+    foo_stats = FrozenStatistics('foo', 'foo.py', 1, 'foo', own_hits=3,
+                                 deep_time=6, line_hits={2: 3})
+    bar_stats = FrozenStatistics('bar', 'bar.py', 1, 'bar', own_hits=2,
+                                 deep_time=8, children=[foo_stats])
+    return FrozenStatistics(children=[
+        FrozenStatistics('foo', 'foo.py', 1, 'foo', own_hits=1, deep_time=10,
+                         children=[bar_stats]),
+        FrozenStatistics('foo', 'foo.py', 1, 'foo', own_hits=4, deep_time=3,
+                         estimated=True),
+    ])
+
+
+def test_view(backend):
+    stats = columnar.freeze(make_stats())
+    assert len(stats.columns) == 5
+    assert stats.deep_hits == 10
+    foo_stats, foo_stats2 = stats
+    assert (foo_stats.name, foo_stats.filename, foo_stats.lineno,
+            foo_stats.module) == ('foo', 'foo.py', 1, 'foo')
+    assert foo_stats.own_hits == 1
+    assert foo_stats.deep_hits == 6
+    assert foo_stats.own_time == 2
+    assert foo_stats2.estimated
+    assert len(foo_stats2) == 0
+    bar_stats = list(foo_stats)[0]
+    assert list(bar_stats)[0].line_hits == {2: 3}
+    assert stats.sorted(sortkeys.by_deep_hits) == [foo_stats, foo_stats2]
+    # the columns are pickled.
+    stats = pickle.loads(pickle.dumps(stats))
+    assert isinstance(stats, columnar.StatisticsView)
+    assert list(stats)[0].deep_hits == 6
+
+
+def test_large_hits(backend):
+    stats = columnar.freeze(FrozenStatistics(children=[
+        FrozenStatistics('foo', own_hits=2 ** 40),
+        FrozenStatistics('bar', own_hits=2 ** 40),
+    ]))
+    assert stats.deep_hits == 2 ** 41
+    assert stats.columns.own_hits.itemsize == 8
+
+
+def test_flat(backend):
+    stats = columnar.freeze(make_stats())
+    expected = FlatFrozenStatistics.flatten(make_stats())
+    key = lambda s: (s.name, s.own_hits, s.deep_hits, s.own_time,
+                     s.deep_time, s.estimated, s.line_hits)
+    assert sorted(map(key, stats.flat())) == sorted(map(key, expected))
+
+
+def test_flat_exemplars(backend):
+    def make_exemplars(*deep_times):
+        return [FrozenStatistics('handle', own_hits=1, deep_time=t)
+                for t in deep_times]
+    stats = FrozenStatistics(children=[
+        FrozenStatistics('handle', own_hits=3, deep_time=9,
+                         exemplars=make_exemplars(3, 2, 1)),
+        FrozenStatistics('serve', children=[
+            FrozenStatistics('handle', own_hits=3, deep_time=18,
+                             exemplars=make_exemplars(6, 5, 4)),
+        ]),
+    ])
+    # the merged exemplars are cut to the capacity.
+    for flat_stats in [FlatFrozenStatistics.flatten(stats),
+                       columnar.freeze(stats).flat()]:
+        handle_stats, = [s for s in flat_stats if s.name == 'handle']
+        assert [s.deep_time for s in handle_stats.exemplars] == \
+            [6, 5, 4, 3, 2]
+
+
+def test_top(backend):
+    columns = columnar.freeze(make_stats()).columns
+    assert [s.own_hits for s in columns.top(2)] == [4, 3]
+    assert [s.deep_hits for s in columns.top(2, 'deep_hits')] == [10, 6]
+    assert columns.top(0) == []
+
+
+def test_viewer(backend):
+    stats = columnar.freeze(make_stats())
+    viewer = StatisticsViewer()
+    viewer.table.sort_stats(sortkeys.by_deep_hits)
+    viewer.set_result(stats, 1.0, 1.0)
+    node = viewer.table.get_focus()[1]
+    assert node.get_child_keys() == list(stats)
+    # flattened by the columns.
+    viewer.table.set_layout(FLAT)
+    node = viewer.table.get_focus()[1]
+    assert sorted(s.name for s in node.get_child_keys()) == ['bar', 'foo']
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import gc
+import pickle
+
+import pytest
+
+from _utils import factorial, find_stats, foo, spin
+from profiling.compact import (
+    CompactRecordingStatistics, CompactVoidRecordingStatistics)
+from profiling.sampling import SamplingProfiler
+from profiling.sampling.samplers import ItimerSampler
+from profiling.stats import (
+    FrozenStatistics, PseudoCode, RecordingStatistics,
+    VoidRecordingStatistics as void)
+from profiling.tracing import TracingProfiler
+
+
+def test_compact():
+    stats = CompactRecordingStatistics()
+    foo_stats = stats.ensure_child(foo.__code__, void)
+    assert isinstance(foo_stats, CompactVoidRecordingStatistics)
+    assert isinstance(foo_stats, void)
+    factorial_stats = foo_stats.ensure_child(factorial.__code__,
+                                             RecordingStatistics)
+    assert isinstance(factorial_stats, CompactRecordingStatistics)
+    factorial_stats.own_hits += 2
+    factorial_stats.deep_time_ns += 3000000000
+    factorial_stats.estimated = True
+    foo_stats.own_hits += 10
+    assert foo_stats.own_hits == 0
+    assert foo_stats.get_child(factorial.__code__) == factorial_stats
+    assert factorial.__code__ in foo_stats
+    assert foo.__code__ not in foo_stats
+    with pytest.raises(KeyError):
+        stats.get_child(factorial.__code__)
+    assert len(stats) == len(foo_stats) == 1
+    assert factorial_stats.name == 'factorial'
+    assert factorial_stats.estimated
+    assert stats.deep_hits == 2
+    assert foo_stats.deep_time == 3
+    assert stats.tree.deep_times_ns.itemsize == 8
+    assert stats.own_time == 0
+    # the aggregates follow the paths marked dirty.
+    factorial_stats.own_hits += 1
+    assert stats.deep_hits == 2
+    factorial_stats.mark_dirty()
+    foo_stats.mark_dirty()
+    stats.mark_dirty()
+    assert stats.deep_hits == 3
+    # pickled as frozen statistics.
+    frozen_stats = pickle.loads(pickle.dumps(stats))
+    assert isinstance(frozen_stats, FrozenStatistics)
+    assert find_stats(frozen_stats, 'factorial').own_hits == 3
+    stats.remove_child(foo.__code__)
+    assert len(stats) == 0
+    assert stats.deep_hits == 0
+    with pytest.raises(KeyError):
+        stats.remove_child(foo.__code__)
+    stats.discard_child(foo.__code__)
+    stats.ensure_child(foo.__code__)
+    stats.clear()
+    assert len(stats) == 0
+    assert len(stats.tree) == 1
+
+
+def test_untracked():
+    pseudo_codes = [PseudoCode('test', 'f%d' % x) for x in range(1000)]
+    gc.collect()
+    objects = len(gc.get_objects())
+    stats = CompactRecordingStatistics()
+    for code in pseudo_codes:
+        stats.ensure_child(code).ensure_child(code)
+    gc.collect()
+    assert len(stats.tree) == 2001
+    assert len(gc.get_objects()) - objects < 100
+    assert not gc.is_tracked(stats.tree.nodes)
+
+
+def test_merge():
+    stats = RecordingStatistics()
+    foo_stats = stats.ensure_child(foo.__code__, void)
+    factorial_stats = foo_stats.ensure_child(factorial.__code__,
+                                             RecordingStatistics)
+    factorial_stats.own_hits = 2
+    factorial_stats.line_hits = {10: 2}
+    compact_stats = CompactRecordingStatistics()
+    compact_stats.merge(stats)
+    compact_stats.merge(stats)
+    assert isinstance(compact_stats.get_child(foo.__code__), void)
+    factorial_stats = find_stats(compact_stats, 'factorial')
+    assert factorial_stats.own_hits == 4
+    assert factorial_stats.line_hits == {10: 4}
+    # the absent frame has been recorded in the other tree.
+    stats.merge(compact_stats)
+    stats.add_child(foo.__code__, RecordingStatistics(foo.__code__))
+    stats.get_child(foo.__code__).own_hits = 1
+    compact_stats.merge(stats)
+    foo_stats = compact_stats.get_child(foo.__code__)
+    assert isinstance(foo_stats, CompactRecordingStatistics)
+    assert foo_stats.own_hits == 1
+    assert find_stats(compact_stats, 'factorial').own_hits == 4
+
+
+def test_profilers():
+    profiler = TracingProfiler(compact=True)
+    assert isinstance(profiler.stats, CompactRecordingStatistics)
+    with profiler:
+        factorial(1000)
+        factorial(10000)
+    stats = find_stats(profiler.stats, 'factorial')
+    assert stats.own_hits == 2
+    assert stats.deep_time > 0
+    assert profiler.stats.deep_hits >= 2
+    profiler = SamplingProfiler(sampler=ItimerSampler(0.0001), compact=True)
+    with profiler:
+        spin(0.1)
+    stats, __, __ = profiler.result()
+    assert find_stats(stats, 'spin').deep_hits > 0
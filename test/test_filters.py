@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+import gc
+import json
+import os
+import sys
+
+import pytest
+import six
+
+from _utils import bar, baz, factorial, find_stats, foo
+import profiling
+from profiling.filters import CodeFilter
+from profiling.sampling import SamplingProfiler
+from profiling.stats import PseudoCode
+from profiling.tracing import TracingProfiler
+
+
+stdlib_code = six.get_function_code(json.dumps)
+profiling_code = six.get_function_code(profiling.filters.code_module_name)
+test_code = six.get_function_code(factorial)
+
+
+def test_no_rules():
+    code_filter = CodeFilter()
+    assert stdlib_code not in code_filter
+    assert test_code not in code_filter
+    code_filter = CodeFilter(ignored_codes=[test_code])
+    assert stdlib_code not in code_filter
+    assert test_code in code_filter
+
+
+def test_rules():
+    code_filter = CodeFilter(exclude=['stdlib'])
+    assert stdlib_code in code_filter
+    assert profiling_code not in code_filter
+    assert test_code not in code_filter
+    # module name globs match submodules also.
+    code_filter = CodeFilter(include=['profiling'])
+    assert stdlib_code in code_filter
+    assert profiling_code not in code_filter
+    assert test_code in code_filter
+    code_filter = CodeFilter(include=['prof*'], exclude=['*.filters'])
+    assert profiling_code in code_filter
+    # path prefixes.
+    path = os.path.dirname(profiling.__file__)
+    code_filter = CodeFilter(exclude=[path + os.sep])
+    assert stdlib_code not in code_filter
+    assert profiling_code in code_filter
+    assert test_code not in code_filter
+
+
+def test_site_packages():
+    site_packages_code = six.get_function_code(pytest.main)
+    code_filter = CodeFilter(exclude=['site-packages'])
+    if 'site-packages' not in site_packages_code.co_filename:
+        pytest.skip('pytest is not installed in site-packages')
+    assert site_packages_code in code_filter
+    assert stdlib_code not in code_filter
+
+
+def test_cache():
+    code_filter = CodeFilter(exclude=['stdlib'])
+    assert stdlib_code not in code_filter._verdicts
+    assert code_filter.is_ignored(stdlib_code)
+    assert code_filter._verdicts[stdlib_code] is True
+    # cached verdicts are not evaluated again.
+    code_filter._verdicts[stdlib_code] = False
+    assert stdlib_code not in code_filter
+    # the cache doesn't keep codes alive.
+    code = compile('pass', '<test>', 'exec')
+    assert not code_filter.is_ignored(code)
+    assert code in code_filter._verdicts
+    del code
+    gc.collect()
+    assert len(code_filter._verdicts) == 1
+    # pseudo codes cannot be weakly referenced.
+    pseudo_code = PseudoCode('json', 'dumps')
+    code_filter = CodeFilter(ignored_codes=[pseudo_code])
+    assert code_filter.is_ignored(pseudo_code)
+    assert not code_filter.is_ignored(PseudoCode('json', 'loads'))
+
+
+def test_profilers():
+    code_filter = CodeFilter(exclude=['_utils'])
+    profiler = TracingProfiler(base_frame=sys._getframe(),
+                               ignored_codes=code_filter)
+    assert profiler.ignored_codes is code_filter
+    with profiler:
+        factorial(10)
+        json.dumps({})
+    with pytest.raises(IndexError):
+        find_stats(profiler.stats, 'factorial')
+    assert find_stats(profiler.stats, 'dumps').own_hits == 1
+    # the innermost frame which is not ignored takes the sample.
+    code_filter = CodeFilter(ignored_codes=[
+        six.get_function_code(f) for f in [foo, bar, baz]])
+    profiler = SamplingProfiler(base_frame=sys._getframe().f_back,
+                                ignored_codes=code_filter)
+    profiler.sample(foo())
+    profiler.aggregate()
+    assert find_stats(profiler.stats, 'test_profilers').own_hits == 1
+    with pytest.raises(IndexError):
+        find_stats(profiler.stats, 'baz')
+    # all frames are ignored.
+    profiler = SamplingProfiler(base_frame=sys._getframe(),
+                                ignored_codes=code_filter)
+    profiler.sample(foo())
+    profiler.aggregate()
+    assert len(profiler.stats) == 0
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import signal
+import sys
+import time
+
+from _utils import factorial, spin
+from profiling.governor import OverheadGovernor
+from profiling.sampling import SamplingProfiler, SamplingStatisticsTable
+from profiling.tracing import TracingProfiler, TracingStatisticsTable
+
+
+def call_densely():
+    for x in range(10000):
+        factorial(1)
+
+
+def test_governor():
+    try:
+        _test_governor()
+    finally:
+        # ItimerSampler leaves SIG_IGN.
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+
+def _test_governor():
+    frame = sys._getframe()
+    tracing_profiler = TracingProfiler(base_frame=frame)
+    sampling_profiler = SamplingProfiler(base_frame=frame)
+    governor = OverheadGovernor(tracing_profiler, sampling_profiler,
+                                budget=0.05)
+    assert governor.mode == 'tracing'
+    # over budget.
+    with governor:
+        assert tracing_profiler.is_running()
+        call_densely()
+    assert governor.overhead_ratio > 0.05
+    assert governor.next_profiler is sampling_profiler
+    # the result is still of the tracing profiler.
+    assert governor.mode == 'tracing'
+    assert governor.table_class is TracingStatisticsTable
+    assert governor.meta()['mode'] == 'tracing'
+    # still busy.
+    with governor:
+        assert sampling_profiler.is_running()
+        spin(0.1)
+    assert governor.mode == 'sampling'
+    assert governor.table_class is SamplingStatisticsTable
+    assert governor.next_profiler is sampling_profiler
+    # load dropped.
+    with governor:
+        time.sleep(0.1)
+    assert governor.overhead_ratio < 0.05
+    assert governor.next_profiler is tracing_profiler
+    with governor:
+        assert tracing_profiler.is_running()
+    assert governor.mode == 'tracing'
+
+
+def test_governor_idle_interval(monkeypatch):
+    tracing_profiler = TracingProfiler()
+    governor = OverheadGovernor(tracing_profiler, SamplingProfiler())
+    governor.overhead_per_cpu_time = 0.1
+    # no CPU time was measured on a coarse clock.
+    monkeypatch.setattr(tracing_profiler, 'result', lambda: (None, 0.0, 0.1))
+    monkeypatch.setattr(TracingProfiler, 'overhead', 0.0)
+    governor.govern()
+    assert governor.overhead_per_cpu_time == 0.1
+    assert governor.overhead_ratio == 0.0
+    assert governor.next_profiler is tracing_profiler
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+import pickle
+
+from profiling import histogram
+
+
+def test_bucket():
+    for sec in [1e-6, 1e-3, 0.0123, 0.8, 12.3]:
+        value = histogram.bucket_value(histogram.bucket_index(sec))
+        # the relative error is bounded by the sub-buckets.
+        assert sec <= value <= sec * (1 + 1. / histogram.SUB_BUCKETS)
+    assert histogram.bucket_index(0) == 0
+    assert histogram.bucket_index(1e-9) == 0
+    assert histogram.bucket_index(1e9) == histogram.BUCKETS - 1
+
+
+def test_percentile():
+    h = histogram.make_histogram()
+    assert len(h) == histogram.BUCKETS
+    assert histogram.percentile(h, 0.99) == 0.0
+    for x in range(98):
+        histogram.record(h, 0.001)
+    histogram.record(h, 0.8, count=2)
+    assert histogram.total(h) == 100
+    assert 0.001 <= histogram.percentile(h, 0.5) < 0.0013
+    assert 0.8 <= histogram.percentile(h, 0.99) < 1
+    # merge.
+    h2 = histogram.make_histogram()
+    histogram.record(h2, 0.8, count=100)
+    histogram.merge(h, h2)
+    assert histogram.total(h) == 200
+    assert 0.8 <= histogram.percentile(h, 0.5) < 1
+    assert pickle.loads(pickle.dumps(h)) == h
+
+
+def test_large_counts():
+    h = histogram.make_histogram()
+    assert h.itemsize == 8
+    histogram.record(h, 0.001, count=2 ** 40)
+    histogram.record(h, 0.001, count=2 ** 40)
+    assert histogram.total(h) == 2 ** 41
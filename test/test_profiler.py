@@ -61,10 +61,11 @@ def test_dump(profiler):
     assert path.getsize(temp_file) > 0
 
     with open(temp_file, 'rb') as f:
-        profiler_class, (stats, cpu_time, wall_time) = pickle.load(f)
+        profiler_class, (stats, cpu_time, wall_time), meta = pickle.load(f)
 
     assert profiler.__class__ == profiler_class
     assert cpu_time == wall_time == 0.0
+    assert meta == {}
 
 
 def test_wrapper(profiler):
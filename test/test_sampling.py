@@ -2,14 +2,22 @@
 from __future__ import division
 
 import os
+import pickle
 import signal
 import sys
+from textwrap import dedent
+import threading
+import time
 
 import pytest
+from six import exec_
 
 from _utils import find_stats, spin
-from profiling.sampling import SamplingProfiler
-from profiling.sampling.samplers import ItimerSampler, TracingSampler
+from profiling.sampling import (
+    samplers, SamplingProfiler, SamplingStatisticsTable)
+from profiling.sampling.samplers import (
+    ItimerSampler, Sampler, ThreadsSampler, TracingSampler)
+from profiling.viewer import StatisticsViewer
 
 
 def spin_100ms():
@@ -50,12 +58,118 @@ def test_itimer_sampler():
         signal.signal(signal.SIGPROF, signal.SIG_DFL)
 
 
+@pytest.mark.flaky(reruns=10)
+def test_time_weighted_samples():
+    profiler = SamplingProfiler(base_frame=sys._getframe(),
+                                sampler=ItimerSampler(0.001))
+    try:
+        with profiler:
+            spin_100ms()
+            spin_500ms()
+    finally:
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+    stats1 = find_stats(profiler.stats, 'spin_100ms')
+    stats2 = find_stats(profiler.stats, 'spin_500ms')
+    # each sample records the CPU time since the last sample.
+    assert 0.05 < stats1.deep_time < 0.2
+    assert 0.4 < stats2.deep_time < 0.7
+    spin_stats = find_stats(stats2, 'spin')
+    assert spin_stats.own_time == spin_stats.deep_time
+    assert stats2.own_time < stats2.deep_time
+    assert profiler.stats.deep_time >= stats1.deep_time + stats2.deep_time
+
+
+@pytest.mark.flaky(reruns=10)
+def test_samples_without_thread_clock(monkeypatch):
+    def thread_clock():
+        raise ImportError('No module named yappi')
+    monkeypatch.setattr(samplers, 'thread_clock', thread_clock)
+    for sampler in [ItimerSampler(0.001), TracingSampler(0.001)]:
+        profiler = SamplingProfiler(base_frame=sys._getframe(),
+                                    sampler=sampler)
+        try:
+            with profiler:
+                spin_100ms()
+        finally:
+            signal.signal(signal.SIGPROF, signal.SIG_DFL)
+        assert sampler.thread_clock is None
+        # sampled without weights.
+        stats = find_stats(profiler.stats, 'spin_100ms')
+        assert stats.deep_hits > 0
+        assert stats.deep_time == 0
+
+
 @pytest.mark.flaky(reruns=10)
 def test_tracing_sampler():
     pytest.importorskip('yappi')
     _test_sampling_profiler(TracingSampler(0.0001))
 
 
+@pytest.mark.flaky(reruns=10)
+def test_threads_sampler():
+    def busy():
+        spin(0.3)
+    def idle():
+        time.sleep(0.3)
+    profiler = SamplingProfiler(sampler=ThreadsSampler(0.001))
+    with profiler:
+        threads = [threading.Thread(target=busy),
+                   threading.Thread(target=idle)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    busy_stats = find_stats(profiler.stats, 'busy')
+    idle_stats = find_stats(profiler.stats, 'idle')
+    # all threads are sampled by wall-clock time.
+    assert 0.5 <= busy_stats.deep_hits / idle_stats.deep_hits <= 2
+    if not hasattr(time, 'pthread_getcpuclockid'):
+        return
+    # but weighted by CPU time.
+    assert busy_stats.deep_time > 0.1
+    assert idle_stats.deep_time < busy_stats.deep_time / 10
+    assert profiler.stats.deep_time >= busy_stats.deep_time
+    # the sampler thread is not sampled.
+    with pytest.raises(IndexError):
+        find_stats(profiler.stats, '_sample_periodically')
+
+
+def test_threads_sampler_clock_ids(monkeypatch):
+    resolved = []
+    def pthread_getcpuclockid(thread_id):
+        resolved.append(thread_id)
+        return time.CLOCK_THREAD_CPUTIME_ID
+    monkeypatch.setattr(time, 'pthread_getcpuclockid', pthread_getcpuclockid,
+                        raising=False)
+    sampler = ThreadsSampler()
+    # the clock of an exited thread is not resolved.
+    thread = threading.Thread(target=lambda: None)
+    thread.start()
+    thread.join()
+    assert sampler.thread_cpu_time(thread.ident) is None
+    assert resolved == []
+    # resolved once for an alive thread.
+    thread_id = threading.current_thread().ident
+    assert sampler.thread_cpu_time(thread_id) is not None
+    assert sampler.thread_cpu_time(thread_id) is not None
+    assert resolved == [thread_id]
+    # looked up again for a thread which is starting.
+    starting_thread = threading.Thread(target=lambda: None)
+    starting_thread_id = max(sys._current_frames()) + 1
+    monkeypatch.setitem(threading._limbo, starting_thread, starting_thread)
+    assert sampler.thread_cpu_time(starting_thread_id) is None
+    assert starting_thread_id not in sampler.clock_ids
+    monkeypatch.setitem(threading._active, starting_thread_id,
+                        starting_thread)
+    del threading._limbo[starting_thread]
+    assert sampler.thread_cpu_time(starting_thread_id) is not None
+    assert resolved == [thread_id, starting_thread_id]
+    # but not for a thread which is not started by threading.
+    foreign_thread_id = starting_thread_id + 1
+    assert sampler.thread_cpu_time(foreign_thread_id) is None
+    assert sampler.clock_ids[foreign_thread_id] is None
+
+
 @pytest.mark.flaky(reruns=10)
 def test_tracing_sampler_does_not_sample_too_often():
     pytest.importorskip('yappi')
@@ -64,7 +178,7 @@ def test_tracing_sampler_does_not_sample_too_often():
     class fake_profiler(object):
         samples = []
         @classmethod
-        def sample(cls, frame):
+        def sample(cls, frame, *args):
             cls.samples.append(frame)
         @classmethod
         def count_and_clear_samples(cls):
@@ -93,3 +207,289 @@ def test_sample_1_depth():
     assert frame.f_back is None
     profiler = SamplingProfiler()
     profiler.sample(frame)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 5),
+                    reason='async def requires Python 3.5')
+def test_async_stacks():
+    import asyncio
+    profiler = SamplingProfiler(base_frame=sys._getframe(), async_stacks=True)
+    namespace = {'asyncio': asyncio, 'profiler': profiler, 'sys': sys}
+    exec_(dedent('''
+    async def work():
+        await asyncio.sleep(0)
+        profiler.sample(sys._getframe())
+    async def fetch():
+        await asyncio.gather(work(), work())
+    async def handle():
+        await asyncio.ensure_future(fetch())
+    '''), namespace)
+    handle = namespace['handle']
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(handle())
+    finally:
+        loop.close()
+    profiler.aggregate()
+    # the awaiting tasks are grafted under the pseudo code of each task.
+    assert len(profiler.stats) == 1
+    handle_task_stats = find_stats(profiler.stats, 'handle')
+    assert handle_task_stats.module == 'asyncio.Task'
+    handle_stats = find_stats(handle_task_stats, 'handle')
+    assert handle_stats.lineno is not None
+    fetch_stats = find_stats(handle_stats, 'fetch')
+    assert fetch_stats.module == 'asyncio.Task'
+    work_task_stats = find_stats(find_stats(fetch_stats, 'fetch'), 'work')
+    assert work_task_stats.module == 'asyncio.Task'
+    assert find_stats(work_task_stats, 'work').own_hits == 2
+    # the event loop is not sampled.
+    with pytest.raises(IndexError):
+        find_stats(profiler.stats, 'run_until_complete')
+    # sampled as usual out of tasks.
+    profiler.sample(sys._getframe())
+    profiler.aggregate()
+    assert len(profiler.stats) == 2
+
+
+@pytest.mark.skipif(sys.version_info < (3, 5),
+                    reason='async def requires Python 3.5')
+def test_async_stacks_awaited_later():
+    import asyncio
+    profiler = SamplingProfiler(base_frame=sys._getframe(), async_stacks=True)
+    namespace = {'asyncio': asyncio, 'profiler': profiler, 'sys': sys}
+    exec_(dedent('''
+    async def work():
+        profiler.sample(sys._getframe())
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        profiler.sample(sys._getframe())
+    async def handle():
+        task = asyncio.ensure_future(work())
+        await asyncio.sleep(0)
+        await task
+    '''), namespace)
+    handle = namespace['handle']
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(handle())
+    finally:
+        loop.close()
+    profiler.aggregate()
+    # sampled before and after the task is awaited.
+    work_task_stats = find_stats(profiler.stats, 'work')
+    assert work_task_stats.module == 'asyncio.Task'
+    assert find_stats(work_task_stats, 'work').own_hits == 1
+    handle_stats = find_stats(find_stats(profiler.stats, 'handle'), 'handle')
+    work_task_stats = find_stats(handle_stats, 'work')
+    assert find_stats(work_task_stats, 'work').own_hits == 1
+
+
+def test_async_stacks_threads_sampler():
+    # the running task of another thread is unknown.
+    with pytest.raises(ValueError):
+        SamplingProfiler(sampler=ThreadsSampler(), async_stacks=True)
+
+
+def test_sample_buffer():
+    profiler = SamplingProfiler(base_frame=sys._getframe(), buffer_size=4)
+    for x in range(4):
+        profiler.sample(sys._getframe())
+    # a sample doesn't aggregate.
+    assert len(profiler.stats) == 0
+    # samples are dropped rather than overwritten while the buffer is full.
+    profiler.sample(sys._getframe())
+    assert profiler.dropped_samples == 1
+    assert profiler.meta()['dropped_samples'] == 1
+    # aggregated for the result.
+    stats, __, __ = profiler.result()
+    assert find_stats(stats, 'test_sample_buffer').own_hits == 4
+    # the same stacks are recorded at once.
+    profiler.sample(sys._getframe(), 10)
+    profiler.sample(sys._getframe(), 20)
+    profiler.aggregate()
+    stats = find_stats(profiler.stats, 'test_sample_buffer')
+    assert stats.own_hits == 6
+    assert stats.deep_time_ns == 30
+    # a sample interrupting another one is dropped.
+    with profiler._writing:
+        profiler.sample(sys._getframe())
+    assert profiler.dropped_samples == 2
+    assert profiler._written == profiler._aggregated
+
+
+def test_sample_buffer_aggregated_in_background():
+    profiler = SamplingProfiler(base_frame=sys._getframe(),
+                                sampler=ThreadsSampler(10))
+    profiler.aggregation_interval = 0.01
+    with profiler:
+        assert len(profiler.thread_ids) == 1
+        profiler.sample(sys._getframe())
+        time.sleep(0.1)
+        # aggregated by the background thread.
+        assert profiler._written == profiler._aggregated
+        stats = find_stats(profiler.stats, 'test_sample_buffer_aggregated_'
+                                           'in_background')
+        assert stats.own_hits == 1
+    assert not profiler.thread_ids
+
+
+def test_sample_concurrently():
+    profiler = SamplingProfiler(base_frame=sys._getframe(),
+                                buffer_size=100000)
+    def sample():
+        for x in range(1000):
+            profiler.sample(sys._getframe())
+    threads = [threading.Thread(target=sample) for x in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # every sample is written or dropped.
+    assert profiler._written + profiler.dropped_samples == 10000
+    profiler.aggregate()
+    assert find_stats(profiler.stats, 'sample').own_hits == profiler._written
+
+
+def test_stack_cache():
+    def sample_a():
+        profiler.sample(sys._getframe())
+    def sample_b():
+        profiler.sample(sys._getframe())
+    profiler = SamplingProfiler(base_frame=sys._getframe(), buffer_size=1,
+                                stack_cache_size=1,
+                                sampler=ThreadsSampler(10))
+    for x in range(3):
+        sample_a()
+        profiler.aggregate()
+    assert find_stats(profiler.stats, 'sample_a').own_hits == 3
+    assert profiler.stack_cache_misses == 1
+    assert profiler.stack_cache_hits == 2
+    # the least recently recorded stack is evicted.
+    sample_b()
+    profiler.aggregate()
+    sample_a()
+    profiler.aggregate()
+    assert find_stats(profiler.stats, 'sample_a').own_hits == 4
+    assert find_stats(profiler.stats, 'sample_b').own_hits == 1
+    assert profiler.stack_cache_misses == 3
+    assert profiler.stack_cache_hits == 2
+    assert profiler.meta()['stack_cache_hits'] == 2
+    # invalidated with the cleared statistics.
+    profiler.start()
+    profiler.stop()
+    assert len(profiler.stats) == 0
+    assert not profiler._stack_cache
+    assert profiler.stack_cache_hits == 0
+    sample_a()
+    profiler.aggregate()
+    assert find_stats(profiler.stats, 'sample_a').own_hits == 1
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_mixed_weighted_samples(compact):
+    def caller():
+        pass
+    def callee():
+        pass
+    codes = (caller.__code__, callee.__code__)
+    profiler = SamplingProfiler(compact=compact)
+    # the first unweighted sample makes the caller void.
+    profiler.record(codes, 1, None)
+    profiler.record(codes, 1, 5 * 10 ** 6)
+    profiler.record(codes, 1, 5 * 10 ** 6)
+    profiler.record(codes, 1, None)
+    # the void leaf records also.
+    profiler.record(codes[:1], 1, 5 * 10 ** 6)
+    callee_stats = find_stats(profiler.stats, 'callee')
+    assert callee_stats.own_hits == 4
+    assert callee_stats.deep_time == 0.01
+    caller_stats = find_stats(profiler.stats, 'caller')
+    assert caller_stats.own_hits == 1
+    assert caller_stats.deep_hits == 5
+    assert caller_stats.deep_time == 0.015
+    assert profiler.stats.deep_time == 0.015
+
+
+def test_line_samples():
+    def sample_twice():
+        profiler.sample(sys._getframe())
+        profiler.sample(sys._getframe())
+    profiler = SamplingProfiler(base_frame=sys._getframe(), lines=True)
+    sample_twice()
+    sample_twice()
+    stats, __, __ = profiler.result()
+    lineno = sample_twice.__code__.co_firstlineno
+    sample_stats = find_stats(stats, 'sample_twice')
+    assert sample_stats.line_hits == {lineno + 1: 2, lineno + 2: 2}
+    assert len(sample_stats) == 0
+    # frozen with the statistics.
+    assert find_stats(pickle.loads(pickle.dumps(stats)),
+                      'sample_twice').line_hits == sample_stats.line_hits
+    # the callers count their call-site lines.
+    def call_sample_twice():
+        sample_twice()
+    profiler = SamplingProfiler(base_frame=sys._getframe(), call_lines=True)
+    assert profiler.lines
+    call_sample_twice()
+    stats, __, __ = profiler.result()
+    caller_stats = find_stats(stats, 'call_sample_twice')
+    lineno = call_sample_twice.__code__.co_firstlineno
+    assert caller_stats.line_hits == {lineno + 1: 2}
+    assert sum(find_stats(caller_stats, 'sample_twice')
+               .line_hits.values()) == 2
+
+
+def test_adaptive_interval():
+    sampler = Sampler(0.001, target_overhead=0.01, min_interval=0.0001,
+                      max_interval=0.1)
+    assert sampler.weight == 10
+    # an expensive sample makes the interval longer.
+    assert sampler.adapt(0.0001)
+    assert sampler.interval == pytest.approx(0.01)
+    assert sampler.weight == 100
+    # small changes are ignored.
+    assert not sampler.adapt(0.0001)
+    # within the bounds.
+    for x in range(100):
+        sampler.adapt(1)
+    assert sampler.interval == pytest.approx(0.1, rel=0.1)
+    for x in range(200):
+        sampler.adapt(0)
+    assert sampler.interval == pytest.approx(0.0001, rel=0.1)
+    assert sampler.weight == 1
+    # fixed by default.
+    sampler = Sampler(0.001)
+    assert sampler.weight == 1
+    with pytest.raises(ValueError):
+        Sampler(0.001, target_overhead=0)
+
+
+@pytest.mark.flaky(reruns=10)
+def test_adaptive_itimer_sampler():
+    sampler = ItimerSampler(0.0001, target_overhead=0.5, min_interval=0.0001,
+                            max_interval=0.01)
+    try:
+        _test_sampling_profiler(sampler)
+    finally:
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+    assert sampler.cost > 0
+    # the samples are weighted.
+    profiler = SamplingProfiler(base_frame=sys._getframe())
+    profiler.sample(sys._getframe(), weight=3)
+    profiler.sample(sys._getframe(), weight=2)
+    stats, __, __ = profiler.result()
+    assert find_stats(stats, 'test_adaptive_itimer_sampler').own_hits == 5
+    # the effective interval is shown in the header.
+    sampler = Sampler(0.002, target_overhead=0.01)
+    profiler = SamplingProfiler(sampler=sampler)
+    meta = profiler.meta()
+    assert meta['interval'] == 0.002
+    assert meta['target_overhead'] == 0.01
+    viewer = StatisticsViewer()
+    viewer.set_profiler_class(SamplingProfiler)
+    assert isinstance(viewer.table, SamplingStatisticsTable)
+    viewer.set_result(stats, 1.0, 1.0, meta=meta)
+    markup = viewer.table.make_meta_markup(meta)
+    assert markup[0] == 'INTERVAL '
+    assert markup[1][1] == '2ms'
+    assert viewer.table.make_meta_markup({}) is None
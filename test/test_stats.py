@@ -16,7 +16,7 @@ from profiling.sortkeys import \
     by_deep_time_per_call, by_name, by_own_hits, by_own_time_per_call
 from profiling.stats import \
     FlatFrozenStatistics, FrozenStatistics, RecordingStatistics, \
-    spread_stats, Statistics
+    spread_stats, Statistics, VoidRecordingStatistics
 from profiling.tracing import TracingProfiler
 
 
@@ -123,6 +123,48 @@ def test_recording():
 #     assert stats.cpu_usage == 400 / 1990.
 
 
+def test_aggregates():
+    def foo():
+        pass
+    def bar():
+        pass
+    stats = RecordingStatistics()
+    foo_stats = stats.ensure_child(foo.__code__)
+    bar_stats = foo_stats.ensure_child(bar.__code__)
+    foo_stats.own_hits, bar_stats.own_hits = 1, 2
+    foo_stats.deep_time, bar_stats.deep_time = 3, 2
+    assert stats.deep_hits == 3
+    assert foo_stats.own_time == 1
+    # cached until marked dirty.
+    bar_stats.own_hits = 10
+    assert stats.deep_hits == 3
+    for _stats in [stats, foo_stats, bar_stats]:
+        _stats.mark_dirty()
+    assert stats.deep_hits == 11
+    bar_stats.own_hits = 20
+    stats.invalidate()
+    assert stats.deep_hits == 21
+    # an absent frame takes the times of its children.
+    void_stats = stats.ensure_child(None, VoidRecordingStatistics)
+    void_stats.ensure_child(foo.__code__, RecordingStatistics).deep_time = 5
+    stats.invalidate()
+    assert void_stats.deep_time == 5
+    assert void_stats.own_time == 0
+    # frozen statistics are aggregated once when they are restored.
+    frozen_stats = pickle.loads(pickle.dumps(stats))
+    assert frozen_stats._deep_hits == 21
+    assert frozen_stats.children[0]._own_time is not None
+    # or when they are read first.
+    frozen_stats = FrozenStatistics(own_hits=1, children=[
+        FrozenStatistics(own_hits=2, deep_time=3, children=[
+            FrozenStatistics(own_hits=4, deep_time=1),
+        ]),
+    ])
+    assert frozen_stats.deep_hits == 7
+    assert frozen_stats.children[0]._deep_hits == 6
+    assert frozen_stats.children[0].own_time == 2
+
+
 def test_pickle():
     stats = Statistics(name='ok')
     for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
@@ -160,6 +202,21 @@ def test_flatten():
     assert children['foo'].own_hits == 30
     assert children['bar'].own_hits == 70
     assert children['baz'].own_hits == 50
+    # recursive statistics are not counted twice.
+    stats = FrozenStatistics(children=[
+        FrozenStatistics('foo', own_hits=1, deep_time=10, children=[
+            FrozenStatistics('bar', own_hits=1, deep_time=8, children=[
+                FrozenStatistics('foo', own_hits=1, deep_time=6),
+            ]),
+        ]),
+        FrozenStatistics('foo', own_hits=1, deep_time=3),
+    ])
+    flat_stats = FlatFrozenStatistics.flatten(stats)
+    children = {stats.name: stats for stats in flat_stats}
+    assert children['foo'].own_hits == 3
+    assert children['foo'].deep_hits == 4
+    assert children['foo'].deep_time == 13
+    assert children['bar'].deep_time == 8
 
 
 def test_spread_stats():
@@ -1,14 +1,17 @@
 # -*- coding: utf-8 -*-
 import re
 import sys
+from textwrap import dedent
 import time
 
 import pytest
+from six import exec_, integer_types
 
 from _utils import factorial, find_stats
 from profiling.__main__ import spawn_thread
 from profiling.tracing import TracingProfiler
-from profiling.tracing.timers import GreenletTimer, ThreadTimer
+from profiling.tracing.timers import (
+    AsyncioTaskTimer, GreenletTimer, ThreadTimer, Timer, WallTimer)
 
 
 # is it running on pypy?
@@ -37,9 +40,10 @@ def _test_timer_with_threads(timer, sleep, spawn, join=lambda x: x.join()):
         stat1 = find_stats(profiler.stats, 'light')
         stat2 = find_stats(profiler.stats, 'heavy')
         return (stat1, stat2)
-    # using the default timer.
+    # using the process-wide timer.
     # light() ends later than heavy().  its total time includes heavy's also.
-    normal_profiler = TracingProfiler(base_frame=sys._getframe())
+    normal_profiler = TracingProfiler(base_frame=sys._getframe(),
+                                      timer=Timer())
     stat1, stat2 = profile(normal_profiler)
     assert stat1.deep_time >= stat2.deep_time
     # using the given timer.
@@ -75,3 +79,100 @@ def test_greenlet_timer_with_eventlet():
     eventlet = pytest.importorskip('eventlet', '0.15')
     _test_timer_with_threads(GreenletTimer(), eventlet.sleep, eventlet.spawn,
                              eventlet.greenthread.GreenThread.wait)
+
+
+def test_nanoseconds():
+    for timer in [Timer(), ThreadTimer(), WallTimer()]:
+        assert isinstance(timer(), integer_types)
+    cpu_timer, wall_timer = ThreadTimer(), WallTimer()
+    cpu_time, wall_time = cpu_timer(), wall_timer()
+    time.sleep(0.02)
+    assert wall_timer() - wall_time >= 2 * 10 ** 7
+    assert cpu_timer() - cpu_time < 10 ** 7
+    # the recording tree keeps integer nanoseconds.
+    profiler = TracingProfiler(base_frame=sys._getframe(), timer=WallTimer())
+    with profiler:
+        factorial(1000)
+    stats = find_stats(profiler.stats, 'factorial')
+    assert isinstance(stats.deep_time_ns, integer_types)
+    assert stats.deep_time == stats.deep_time_ns / 1e9
+    # converted into seconds when frozen.
+    frozen_stats = find_stats(profiler.result()[0], 'factorial')
+    assert frozen_stats.deep_time == stats.deep_time
+
+
+@pytest.mark.skipif(sys.version_info < (3, 5),
+                    reason='async def requires Python 3.5')
+def test_asyncio_task_timer():
+    import asyncio
+    namespace = {'asyncio': asyncio, 'factorial': factorial}
+    exec_(dedent('''
+    async def light():
+        factorial(10)
+        await asyncio.sleep(0.1)
+        factorial(10)
+    async def heavy():
+        factorial(10000)
+    async def serve():
+        await asyncio.gather(light(), heavy())
+    '''), namespace)
+    serve = namespace['serve']
+    def run_loop():
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(serve())
+        finally:
+            loop.close()
+    def profile(timer):
+        profiler = TracingProfiler(base_frame=sys._getframe(), timer=timer)
+        with profiler:
+            run_loop()
+        stat1 = find_stats(profiler.stats, 'run_loop')
+        stat2 = find_stats(profiler.stats, 'heavy')
+        return (stat1, stat2)
+    # the loop spans the tasks.
+    stat1, stat2 = profile(ThreadTimer())
+    assert stat1.deep_time >= stat2.deep_time
+    # but the CPU time of the tasks is not of the loop.
+    timer = AsyncioTaskTimer()
+    stat1, stat2 = profile(timer)
+    assert stat1.deep_time < stat2.deep_time
+    assert find_stats(stat1, 'light').own_hits > 0
+    # finished tasks are forgotten.
+    assert [task for __, task in timer._contextual_times] == [None]
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7),
+                    reason='time.thread_time requires Python 3.7')
+def test_asyncio_task_timer_executor():
+    import asyncio
+    cpu_times = []
+    def blocking():
+        t = time.thread_time()
+        while time.thread_time() - t < 0.1:
+            pass
+        cpu_times.append(time.thread_time() - t)
+    namespace = {'asyncio': asyncio, 'blocking': blocking,
+                 'cpu_times': cpu_times, 'factorial': factorial}
+    exec_(dedent('''
+    async def busy():
+        # switch the tasks in the loop thread while blocking.
+        while not cpu_times:
+            factorial(100)
+            await asyncio.sleep(0)
+    async def serve():
+        loop = asyncio.get_event_loop()
+        await asyncio.gather(loop.run_in_executor(None, blocking), busy())
+    '''), namespace)
+    serve = namespace['serve']
+    profiler = TracingProfiler(base_frame=sys._getframe(),
+                               timer=AsyncioTaskTimer(), bias=0)
+    with profiler:
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(serve())
+        finally:
+            loop.close()
+    # the executor thread is timed by its own clock.
+    stats = find_stats(profiler.stats, 'blocking')
+    assert stats.deep_time == pytest.approx(cpu_times[0], abs=0.002)
@@ -1,11 +1,18 @@
 # -*- coding: utf-8 -*-
+import json
+import pickle
 import sys
+import threading
+import time
 
 import pytest
 
-from _utils import factorial, find_stats, foo
-from profiling.stats import RecordingStatistics
-from profiling.tracing import TracingProfiler
+from _utils import factorial, find_multiple_stats, find_stats, foo, spin
+from profiling import histogram
+from profiling.filters import CodeFilter
+from profiling.stats import FlatFrozenStatistics, RecordingStatistics
+from profiling.tracing import calibrate, TracingProfiler
+from profiling.tracing.timers import ThreadTimer, WallTimer
 
 
 def test_setprofile():
@@ -20,6 +27,51 @@ def test_setprofile():
     sys.setprofile(None)
 
 
+@pytest.mark.skipif(not hasattr(sys, 'monitoring'),
+                    reason='sys.monitoring requires Python 3.12')
+def test_monitoring():
+    base_frame = sys._getframe()
+    def gen():
+        yield factorial(10)
+        yield factorial(10)
+    trees = []
+    for backend in ['setprofile', 'monitoring']:
+        profiler = TracingProfiler(base_frame=base_frame, backend=backend)
+        with profiler:
+            factorial(10)
+            list(gen())
+            foo()
+        trees.append(profiler.stats)
+    for tree in trees:
+        factorial_stats = find_multiple_stats(tree, 'factorial')
+        assert len(factorial_stats) == 2
+        assert sum(s.own_hits for s in factorial_stats) == 3
+        # a generator is entered on each resume.
+        assert find_stats(tree, 'gen').own_hits == 3
+        assert find_stats(tree, 'baz').own_hits == 1
+    # ignored code is transparent and disabled after the first call.
+    profiler = TracingProfiler(base_frame=base_frame, backend='monitoring',
+                               ignored_codes=[factorial.__code__])
+    with profiler:
+        factorial(10)
+        factorial(10)
+        foo()
+        with pytest.raises(RuntimeError):
+            TracingProfiler(backend='monitoring').start()
+    assert find_stats(profiler.stats, 'baz').own_hits == 1
+    with pytest.raises(IndexError):
+        find_stats(profiler.stats, 'factorial')
+    assert sys.monitoring.get_tool(sys.monitoring.PROFILER_ID) is None
+
+
+def test_backend():
+    with pytest.raises(ValueError):
+        TracingProfiler(backend='unknown')
+    if not hasattr(sys, 'monitoring'):
+        with pytest.raises(RuntimeError):
+            TracingProfiler(backend='monitoring')
+
+
 def test_profile():
     profiler = TracingProfiler()
     frame = foo()
@@ -55,3 +107,365 @@ def test_profiler():
     assert stats1.own_hits == 2
     assert stats2.own_hits == 0  # entering to __enter__() wasn't profiled.
     assert stats3.own_hits == 1
+
+
+def test_shadow_stack():
+    def gen():
+        for x in range(3):
+            factorial(10)
+            yield x
+    def outer():
+        return list(gen())
+    profiler = TracingProfiler(base_frame=sys._getframe())
+    with profiler:
+        outer()
+        outer()
+    stats1 = find_stats(profiler.stats, 'outer')
+    stats2 = find_stats(stats1, 'gen')
+    stats3 = find_stats(stats2, 'factorial')
+    assert stats1.own_hits == 2
+    assert stats2.own_hits == 8  # resumed 4 times per a call.
+    assert stats3.own_hits == 6
+    assert stats1.deep_time >= stats2.deep_time >= stats3.deep_time > 0
+    # frames entered before profiling are resynchronized as void statistics.
+    frame = foo()
+    profiler._profile(frame, 'call', None)
+    profiler._profile(frame, 'return', None)
+    entries = profiler._local.shadow.entries
+    assert [e[0].f_code.co_name for e in entries] == ['foo', 'bar']
+    assert all(e[2] is None for e in entries)
+    assert find_stats(profiler.stats, 'baz').own_hits == 1
+
+
+def test_thread_stats():
+    def work():
+        factorial(1000)
+    profiler = TracingProfiler(base_frame=sys._getframe())
+    with profiler:
+        threads = [threading.Thread(target=work) for x in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # each thread records into its own tree while profiling.
+        assert len(profiler._shadows) >= 5
+        stats, __, __ = profiler.result()
+        assert find_stats(stats, 'work').own_hits == 4
+    # merged when the profiler stops.
+    stats = find_stats(profiler.stats, 'work')
+    assert stats.own_hits == 4
+    assert find_stats(stats, 'factorial').own_hits == 4
+
+
+def test_calibration():
+    timer = ThreadTimer()
+    bias = calibrate(timer)
+    assert bias > 0
+    # calibrated once for a timer class.
+    assert calibrate(ThreadTimer()) == bias
+    assert TracingProfiler(timer=timer, bias=0).bias == 0
+    # calibrated when the profiler starts not to replace the profile
+    # function while constructing.
+    prev_profile = lambda *x: None
+    sys.setprofile(prev_profile)
+    try:
+        profiler = TracingProfiler(timer=timer)
+        assert sys.getprofile() is prev_profile
+    finally:
+        sys.setprofile(None)
+    assert profiler.bias is None
+    with profiler:
+        pass
+    assert profiler.bias == bias
+    assert profiler.meta() == {'timer': 'ThreadTimer', 'bias': bias,
+                               'backend': 'setprofile', 'hot_threshold': None}
+    # the overhead is estimated by the number of events.
+    profiler._reset_shadows()
+    frame = foo()
+    profiler._profile(frame, 'call', None)
+    profiler._profile(frame, 'return', None)
+    assert profiler.overhead == 2 * bias
+
+
+def test_hot_code():
+    def tiny():
+        pass
+    def heavy():
+        factorial(1000)
+    def caller():
+        for x in range(500):
+            tiny()
+            heavy()
+    profiler = TracingProfiler(base_frame=sys._getframe(), hot_threshold=1e-5,
+                               hot_calls=100, hot_interval=10)
+    with profiler:
+        caller()
+    tiny_stats = find_stats(profiler.stats, 'tiny')
+    heavy_stats = find_stats(profiler.stats, 'heavy')
+    # every call is counted.
+    assert tiny_stats.own_hits == heavy_stats.own_hits == 500
+    assert tiny_stats.estimated
+    assert tiny_stats.deep_time > 0
+    assert not heavy_stats.estimated
+    watch = profiler._local.shadow.watches[tiny.__code__]
+    assert watch.interval == 10
+    # the mark is kept in the frozen statistics.
+    frozen_stats = profiler.result()[0]
+    assert find_stats(frozen_stats, 'tiny').estimated
+    assert not find_stats(frozen_stats, 'heavy').estimated
+    # only counting.
+    profiler = TracingProfiler(base_frame=sys._getframe(), hot_threshold=1e-5,
+                               hot_calls=100, hot_interval=0)
+    with profiler:
+        caller()
+    tiny_stats = find_stats(profiler.stats, 'tiny')
+    assert tiny_stats.own_hits == 500
+    assert tiny_stats.estimated
+    # not called often enough in a CPU second.
+    profiler = TracingProfiler(base_frame=sys._getframe(), hot_threshold=1e-5,
+                               hot_calls=100, hot_rate=1e6)
+    with profiler:
+        caller()
+    tiny_stats = find_stats(profiler.stats, 'tiny')
+    assert tiny_stats.own_hits == 500
+    assert not tiny_stats.estimated
+
+
+def test_c_calls():
+    def callback(x):
+        return x
+    def caller():
+        for x in range(10):
+            len([])
+            [].append(x)
+        sorted([3, 2, 1], key=callback)
+        json.dumps({})
+    class c_codes_t(dict):
+        misses = 0
+        def __getitem__(self, key):
+            if key not in self:
+                self.misses += 1
+            return dict.__getitem__(self, key)
+    profiler = TracingProfiler(base_frame=sys._getframe(), trace_c_calls=True)
+    profiler._c_codes = c_codes = c_codes_t()
+    with profiler:
+        caller()
+    # each C function misses the cache once even if it is a bound method.
+    assert c_codes.misses == len(c_codes)
+    caller_stats = find_stats(profiler.stats, 'caller')
+    len_stats = find_stats(caller_stats, 'len')
+    assert len_stats.own_hits == 10
+    assert len_stats.module == 'builtins'
+    assert len_stats.lineno is None
+    # bound methods share a pseudo code.
+    assert find_stats(caller_stats, 'list.append').own_hits == 10
+    # Python functions called back by a C function are nested in it.
+    sorted_stats = find_stats(caller_stats, 'sorted')
+    callback_stats = find_stats(sorted_stats, 'callback')
+    assert callback_stats.own_hits == 3
+    assert sorted_stats.deep_time >= callback_stats.deep_time
+    assert find_stats(caller_stats, 'dumps').own_hits == 1
+    # round-trip through the frozen statistics.
+    frozen_stats = pickle.loads(pickle.dumps(profiler.stats))
+    frozen_len_stats = find_stats(find_stats(frozen_stats, 'caller'), 'len')
+    assert frozen_len_stats.own_hits == 10
+    assert frozen_len_stats.module == 'builtins'
+    flat_stats = FlatFrozenStatistics.flatten(frozen_stats)
+    assert find_stats(flat_stats, 'sorted').own_hits == 1
+    # not recorded by default.
+    profiler = TracingProfiler(base_frame=sys._getframe())
+    with profiler:
+        caller()
+    with pytest.raises(IndexError):
+        find_stats(profiler.stats, 'len')
+
+
+def test_histograms():
+    def spike(sec):
+        spin(sec)
+    # spin() waits for wall-clock time.  the CPU time of a spike may be
+    # shorter than it under load.
+    profiler = TracingProfiler(base_frame=sys._getframe(), histograms=True,
+                               timer=WallTimer(), bias=0)
+    with profiler:
+        for x in range(9):
+            spike(0.001)
+        spike(0.05)
+    stats = find_stats(profiler.stats, 'spike')
+    assert histogram.total(stats.histogram) == 10
+    assert stats.deep_time_percentile(0.5) < 0.01
+    assert stats.deep_time_percentile(0.99) >= 0.05
+    # kept in the frozen statistics.
+    frozen_stats = pickle.loads(pickle.dumps(profiler.stats))
+    frozen_spike_stats = find_stats(frozen_stats, 'spike')
+    assert frozen_spike_stats.histogram == stats.histogram
+    flat_stats = FlatFrozenStatistics.flatten(frozen_stats)
+    assert find_stats(flat_stats, 'spike').histogram == stats.histogram
+    # switched off by default.
+    profiler = TracingProfiler(base_frame=sys._getframe())
+    with profiler:
+        spike(0.001)
+    stats = find_stats(profiler.stats, 'spike')
+    assert stats.histogram is None
+    assert stats.deep_time_percentile(0.5) is None
+
+
+def test_exemplars():
+    def fetch(sec):
+        spin(sec)
+    def handle(sec):
+        fetch(sec)
+        factorial(10)
+    def serve():
+        for sec in [0.001, 0.03, 0.001, 0.02, 0.001, 0.01, 0.001]:
+            handle(sec)
+    profiler = TracingProfiler(base_frame=sys._getframe(),
+                               exemplar_targets=['handle'], exemplars=3)
+    with profiler:
+        serve()
+    handle_stats = find_stats(profiler.stats, 'handle')
+    # the aggregated tree is not affected.
+    assert handle_stats.own_hits == 7
+    assert find_stats(handle_stats, 'fetch').own_hits == 7
+    assert find_stats(handle_stats, 'spin').own_hits == 7
+    # only the slowest calls are kept.
+    exemplars = list(handle_stats.exemplars)
+    assert len(exemplars) == 3
+    assert [s.own_hits for s in exemplars] == [1, 1, 1]
+    assert exemplars[0].deep_time > 0.02
+    assert exemplars[2].deep_time > 0.005
+    assert exemplars[0].deep_time >= exemplars[1].deep_time
+    assert exemplars[1].deep_time >= exemplars[2].deep_time
+    assert find_stats(exemplars[0], 'spin').own_hits == 1
+    assert find_stats(exemplars[0], 'factorial').own_hits == 1
+    assert find_stats(profiler.stats, 'fetch').exemplars is None
+    # kept in the frozen statistics.
+    frozen_stats = pickle.loads(pickle.dumps(profiler.stats))
+    frozen_exemplars = find_stats(frozen_stats, 'handle').exemplars
+    assert [s.deep_time for s in frozen_exemplars] == \
+        [s.deep_time for s in exemplars]
+    assert find_stats(frozen_exemplars[0], 'spin').own_hits == 1
+    flat_stats = FlatFrozenStatistics.flatten(frozen_stats)
+    assert len(find_stats(flat_stats, 'handle').exemplars) == 3
+    # targeted by code.
+    profiler = TracingProfiler(base_frame=sys._getframe(),
+                               exemplar_targets=[fetch.__code__])
+    with profiler:
+        serve()
+    assert len(find_stats(profiler.stats, 'fetch').exemplars) == 5
+    assert find_stats(profiler.stats, 'handle').exemplars is None
+
+
+def test_collapse_recursion():
+    def walk(depth):
+        if depth:
+            spin(0.001)
+            walk(depth - 1)
+    def ping(n):
+        if n:
+            pong(n - 1)
+    def pong(n):
+        factorial(10)
+        ping(n)
+    def traverse():
+        walk(10)
+        ping(10)
+    profiler = TracingProfiler(base_frame=sys._getframe(),
+                               collapse_recursion=True)
+    with profiler:
+        traverse()
+    traverse_stats = find_stats(profiler.stats, 'traverse')
+    walk_stats = find_stats(traverse_stats, 'walk')
+    # recursive calls are counted in the outermost call.
+    assert walk_stats.own_hits == 11
+    assert len(find_multiple_stats(profiler.stats, 'walk')) == 1
+    assert find_stats(walk_stats, 'spin').own_hits == 10
+    # only the outermost call is timed.
+    assert walk_stats.deep_time < 2 * traverse_stats.deep_time
+    # indirect recursion.
+    ping_stats = find_stats(traverse_stats, 'ping')
+    pong_stats = find_stats(ping_stats, 'pong')
+    assert ping_stats.own_hits == 11
+    assert pong_stats.own_hits == 10
+    assert find_stats(pong_stats, 'factorial').own_hits == 10
+    assert len(find_multiple_stats(profiler.stats, 'ping')) == 1
+    assert len(find_multiple_stats(profiler.stats, 'pong')) == 1
+    active = profiler._local.shadow.active
+    assert walk.__code__ not in active
+    assert ping.__code__ not in active
+    # each recursion level is a child by default.
+    profiler = TracingProfiler(base_frame=sys._getframe())
+    with profiler:
+        traverse()
+    assert len(find_multiple_stats(profiler.stats, 'walk')) == 11
+    traverse_stats = find_stats(profiler.stats, 'traverse')
+    # but the flat view counts the outermost calls only.
+    flat_stats = FlatFrozenStatistics.flatten(traverse_stats)
+    flat_walk_stats = find_stats(flat_stats, 'walk')
+    assert flat_walk_stats.own_hits == 11
+    assert flat_walk_stats.deep_hits == 21
+    assert flat_walk_stats.deep_time < 2 * traverse_stats.deep_time
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_aggregates_while_profiling(compact):
+    # the aggregation in the profiled thread should not be recorded.
+    ignored_codes = CodeFilter(exclude=['profiling.*', 'six'])
+    profiler = TracingProfiler(base_frame=sys._getframe(), compact=compact,
+                               ignored_codes=ignored_codes)
+    with profiler:
+        factorial(10)
+        # find_stats() would walk the tree which it grows.
+        stats = profiler.stats.get_child(factorial.__code__)
+        assert stats.deep_hits == 1
+        own_time = stats.own_time
+        deep_hits = profiler.stats.deep_hits
+        # the recorded paths are marked dirty.
+        factorial(10)
+        assert stats.deep_hits == 2
+        assert stats.own_time > own_time
+        assert profiler.stats.deep_hits > deep_hits
+    # a recursive call of an exemplar target is counted out of its scope.
+    def walk(depth):
+        readings.append(profiler.stats.deep_hits)
+        if depth:
+            walk(depth - 1)
+    readings = []
+    profiler = TracingProfiler(base_frame=sys._getframe(), compact=compact,
+                               ignored_codes=ignored_codes,
+                               collapse_recursion=True,
+                               exemplar_targets=['walk'])
+    with profiler:
+        walk(3)
+    assert [y - x for x, y in zip(readings, readings[1:])] == [1, 1, 1]
+
+
+def test_wall_time():
+    def busy():
+        spin(0.02)
+    def idle():
+        time.sleep(0.02)
+    def work():
+        busy()
+        idle()
+    profiler = TracingProfiler(base_frame=sys._getframe())
+    with profiler:
+        work()
+    busy_stats = find_stats(profiler.stats, 'busy')
+    idle_stats = find_stats(profiler.stats, 'idle')
+    work_stats = find_stats(profiler.stats, 'work')
+    # busy code spends CPU time as much as wall time.
+    assert busy_stats.deep_wall_time >= 0.02
+    assert busy_stats.deep_time > busy_stats.deep_wall_time / 2
+    # waiting code doesn't spend CPU time.
+    assert idle_stats.deep_wall_time >= 0.02
+    assert idle_stats.deep_time < idle_stats.deep_wall_time / 2
+    assert work_stats.deep_wall_time >= 0.04
+    assert work_stats.deep_wall_time_per_call == work_stats.deep_wall_time
+    # kept in the frozen statistics.
+    frozen_stats = pickle.loads(pickle.dumps(profiler.stats))
+    frozen_idle_stats = find_stats(frozen_stats, 'idle')
+    assert frozen_idle_stats.deep_wall_time == idle_stats.deep_wall_time
+    flat_stats = FlatFrozenStatistics.flatten(frozen_stats)
+    flat_idle_stats = find_stats(flat_stats, 'idle')
+    assert flat_idle_stats.deep_wall_time == idle_stats.deep_wall_time
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
-from profiling.viewer import fmt
+from profiling import sortkeys
+from profiling.stats import FrozenStatistics, LineStatistics
+from profiling.viewer import fmt, LeafStatisticsNode, StatisticsViewer
 
 
 def test_fmt():
@@ -18,6 +20,8 @@ def test_fmt():
     assert fmt.markup_time(0) == ('zero', '0')
     assert fmt.markup_time(0.123456) == ('msec', '123ms')
     assert fmt.markup_time(12.34567) == ('sec', '12.3sec')
+    assert fmt.markup_time_or_na(None) == ('zero', 'n/a')
+    assert fmt.markup_time_or_na(0.123456) == ('msec', '123ms')
 
 
 def test_format_int():
@@ -55,3 +59,60 @@ def test_format_percent():
     assert fmt.format_percent(0.999999) == '100'
     assert fmt.format_percent(0.9999) == '100'
     assert fmt.format_percent(0.988) == '98.8'
+
+
+def test_markup_stats():
+    stats = FrozenStatistics('foo', 'foo.py', 10, 'foo')
+    assert fmt.markup_stats(stats) == [('name', 'foo'), ' ',
+                                       ('loc', '(foo:10)')]
+    # builtin functions don't have line numbers.
+    stats = FrozenStatistics('len', None, None, 'builtins')
+    assert fmt.markup_stats(stats) == [('name', 'len'), ' ',
+                                       ('loc', '(builtins)')]
+    # a sampled line.
+    stats = LineStatistics(name='foo', lineno=12, own_hits=3)
+    assert fmt.markup_stats(stats) == [('weak', 'line '), ('loc', '12')]
+
+
+def test_line_stats():
+    callee = FrozenStatistics('bar', own_hits=2)
+    stats = FrozenStatistics('foo', 'foo.py', 10, 'foo', own_hits=4,
+                             line_hits={11: 1, 12: 3}, children=[callee])
+    root = FrozenStatistics(children=[stats])
+    viewer = StatisticsViewer()
+    viewer.table.sort_stats(sortkeys.by_deep_hits)
+    viewer.set_result(root, 1.0, 1.0)
+    node = viewer.table.get_focus()[1].get_child_node(stats)
+    # the lines are expanded along with the callees, the hottest first.
+    keys = node.get_child_keys()
+    assert [(s.lineno, s.own_hits) for s in keys] == \
+        [(12, 3), (None, 2), (11, 1)]
+    assert isinstance(keys[0], LineStatistics)
+    assert isinstance(node.get_child_node(keys[0]), LeafStatisticsNode)
+
+
+def test_open_exemplar():
+    exemplars = [FrozenStatistics('handle', own_hits=1, deep_time=t)
+                 for t in [3.0, 2.0]]
+    stats = FrozenStatistics('handle', own_hits=10, deep_time=10.0,
+                             exemplars=exemplars)
+    root = FrozenStatistics(children=[stats])
+    viewer = StatisticsViewer()
+    viewer.set_result(root, 10.0, 10.0)
+    viewer.open_exemplar(stats)
+    assert viewer.paused
+    assert viewer.table.stats.children == [exemplars[0]]
+    assert viewer.table.title == 'exemplar 1/2 of handle'
+    # the next slowest one.
+    viewer.open_exemplar(exemplars[0])
+    assert viewer.table.stats.children == [exemplars[1]]
+    viewer.open_exemplar(exemplars[1])
+    assert viewer.table.stats.children == [exemplars[0]]
+    viewer.resume()
+    assert viewer.table.stats is root
+    # nothing to open.
+    viewer.open_exemplar(root)
+    assert not viewer.paused
+    viewer.open_exemplar(None)
+    assert not viewer.paused
+    StatisticsViewer().table.keypress((80, 20), 'x')